@@ -4,16 +4,133 @@ import requests
 import webbrowser
 import time
 import json
+import importlib.util
 import os
-from bs4 import BeautifulSoup
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from bs4 import BeautifulSoup, SoupStrainer
+import metrics
+from fetch import FetchError, QuotaExhausted, crawl, write_json_atomic, start_refresh
+from bincache import load_store
+from catalog import Catalog
+from enrich import enrich_store, join
+from export import export_selection
+from mapview import map_selection
+from refine import Refinement
+from sessionlog import save_trace
+from store import merge_stores
+from stream import iter_food, predicate
+from textindex import load_text_index
 
 api_key = 'Enter API Key Here'  # you do not need an API key since we are caching
 # please input either Detroit or Ann Arbor in the command to get the cached data
+cache_ttl = 7 * 24 * 60 * 60  # seconds before a cached page is fetched again
+## set METRICS_FILE to a .prom or .jsonl file to record how long each step of a
+# session takes, and PROFILE_FILE to a file to sample where the time goes
+metrics_file = os.environ.get('METRICS_FILE')
+profile_file = os.environ.get('PROFILE_FILE')
+## the final results of a session are exported here if it's set, and
+# mapped to MAP_FILE, an .html page or a .geojson file
+export_file = os.environ.get('EXPORT_FILE')
+map_file = os.environ.get('MAP_FILE')
+## messages from background threads, printed before the next prompt
+# instead of in the middle of one
+notices = queue.Queue()
+
+def ask(prompt):
+    '''
+    Prints the messages background threads have queued since the
+    last prompt, then asks the user for input.
+    '''
+    while True:
+        try:
+            print(notices.get_nowait())
+        except queue.Empty:
+            break
+    return input(prompt)
+
+class Missing:
+    '''A stand-in for a field the restaurant data doesn't have.
+    There is only one, missing, shared by every Food object instead
+    of each one holding its own placeholder string.'''
+    __slots__ = ()
+    def __bool__(self):
+        return False
+    def __repr__(self):
+        return 'missing'
+
+missing = Missing()
+_ratings = {} # one shared float per distinct rating
+
+## what gets printed in place of a missing field, same as the old placeholders
+placeholders = {'name': 'No Name', 'latitude': 'No Latitude',
+                'longitude': 'No Longitude', 'address': 'No Address',
+                'price': 'No Price', 'rating': 'No Rating',
+                'type': 'No Type', 'url': 'No URL',
+                'review_count': 'No Reviews', 'eater': 'Not on Eater'}
+
+def _text(value):
+    '''
+    Interns a repeated string like a price or type so every Food
+    object shares one copy.'''
+    if isinstance(value, str):
+        return sys.intern(value)
+    return missing if value is None else value
+
+def _rating(value):
+    '''
+    Returns the shared float for a rating.'''
+    if value is None or value is missing:
+        return missing
+    value = float(value)
+    return _ratings.setdefault(value, value)
+
+def _count(value):
+    '''
+    Returns a count as an int, or missing.'''
+    if value is None or value is missing:
+        return missing
+    return int(value)
+
+def _coordinate(json, key):
+    if isinstance(json.get("coordinates"), dict):
+        value = json["coordinates"].get(key)
+        if value is not None:
+            return value
+    return missing
+
+def _address(json):
+    if isinstance(json.get("location"), dict):
+        address = json["location"].get("display_address")
+        if address is not None:
+            return address # shared with the record instead of copied
+    return missing
+
+def _type(json):
+    if json.get("categories"):
+        return _text(json["categories"][0].get("title"))
+    return missing
+
+## how each field is read from a Yelp record
+parsers = {'name': lambda json: json.get("name") or missing,
+           'latitude': lambda json: _coordinate(json, "latitude"),
+           'longitude': lambda json: _coordinate(json, "longitude"),
+           'address': _address,
+           'price': lambda json: _text(json.get("price")),
+           'rating': lambda json: _rating(json.get("rating")),
+           'type': _type,
+           'url': lambda json: json.get("url") or missing,
+           'review_count': lambda json: _count(json.get("review_count")),
+           'eater': lambda json: json.get("eater") or missing}
 
 class Food:
     '''Gets food data from the API and assigns attributes
     like name, latitude, longitude, address, price, yelp rating,
-    and url.
+    and url. Food objects use __slots__ instead of a __dict__,
+    price and type strings are interned, and every missing field
+    is the shared missing object, so large multi-city datasets
+    stay small.
 
     Instance Attributes
     -------------------
@@ -23,8 +140,8 @@ class Food:
         the latitude location of the restaurant
     longitude: float
         the longitude location of the restaurant
-    address: string
-        the address of the restaurant
+    address: list
+        the lines of the address of the restaurant
     price: string
         the price of the restaurant (1-4 dollar signs)
     rating: float
@@ -33,42 +150,50 @@ class Food:
         the type of restaurant
     url: string
         the yelp url of the restaurant
-    json: string
-        filepath to a json file'''
-    def __init__(self, name="No Name", latitude="No Latitude",
-                 longitude="No Longitude", address="No Address",
-                 price="No Price", rating="No Rating", type="No Type",
-                 url="No URL", json=None):
+    review_count: int
+        how many Yelp reviews the rating is an average of
+    eater: dict
+        the restaurant's Eater entry and match confidence, if it's
+        on the Eater list
+    json: dict
+        a restaurant record from the Yelp API'''
+    __slots__ = ('name', 'latitude', 'longitude', 'address', 'price',
+                 'rating', 'type', 'url', 'review_count', 'eater')
+
+    def __init__(self, name=missing, latitude=missing,
+                 longitude=missing, address=missing,
+                 price=missing, rating=missing, type=missing,
+                 url=missing, review_count=missing, eater=missing, json=None):
         if json == None:
             self.name = name
             self.latitude = latitude
             self.longitude = longitude
             self.address = address
-            self.price = price
-            self.rating = float(rating)
-            self.type = type
+            self.price = _text(price)
+            self.rating = _rating(rating)
+            self.type = _text(type)
             self.url = url
+            self.review_count = _count(review_count)
+            self.eater = eater
         else:
-            self.name = json.get("name", "No Name")
-            if isinstance(json["coordinates"], dict):
-                self.latitude = json["coordinates"].get("latitude", "No Latitude")
-                self.longitude = json["coordinates"].get("longitude", "No Longitude")
-            else:
-                self.latitude = "No Latitude"
-                self.longitude = "No Longitude"
-            self.address = json["location"].get("display_address", "No Address")
-            self.price = json.get("price", "No Price")
-            self.rating = float(json.get("rating", "No Rating"))
-            if json["categories"]:
-                self.type = json["categories"][0].get("title", "No Type")
-            else:
-                self.type = "No Type"
-            self.url = json.get("url", "No URL")
+            for field in Food.__slots__:
+                setattr(self, field, parsers[field](json))
+    def text(self, field):
+        '''
+        Returns a field, or its placeholder text if it's missing.'''
+        value = getattr(self, field)
+        return placeholders[field] if value is missing else value
     def info(self):
         '''
         Returns a string with the name, type, rating,
         and price of the restaurant'''
-        return f"{self.name}, {self.type}, {self.rating}, {self.price}"
+        return f"{self.text('name')}, {self.text('type')}, {self.text('rating')}, {self.text('price')}"
+    def as_dict(self):
+        '''
+        Returns the fields of the restaurant as a dictionary,
+        with None for missing fields.'''
+        return {field: None if getattr(self, field) is missing else getattr(self, field)
+                for field in placeholders}
 
 def get_map(latitude, longitude):
     '''
@@ -85,53 +210,161 @@ def get_map(latitude, longitude):
     url = "https://www.google.com/maps/search/?api=1&query={},{}".format(latitude, longitude)
     webbrowser.open(url) # opens your web browser to the url
 
-def get_api(term):
+def load_records(term, max_workers=8, folder='.'):
     '''
-    Gets data from the Yelp API and returns a list of Restaurant
-    data. Initially, it looks for a cache file. If it finds one,
-    it'll load from that file. If not, it'll make a request to
-    the API and save the data to a cache file. It'll also return
-    50 restaurants at a time. Note, the API only allows 1000 search
-    results, so this function will take a while to run. Caching
-    should be faster.
+    Gets the raw restaurant data for a city from the Yelp API.
+    Initially, it looks for a cache file. If it finds one, it'll
+    load from that file. If not, it'll request every page of
+    results from the API at once, up to max_workers at a time, and
+    save them to the cache file in one write. Note, the API only
+    allows 1000 search results. Throttled or failed pages are
+    retried, and an interrupted fetch picks up where it stopped.
+    Caching should be faster.
 
     Parameters
     ----------
     term: string
         The city term for the API
+    max_workers: int
+        The most pages requested from the API at the same time
+    folder: string
+        The folder the cache file is in; fetched caches are always
+        saved in the working folder
 
     Returns
     -------
-    restaurants: list
-        A list of 50 Restaurants
+    records: list
+        A list of dictionaries of restaurants
+
+    Raises
+    ------
+    FetchError
+        if there's no cache and it can't be fetched, right away if
+        no API key is set
     '''
-    restaurants = []
     cache = f'{term}.json'
-    filepath = os.getcwd() + '/' + cache
+    filepath = os.path.join(os.getcwd(), folder, cache)
     ## check if cache file exists to load
     if os.path.exists(filepath):
-        with open(filepath, 'r') as file:
-            data = json.load(file)['businesses']
-        return [Food(json=r) for r in data] # returns a list of Food objects
+        metrics.count('cache_hits', 1, 'json')
+        with metrics.timer('load_records', term):
+            with open(filepath, 'r') as file:
+                records = json.load(file)['businesses']
+        metrics.count('records_parsed', len(records), 'json')
+        return records
     ## if cache file doesn't exist, make a request to the API
-    else:
-        headers = {
-            "accept": "application/json",
-            'Authorization': 'Bearer %s' % api_key}
-        url = 'https://api.yelp.com/v3/businesses/search'
-        for offset in range(0, 1000, 50):
-            params = {'term': 'food', 'location': term, 'limit': 50, 'offset': offset}
-            response = requests.get(url, headers=headers, params=params)
-            data = response.json()
-            businesses = data['businesses']
-            restaurants += businesses  # Appending new restaurants to the list
-            with open(cache, 'w') as f:
-                json.dump({'businesses': restaurants}, f)
-        return [Food(json=r) for r in restaurants] # returns a list of Food objects
-
-def get_top(cache, final1):
+    # the crawl checkpoints every page and writes the cache once at the end
+    metrics.count('cache_misses', 1, 'json')
+    if api_key == 'Enter API Key Here':
+        ## without a key every page would just be retried until it fails
+        raise FetchError(f'there is no cache for {term} and no Yelp API key to fetch it with')
+    with metrics.timer('crawl', term):
+        return crawl([term], api_headers(), max_workers=max_workers)[term]
+
+def api_headers():
+    '''
+    Returns the headers for a Yelp API request.
+    '''
+    return {
+        "accept": "application/json",
+        'Authorization': 'Bearer %s' % api_key}
+
+def get_api(term, max_workers=8):
+    '''
+    Gets data from the Yelp API, or its cache files, and returns
+    a list of Restaurant data.
+
+    Parameters
+    ----------
+    term: string
+        The city term for the API
+    max_workers: int
+        The most pages requested from the API at the same time
+
+    Returns
+    -------
+    restaurants: list
+        A list of Food objects
+    '''
+    return list(get_store(term, max_workers))
+
+def stream_api(term, food_type=None, rating=None, price=None, max_workers=8):
+    '''
+    Reads a city's cache one restaurant at a time instead of loading
+    it all, for one pass jobs like exports. The filters are checked
+    on each record before a Food object is made, so memory stays the
+    same however big the cache is. If there's no cache yet, it's
+    fetched from the API first.
+
+    Parameters
+    ----------
+    term: string
+        The city term for the API
+    food_type: string
+        only restaurants with a category containing it, if given
+    rating: float
+        only restaurants rated at least this, if given
+    price: string
+        only restaurants with this price in dollar signs, if given
+    max_workers: int
+        The most pages requested from the API at the same time
+
+    Returns
+    -------
+    restaurants: generator
+        the Food objects of the restaurants that pass
+    '''
+    cache = f'{term}.json'
+    if not os.path.exists(cache):
+        load_records(term, max_workers)
+    return iter_food(cache, predicate(food_type, rating, price), Food)
+
+def get_store(term, max_workers=8, folder='.'):
+    '''
+    Gets data from the Yelp API, or its cache files, and returns
+    every restaurant as a Selection of a RestaurantStore. The
+    store is memory-mapped from the binary cache, {term}.bin,
+    which is rebuilt from {term}.json whenever that file changes.
+    Food objects are only made for rows that get displayed. If the
+    city's Eater list is cached, each restaurant on it gets its
+    Eater entry attached, from a join saved next to the caches. The
+    full-text index of the city is loaded from {term}_text.npz the
+    first time it's searched, or built and saved if either cache has
+    changed.
+
+    Parameters
+    ----------
+    term: string
+        The city term for the API
+    max_workers: int
+        The most pages requested from the API at the same time
+    folder: string
+        The folder the caches are in
+
+    Returns
+    -------
+    restaurants: Selection
+        every restaurant in the city
+    '''
+    ## every cache of the city, and the files built from them, are in folder
+    path = os.path.normpath(os.path.join(folder, term))
+    store = load_store(path, lambda path: load_records(term, max_workers, folder), Food)
+    page = eater_pages.get(term.lower().replace(' ', '_'))
+    eater_cache = os.path.join(folder, page['cache']) if page is not None else None
+    if eater_cache is not None and not os.path.exists(eater_cache):
+        eater_cache = None
+    if eater_cache is not None:
+        enrich_store(store, path, eater_cache)
+    store.load_text = lambda: load_text_index(path, store, eater_cache)
+    return store.all()
+
+def get_top(cache, final1, record=None):
     '''
     Checks if the input restaurant is in the top scraped restaurants.
+    The match is the one the Eater join made when the city loaded,
+    which checks phone numbers and street addresses as well as names.
+    If the city's Eater list wasn't there to join when it loaded, the
+    raw record is run through the same join now.
     If it is, the users will be asked if they want to learn more. If
     not, it'll print that it wasn't found.If so, it'll print the
     restaurant's name, description, address, phone number, and url.
@@ -139,162 +372,172 @@ def get_top(cache, final1):
     Parameters
     ----------
     cache: list
-        A list of dictionaries of the top scraped restaurants
+        The top scraped restaurants
     final1: Food
         A Food object of the input restaurant
+    record: dict
+        The restaurant's Yelp record, given only if its city wasn't
+        joined to the Eater list
     '''
-    found = False
-    for c in cache:
-        if c['name'] == final1.name:
-            found = True
-            print('Found in Top Restaurants!')
-            while True:
-                answer = input('Do you want to learn more? (yes/no): ')
-                if answer.lower() == 'yes':
-                    print(c['name'])
-                    print(c['description'])
-                    print(c['address'])
-                    print(c['phone'])
-                    print(c['url'])
-                    break
-                elif answer.lower() == 'no':
-                    print('Okay!')
-                    break
-                else:
-                    print('Try again!')
-                    continue
-    if not found:
+    c, score = None, 0
+    with metrics.timer('eater_lookup'):
+        if final1.eater:
+            ## already joined when the city loaded
+            c, score = final1.eater, final1.eater['confidence']
+        elif record is not None:
+            matches = join([record], cache)
+            if matches:
+                c, score = cache[matches[0][1]], matches[0][2]
+    metrics.count('eater_lookups', 1, 'none' if not c else 'exact' if score == 1 else 'fuzzy')
+    if c:
+        print('Found in Top Restaurants!')
+        if score < 1:
+            print(f"Closest match: {c['name']} ({score:.0%} confidence)")
+        while True:
+            answer = ask('Do you want to learn more? (yes/no): ')
+            if answer.lower() == 'yes':
+                print(c['name'])
+                print(c['description'])
+                print(c['address'])
+                print(c['phone'])
+                print(c['url'])
+                break
+            elif answer.lower() == 'no':
+                print('Okay!')
+                break
+            else:
+                print('Try again!')
+                continue
+    else:
         print('Not Found in Top Restaurants')
 
-def get_types(restaurants):
+def get_types(refinement):
     '''
-    Gets a list of restaurants matching the input type.
-    Appends the restaurants to a new list and returns it.
-    If the list is too large, it'll only print the first 50.
-    Will check if the input type is valid and in the list of
-    restaurants.
+    Filters the restaurants by type, keeping those with any category
+    matching the input type. Entering ? lists every type that can be
+    searched. Will check if the input type is valid and in the list
+    of restaurants.
 
     Parameters
     ----------
-    restaurants: list
-        a list of dictionaries of restaurants
+    refinement: Refinement
+        the stages of the session so far, a stage is added to it
 
     Returns
     -------
-    new_restaurants: list
-        a list of dictionaries of restaurants matching
-        the input type
+    done: bool
+        True once a stage is added, False if the user wants to go back
     '''
-    new_restaurants = []
     while True:
-        next = input("Do you want to filter the type of food? (yes/no): ")
-        ## keeps running until user inputs yes or no
+        next = ask("Do you want to filter the type of food? (yes/no/back): ")
+        ## keeps running until user inputs yes, no or back
         if next.lower() == 'yes':
-            valid_input = False
-            while not valid_input:
-                food_type = input("Enter a food type: ")
-                for r in restaurants:
-                    if food_type.lower() in r.type.lower():
-                        new_restaurants.append(r)
-                        valid_input = True
-                    else:
-                        continue
-                if not valid_input:
+            while True:
+                food_type = ask("Enter a food type (? to list types): ")
+                ## lists every type that can be searched
+                if food_type.strip() == '?':
+                    print(', '.join(refinement.store.categories.types()))
+                    continue
+                if refinement.try_push('type', food_type) is None:
                     print("No restaurants found. Try again.")
                     continue
-            return new_restaurants
+                return True
         elif next.lower() == 'no':
-            return restaurants
+            refinement.push()
+            return True
+        elif next.lower() == 'back':
+            return False
         else:
-            print("Invalid input. Please enter yes or no.")
+            print("Invalid input. Please enter yes, no or back.")
             continue
 
 
-def get_rating(restaurants):
+def get_rating(refinement):
     '''
-    Gets a list of restaurants matching the input rating.
-    Appends the restaurants to a new list and returns it.
-    If the list is too large, it'll only print the first 50.
+    Filters the restaurants by the input minimum rating.
 
     Parameters
     ----------
-    restaurants: list
-        a list of dictionaries of restaurants
+    refinement: Refinement
+        the stages of the session so far, a stage is added to it
 
     Returns
     -------
-    new_restaurants: list
-        a list of dictionaries of restaurants matching
-        the input ratng
-    '''
-    new_restaurants = []
-    next = input("Do you want to filter the rating? (yes/no): ")
-    if next.lower() == 'yes':
-        ## only takes specific floats, will keep asking until valid input
-        while True:
-            try:
-                rating = float(input("Enter a rating: "))
-                if rating >= 1 and rating <= 5:
-                    for r in restaurants:
-                        if r.rating >= float(rating):
-                            new_restaurants.append(r)
-                    return new_restaurants
-                else:
-                    print("Invalid input. Please enter a rating between 1 and 5. Decimals must be .0 or .5.")
+    done: bool
+        True once a stage is added, False if the user wants to go back
+    '''
+    while True:
+        next = ask("Do you want to filter the rating? (yes/no/back): ")
+        if next.lower() == 'yes':
+            ## only takes specific floats, will keep asking until valid input
+            while True:
+                try:
+                    rating = float(ask("Enter a rating: "))
+                    if rating >= 1 and rating <= 5:
+                        if refinement.try_push('rating', rating) is None:
+                            print("No restaurants found. Try again.")
+                            continue
+                        return True
+                    else:
+                        print("Invalid input. Please enter a rating between 1 and 5. Decimals must be .0 or .5.")
+                        continue
+                except ValueError:
+                    print("Invalid input. Please enter a float.")
                     continue
-            except ValueError:
-                print("Invalid input. Please enter a float.")
-                continue
-    elif next.lower() == 'no':
-        return restaurants
-    ## keeps running until user inputs yes or no
-    else:
-        print("Invalid input. Please enter yes or no.")
-        get_rating(restaurants)
+        elif next.lower() == 'no':
+            refinement.push()
+            return True
+        elif next.lower() == 'back':
+            return False
+        ## keeps running until user inputs yes, no or back
+        else:
+            print("Invalid input. Please enter yes, no or back.")
 
-def get_price(restaurants):
+def get_price(refinement):
     '''
-    Gets a list of restaurants matching the input price.
+    Filters the restaurants by the input price.
     Also checks if the input is valid and made of dollar signs.
-    Appends the restaurants to a new list and returns it.
-    If the list is too large, it'll only print the first 50.
 
     Parameters
     ----------
-    restaurants: list
-        a list of dictionaries of restaurants
+    refinement: Refinement
+        the stages of the session so far, a stage is added to it
 
     Returns
     -------
-    new_restaurants: list
-        a list of dictionaries of restaurants matching the input price'''
-    new_restaurants = []
-    next = input("Do you want to filter the price? (yes/no): ")
-    if next.lower() == 'yes':
-        while True:
-            price = input("Enter a price: ")
-            ## takes specific dollar sign amounts, will keep asking until valid input
-            if price == '$' or price == '$$' or price == '$$$' or price == '$$$$':
-                for i in restaurants:
-                    if i.price == price:
-                        new_restaurants.append(i)
-                return new_restaurants
-            else:
-                print("Invalid price. Please enter 1-4 dollar signs.")
-                continue
-    elif next.lower() == 'no':
-        return restaurants
-    ## keeps running until user inputs yes or no
-    else:
-        print("Invalid input. Please enter yes or no.")
-        get_price(restaurants)
+    done: bool
+        True once a stage is added, False if the user wants to go back
+    '''
+    while True:
+        next = ask("Do you want to filter the price? (yes/no/back): ")
+        if next.lower() == 'yes':
+            while True:
+                price = ask("Enter a price: ")
+                ## takes specific dollar sign amounts, will keep asking until valid input
+                if price == '$' or price == '$$' or price == '$$$' or price == '$$$$':
+                    if refinement.try_push('price', price) is None:
+                        print("No restaurants found. Try again.")
+                        continue
+                    return True
+                else:
+                    print("Invalid price. Please enter 1-4 dollar signs.")
+                    continue
+        elif next.lower() == 'no':
+            refinement.push()
+            return True
+        elif next.lower() == 'back':
+            return False
+        ## keeps running until user inputs yes, no or back
+        else:
+            print("Invalid input. Please enter yes, no or back.")
 
 def final_step(final, cache):
     '''
     Takes in a list and checks if it contains one or more restaurants.
-    If the list contains one restaurant, it will print the final
-    results and asks the user if they want to get directions to the
-    restaurant. If it contains more than one restaurant, the user can
+    The best 50 are shown, ranked by their rating weighted by how many
+    reviews it comes from. If the list contains one restaurant, it will
+    print the final results and asks the user if they want to get
+    directions to the restaurant. If it contains more than one restaurant, the user can
     choose which restaurant to get directions to. If the user enters yes,
     it'll call the get_map function to open a Google Maps link to the
     restaurant's location. If the user enters no, it'll end the session.
@@ -308,11 +551,11 @@ def final_step(final, cache):
 
     Parameters
     ----------
-    final: list
-        a list of dictionaries of restaurants
+    final: Selection
+        the restaurants that passed every filter
 
     cache: list
-        a list of dictionaries of restaurants and their information
+        the top scraped restaurants
 
     Returns
     -------
@@ -321,17 +564,22 @@ def final_step(final, cache):
     print(' ')
     print('Final Results')
     print('---------------------------')
-    ## prints the first 50 results
-    for i, r in enumerate(final[:50]):
-        print(f"{i}. {r.info()}")
+    ## prints the best 50 results, so a 5.0 from 3 reviews doesn't beat
+    # a 4.5 from 2000
+    final = final.top(50)
+    ## rows of a city loaded before its Eater list was there aren't joined yet
+    unjoined = not final.store.eater_entries
+    record = lambda i: final.store.records[final.ids[i]] if unjoined else None
+    for i, r in enumerate(final):
+        print(f"{i}. {r.info()}" + (' (Eater pick)' if r.eater else ''))
     ## if 1, asks if user wants directions to the restaurant
     if len(final) == 1:
         while True:
             print(' ')
-            ans = input("Would you like to see if your restaurant is part of Eater's Top Restaurants? (yes/no): ")
+            ans = ask("Would you like to see if your restaurant is part of Eater's Top Restaurants? (yes/no): ")
             if ans.lower() == 'yes':
                 final1 = r
-                get_top(cache, final1)
+                get_top(cache, final1, record(0))
                 break
             elif ans.lower() == 'no':
                 print(' ')
@@ -340,7 +588,7 @@ def final_step(final, cache):
                 # only accepts yes or no
                 print('Invalid input. Please enter yes or no.')
                 continue
-            answer = input("Would you like to get directions to this restaurant? (yes/no): ")
+            answer = ask("Would you like to get directions to this restaurant? (yes/no): ")
             if answer.lower() == 'yes':
                 get_map(r.latitude, r.longitude)
                 break
@@ -355,15 +603,15 @@ def final_step(final, cache):
     ## if multiple, asks which restaurant they want directions to
     elif len(final) > 1:
         print(' ')
-        ans = input("Please pick a number of a restaurant: ")
+        ans = ask("Please pick a number of a restaurant: ")
         while True:
             if ans.isdigit():
                 if int(ans) < len(final) and int(ans) >= 0:
-                    ans1 = input("Would you like to see if your restaurant is part of Eater's Top Restaurants? (yes/no): ")
+                    ans1 = ask("Would you like to see if your restaurant is part of Eater's Top Restaurants? (yes/no): ")
                     while True:
                         if ans1.lower() == 'yes':
                             final1 = final[int(ans)]
-                            get_top(cache, final1)
+                            get_top(cache, final1, record(int(ans)))
                             break
                         elif ans1.lower() == 'no':
                             print(' ')
@@ -376,7 +624,7 @@ def final_step(final, cache):
                 else:
                     print('Invalid input. Please enter a valid number.')
                     continue
-            answer = input("Would you like to get directions to this restaurant? (yes/no): ")
+            answer = ask("Would you like to get directions to this restaurant? (yes/no): ")
             while True:
                 if answer.lower() == 'yes':
                     get_map(final[int(ans)].latitude, final[int(ans)].longitude)
@@ -390,137 +638,123 @@ def final_step(final, cache):
                     print('Invalid input. Please enter yes or no.')
                     continue
             break
-def webscrape(term):
+## one row per city Eater has a map for: the page and the cache it's saved to
+eater_pages = {
+    'detroit': {'url': 'https://detroit.eater.com/maps/best-restaurants-detroit-38',
+                'cache': 'Detroit_webscrape.json'},
+    'ann_arbor': {'url': 'https://detroit.eater.com/maps/best-ann-arbor-restaurants',
+                  'cache': 'Ann_Arbor_webscrape.json'},
+}
+
+## lxml builds the tree several times faster than the pure Python parser
+html_parser = 'lxml' if importlib.util.find_spec('lxml') else 'html.parser'
+
+def parse_card(card):
     '''
-    Takes in a city and scrapes a website for a list of top restaurants
-    and their descriptions. It then returns a list of dictionaries
-    containing the restaurant names and descriptions.
+    Reads one Eater map card. The card's divs are walked once and each
+    field is taken from the first div with its class.
 
     Parameters
     ----------
-    city: string
-        a string of the city name
+    card: Tag
+        a c-mapstack__card element
 
     Returns
     -------
-    complete: list
-        a list of dictionaries of top restaurants and their information
+    restaurant: dict
+        the name, description, address, phone and url of the
+        restaurant, or None if the card has no name (like the intro)
     '''
-    restaurants = []
-    descriptions = []
-    addresses = []
-    phone_num = []
-    website = []
-    if term.lower() == 'Detroit'.lower():
-        cache = f'{term}_webscrape.json'
-        filepath = os.getcwd() + '/' + cache
-        ## check if cache file exists to load
-        if os.path.exists(filepath):
-            with open(filepath, 'r') as file:
-                data = json.load(file)
-            return data # returns a list of dictionaries
-        url = 'https://detroit.eater.com/maps/best-restaurants-detroit-38'
-        result = requests.get(url)
-        doc = BeautifulSoup(result.text, 'html.parser')
-        rest = doc.find_all('div', {'class': 'c-mapstack__card-hed'})
-        rest1 = doc.find_all('div', {'class': 'c-entry-content venu-card'})
-        rest2 = doc.find_all('div', {'class': 'c-mapstack__address'})
-        rest3 = doc.find_all('div', {'class': 'c-mapstack__phone desktop-only'})
-        rest4 = doc.find_all('div', {'class': 'info'})
-        for div in rest:
-            restaurant = {}
-            d = div.find('div')
-            h1 = d.find('h1')
-            if h1:
-                restaurant['name'] = h1.text.strip()
-                restaurants.append(restaurant)
-        for div in rest1:
-            desc = {}
-            p = div.find('p')
-            if p:
-                ul = p.find_next_sibling('ul', {'class': 'services'})
-                if ul:
-                    desc['description'] = p.text[:p.text.index(ul.text)]
-                else:
-                    desc['description'] = p.text
-                if desc not in descriptions:
-                    descriptions.append(desc)
-        for div in rest2:
-            address = {}
-            a = div.find('a')
-            if a:
-                address['address'] = a.text
-                addresses.append(address)
-        for div in rest3:
-            phone = {}
-            a = div.find('a')
-            if a:
-                phone['phone'] = a.text
-                phone_num.append(phone)
-        for div in rest4:
-            web = {}
-            d = div.find_all('div')[1]
-            a = d.find('a', {'data-analytics-link': 'link-icon'})
-            if a:
-                web['url'] = a['href']
-                website.append(web)
-    elif term.lower() == 'Ann Arbor'.lower() or term.lower() == 'Ann_Arbor'.lower():
-        cache = '/Ann_Arbor_webscrape.json' # wasn't reading term
-        filepath = os.getcwd() + cache
-        ## check if cache file exists to load
-        if os.path.exists(filepath):
-            with open(filepath, 'r') as file:
-                data = json.load(file)
-            return data # returns a list of dictionaries
-        url = 'https://detroit.eater.com/maps/best-ann-arbor-restaurants'
-        result = requests.get(url)
-        doc = BeautifulSoup(result.text, 'html.parser')
-        rest = doc.find_all('div', {'class': 'c-mapstack__card-hed'})
-        rest1 = doc.find_all('div', {'class': 'c-entry-content venu-card'})
-        rest2 = doc.find_all('div', {'class': 'c-mapstack__address'})
-        rest3 = doc.find_all('div', {'class': 'c-mapstack__phone desktop-only'})
-        rest4 = doc.find_all('div', {'class': 'info'})
-        ## storing restaurant names and descriptions separately
-        for div in rest:
-            restaurant = {}
-            d = div.find('div')
-            h1 = d.find('h1')
+    restaurant = {}
+    for div in card.find_all('div', class_=True):
+        classes = div['class']
+        if 'c-mapstack__card-hed' in classes and 'name' not in restaurant:
+            h1 = div.find('h1')
             if h1:
                 restaurant['name'] = h1.text.strip()
-                restaurants.append(restaurant)
-        for div in rest1:
-            desc = {}
+        elif 'venu-card' in classes and 'description' not in restaurant:
             p = div.find('p')
             if p:
-                desc['description'] = p.text
-                descriptions.append(desc)
-        for div in rest2:
-            address = {}
+                text = p.text
+                ## the services list can end up inside the paragraph
+                ul = p.find('ul', {'class': 'services'})
+                if ul and ul.text in text:
+                    text = text[:text.index(ul.text)]
+                restaurant['description'] = text
+        elif 'c-mapstack__address' in classes and 'address' not in restaurant:
             a = div.find('a')
             if a:
-                address['address'] = a.text
-                addresses.append(address)
-        for div in rest3:
-            phone = {}
+                restaurant['address'] = a.text
+        elif 'c-mapstack__phone' in classes and 'desktop-only' in classes and 'phone' not in restaurant:
             a = div.find('a')
             if a:
-                phone['phone'] = a.text
-                phone_num.append(phone)
-        for div in rest4:
-            web = {}
-            d = div.find_all('div')[1]
-            a = d.find('a', {'data-analytics-link': 'link-icon'})
+                restaurant['phone'] = a.text
+        elif 'info' in classes and 'url' not in restaurant:
+            a = div.find('a', {'data-analytics-link': 'link-icon'})
             if a:
-                web['url'] = a['href']
-                website.append(web)
-    ## the lists originally stored like name, name, description, description
-    # reordering the list of dictionaries
-    for i in range(len(restaurants)):
-        restaurants[i].update(descriptions[i])
-        restaurants[i].update(addresses[i])
-        restaurants[i].update(phone_num[i])
-        restaurants[i].update(website[i])
-        cache_webscrape(cache, restaurants)
+                restaurant['url'] = a['href']
+    if 'name' not in restaurant:
+        return None
+    return {field: restaurant.get(field) for field in ('name', 'description', 'address', 'phone', 'url')}
+
+def parse_eater(html):
+    '''
+    Parses an Eater map page into a list of restaurants. Only the
+    map cards are built into a tree, and each is read in one pass.
+
+    Parameters
+    ----------
+    html: string
+        the page
+
+    Returns
+    -------
+    restaurants: list
+        a list of dictionaries of top restaurants and their information
+    '''
+    cards = SoupStrainer(class_='c-mapstack__card')
+    doc = BeautifulSoup(html, html_parser, parse_only=cards)
+    restaurants = []
+    for card in doc.find_all(class_='c-mapstack__card'):
+        restaurant = parse_card(card)
+        if restaurant:
+            restaurants.append(restaurant)
+    return restaurants
+
+def webscrape(term):
+    '''
+    Takes in a city and scrapes a website for a list of top restaurants
+    and their descriptions. It then returns a list of dictionaries
+    containing the restaurant names and descriptions. The page for
+    each city comes from eater_pages, and the results are cached
+    after one write.
+
+    Parameters
+    ----------
+    city: string
+        a string of the city name
+
+    Returns
+    -------
+    complete: list
+        a list of dictionaries of top restaurants and their information
+    '''
+    page = eater_pages.get(term.lower().replace(' ', '_'))
+    if page is None:
+        return []
+    cache = page['cache']
+    filepath = os.getcwd() + '/' + cache
+    ## check if cache file exists to load
+    if os.path.exists(filepath):
+        metrics.count('cache_hits', 1, 'eater')
+        with open(filepath, 'r') as file:
+            data = json.load(file)
+        return data # returns a list of dictionaries
+    metrics.count('cache_misses', 1, 'eater')
+    with metrics.timer('scrape', term):
+        result = requests.get(page['url'])
+        restaurants = parse_eater(result.text)
+    cache_webscrape(cache, restaurants)
     return restaurants
 
 def cache_webscrape(cache, restaurant):
@@ -536,8 +770,93 @@ def cache_webscrape(cache, restaurant):
     -------
     None
     '''
-    with open(cache, 'w') as f:
-        json.dump(restaurant, f)
+    write_json_atomic(cache, restaurant)
+
+_catalog = None # the catalog of the caches, made the first time it's needed
+
+def get_catalog():
+    '''
+    Returns the catalog of the city caches in the working folder.
+    '''
+    global _catalog
+    if _catalog is None:
+        _catalog = Catalog()
+    return _catalog
+
+def city_term(term, refresh=True):
+    '''
+    Turns a city the user typed into the name of its cache. The
+    catalog knows each cache's other names, like "ann arbor" for
+    Ann_Arbor, and a city without a cache gets a name without spaces.
+
+    Parameters
+    ----------
+    term: string
+        the city the user typed
+    refresh: bool
+        whether to rescan the caches for a city the catalog doesn't
+        know, in case it was fetched since the catalog was read
+
+    Returns
+    -------
+    term: string
+        the city term for the cache files
+    '''
+    catalog = get_catalog()
+    found = catalog.resolve(term)
+    if found is None and refresh and catalog.refresh():
+        ## a cache may have been fetched since the catalog was read
+        found = catalog.resolve(term)
+    if found is not None:
+        return found
+    return term.strip().replace(' ', '_')
+
+def city_terms(term):
+    '''
+    Splits what the user typed into the cache names of each city.
+    '''
+    return [city_term(t.strip()) for t in term.split(',') if t.strip()]
+
+def load_eater(terms):
+    '''
+    Scrapes, or loads the cache of, the top restaurants of every city
+    and returns them together. They're only needed for the join.
+    '''
+    entries = []
+    for t in terms:
+        entries += webscrape(t)
+    return entries
+
+def load_cities(term, pool):
+    '''
+    Loads the restaurants and the Eater top restaurants of one or
+    more cities all at once. Every city's Yelp data and the Eater
+    data load in parallel, so a cold start takes about as long as
+    the slowest load instead of the sum of them. This returns once
+    the Yelp data is ready, while the Eater data may still be
+    loading.
+
+    Parameters
+    ----------
+    term: string
+        the cities the user typed, separated by commas
+    pool: ThreadPoolExecutor
+        the threads the loads run on
+
+    Returns
+    -------
+    eater: Future
+        gives the top restaurants of every city when they're ready
+    restaurants: Selection
+        every restaurant in the cities
+    '''
+    terms = city_terms(term)
+    eater = pool.submit(load_eater, terms)
+    stores = [pool.submit(get_store, t) for t in terms]
+    stores = [s.result().store for s in stores]
+    if not stores:
+        return eater, []
+    return eater, merge_stores(stores).all()
 
 def main():
     '''
@@ -547,117 +866,87 @@ def main():
     ----------
     None
     '''
-    ## the cache file is named 'Ann_Arbor.json'
-    # removes chance for error if user inputs Ann Arbor
-    term = input("Enter a city: ")
-    if term.lower() == 'Ann Arbor'.lower():
-        term = 'Ann_Arbor'
-    cache = webscrape(term)
-    res = get_api(term)
-    restaurants = []
+    if metrics_file:
+        metrics.enable(metrics_file)
+    if profile_file:
+        metrics.start_profiler(profile_file)
+    term = ask("Enter a city (or several, separated by commas): ")
+    pool = ThreadPoolExecutor()
     while True:
-        ## if there are no city results or a typo, ask for input again
-        if len(res) == 0:
-            term = input("No results. Enter a city: ")
-            res = get_api(term)
-            continue
         ## user can choose to exit
-        elif term.lower() == 'exit':
+        if term.lower() == 'exit':
             print('Session Ended')
             time.sleep(1)
             quit()
+        try:
+            with metrics.timer('load_cities'):
+                eater, res = load_cities(term, pool)
+        except QuotaExhausted:
+            print("The Yelp API's daily limit has been reached, so only cached cities can be loaded today.")
+            res = []
+        except FetchError as e:
+            print(f'Could not load {term}: {e}')
+            res = []
+        ## if there are no city results or a typo, ask for input again
+        if len(res) == 0:
+            term = ask("No results. Enter a city: ")
+            continue
         else:
-            for r in res:
-                restaurants.append(r)
+            restaurants = res
+            ## with a key, expired pages are fetched again in the background
+            # while the cached data keeps being used
+            if api_key != 'Enter API Key Here':
+                for t in city_terms(term):
+                    start_refresh(t, api_headers(), cache_ttl, notify=notices.put)
             print(' ')
             print('Printing the first 50 of 1000 results')
             print('---------------------------')
             for r in restaurants[:50]:
                 print(r.info())
         break
-    while True:
-        new_restaurants = get_types(restaurants)
-        ## if there are no results or a typo, ask for input again
-        if new_restaurants == None:
-            print(' ')
-            print('No results found. Please try again.')
-            continue
-        elif len(new_restaurants) == 1:
-            ## if only one restaurant, jumps to final step
-            final_step(new_restaurants, cache=cache)
-            print('Session Ended')
-            break
-        else:
-            ## ignores if the user doesn't want to filter by type
-            if new_restaurants != restaurants:
-                print(' ')
-                print('Previewing up to 50 results')
-                print('---------------------------')
-                for r in new_restaurants[:50]:
-                    print(r.info())
-            break
-    while True:
-        new_restaurants1 = get_rating(new_restaurants)
-        ## if there are no results or a typo, ask for input again
-        if new_restaurants1 == None:
+    ## each step adds a stage, and back drops the one before it
+    refinement = Refinement(restaurants)
+    steps = [get_types, get_rating, get_price]
+    step = 0
+    while step < len(steps):
+        if not steps[step](refinement):
+            if step == 0:
+                print('Nothing to go back to.')
+                continue
+            ## the stage before is dropped and its question asked again
+            refinement.pop()
+            step -= 1
             print(' ')
-            print('No results found. Please try again.')
+            print(f'Back to {refinement.count()} results')
             continue
-        elif len(new_restaurants1) == 1:
+        new_restaurants = refinement.selection()
+        if len(new_restaurants) == 1:
             ## if only one restaurant, jumps to final step
-            final_step(new_restaurants1, cache=cache)
+            save_trace(refinement.selections(), city_terms(term), filters=refinement.filters())
+            final_step(new_restaurants, cache=eater.result())
             print('Session Ended')
             time.sleep(1)
             quit()
-        else:
-            ## ignores if the user doesn't want to filter by rating
-            if new_restaurants1 != new_restaurants:
-                print(' ')
-                print('Previewing up to 50 results')
-                print('---------------------------')
-                for r in new_restaurants1[:50]:
-                    print(r.info())
-            break
-    while True:
-        ## if there are no results or a typo, ask for input again
-        final = get_price(new_restaurants1)
-        if final == None:
+        ## ignores if the user didn't want to filter at this step
+        if step < len(steps) - 1 and refinement.count() != refinement.count(-2):
             print(' ')
-            print('No results found. Please try again.')
-            continue
-        else:
-            break
-
-    ## adding to json file
-    final_dict = {}
-    rests = []
-    for r in restaurants:
-        rests.append(r.info())
-    final_dict['initial results'] = rests
-    rests1 = []
-    for r in new_restaurants:
-        if r is None:
-            rests1.append('No results')
-        else:
-            rests1.append(r.info())
-    final_dict['type results'] = rests1
-    rests2 = []
-    for r in new_restaurants1:
-        if r is None:
-            rests2.append('No results')
-        else:
-            rests2.append(r.info())
-    final_dict['rating results'] = rests2
-    rests3 = []
-    for r in final:
-        if r is None:
-            rests3.append('No results')
-        else:
-            rests3.append(r.info())
-    final_dict['price results'] = rests3
-    with open('tree.json', 'w') as f:
-        json.dump(final_dict, f)
+            print('Previewing up to 50 results')
+            print('---------------------------')
+            for r in new_restaurants[:50]:
+                print(r.info())
+        step += 1
+    final = refinement.selection()
+
+    ## adding the session to the trace log for tree.py
+    save_trace(refinement.selections(), city_terms(term), filters=refinement.filters())
+    if export_file:
+        export_selection(final, export_file)
+    if map_file:
+        try:
+            map_selection(final, map_file, ', '.join(city_terms(term)))
+        except ValueError as e:
+            print(f'No map written: {e}')
     ## runs the final step
-    final_step(final, cache=cache)
+    final_step(final, cache=eater.result())
 if __name__ == "__main__":
     main()
@@ -0,0 +1,546 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from bs4 import BeautifulSoup
+
+from FinalProject_akdas import Food, parse_eater
+import FinalProject_akdas
+from bincache import open_cache, write_cache
+from export import export_selection
+from mapview import cluster_selection
+from spatial import SpatialIndex
+from sessionlog import save_trace
+from store import RestaurantStore
+from stream import iter_food
+from textindex import build_index, store_documents
+
+## saved Eater pages, so the scraper can be timed without a network
+scrape_fixtures = ['fixtures/eater_detroit.html', 'fixtures/eater_ann_arbor.html']
+
+## dataset sizes the suite runs at unless told otherwise
+suite_sizes = [1000, 10000, 100000]
+
+## the filter chains the suite times, as the interactive prompts would
+## run them: (type, rating, price), None for a skipped filter
+suite_queries = [('pizza', 4, '$$'), ('sushi', 4.5, None), ('coffee', None, '$'),
+                 ('american', 3, None), (None, 4, '$$$'), ('bar', 3.5, '$$')]
+
+
+class DictFood:
+    '''The Food class before it used __slots__, kept here so the
+    memory benchmark can compare against it. Every instance has a
+    __dict__ and its own placeholder strings.'''
+    def __init__(self, json):
+        self.name = json.get("name", "No Name")
+        if isinstance(json["coordinates"], dict):
+            self.latitude = json["coordinates"].get("latitude", "No Latitude")
+            self.longitude = json["coordinates"].get("longitude", "No Longitude")
+        else:
+            self.latitude = "No Latitude"
+            self.longitude = "No Longitude"
+        self.address = json["location"].get("display_address", "No Address")
+        self.price = json.get("price", "No Price")
+        self.rating = float(json.get("rating", "No Rating"))
+        if json["categories"]:
+            self.type = json["categories"][0].get("title", "No Type")
+        else:
+            self.type = "No Type"
+        self.url = json.get("url", "No URL")
+
+
+def legacy_parse(html):
+    '''
+    The Eater parsing from before the scraper was table-driven, kept
+    here so the scrape benchmark can compare against it. It builds the
+    whole page with html.parser and makes five find_all passes.
+    '''
+    doc = BeautifulSoup(html, 'html.parser')
+    rest = doc.find_all('div', {'class': 'c-mapstack__card-hed'})
+    rest1 = doc.find_all('div', {'class': 'c-entry-content venu-card'})
+    rest2 = doc.find_all('div', {'class': 'c-mapstack__address'})
+    rest3 = doc.find_all('div', {'class': 'c-mapstack__phone desktop-only'})
+    rest4 = doc.find_all('div', {'class': 'info'})
+    restaurants = [{'name': div.find('div').find('h1').text.strip()} for div in rest if div.find('div').find('h1')]
+    descriptions = []
+    for div in rest1:
+        p = div.find('p')
+        if p and {'description': p.text} not in descriptions:
+            descriptions.append({'description': p.text})
+    addresses = [{'address': div.find('a').text} for div in rest2 if div.find('a')]
+    phone_num = [{'phone': div.find('a').text} for div in rest3 if div.find('a')]
+    website = []
+    for div in rest4:
+        a = div.find_all('div')[1].find('a', {'data-analytics-link': 'link-icon'})
+        if a:
+            website.append({'url': a['href']})
+    for i in range(len(restaurants)):
+        restaurants[i].update(descriptions[i])
+        restaurants[i].update(addresses[i])
+        restaurants[i].update(phone_num[i])
+        restaurants[i].update(website[i])
+    return restaurants
+
+
+def bench_scrape(fixtures, repeats):
+    '''
+    Times parsing the synthetic Eater pages in fixtures/ with the old
+    five-pass parser and with parse_eater, using every parser backend
+    installed.
+
+    Parameters
+    ----------
+    fixtures: list
+        the HTML pages, see fixtures/README.md
+    repeats: int
+        how many times to parse each page
+
+    Returns
+    -------
+    results: dict
+        the mean parse time in ms of each parser for each page
+    '''
+    parsers = [('old five-pass, html.parser', legacy_parse)]
+    backends = ['html.parser'] + (['lxml'] if FinalProject_akdas.html_parser == 'lxml' else [])
+    for backend in backends:
+        def parse(html, backend=backend):
+            FinalProject_akdas.html_parser = backend
+            return parse_eater(html)
+        parsers.append((f'single pass, {backend}', parse))
+    default = FinalProject_akdas.html_parser
+    results = {}
+    try:
+        for path in fixtures:
+            with open(path, 'r') as file:
+                html = file.read()
+            for name, parse in parsers:
+                start = time.perf_counter()
+                for i in range(repeats):
+                    parse(html)
+                results[f'{path} {name} (ms)'] = (time.perf_counter() - start) / repeats * 1000
+    finally:
+        FinalProject_akdas.html_parser = default
+    return results
+
+
+def load_copies(cities, copies):
+    '''
+    Loads the city caches copies times over. Each copy is parsed
+    from the file again so its strings are new objects, like a
+    separate metro would be.
+
+    Parameters
+    ----------
+    cities: list
+        the city cache names, like Detroit or Ann_Arbor
+    copies: int
+        how many times to load every city
+
+    Returns
+    -------
+    records: list
+        a list of dictionaries of restaurants
+    '''
+    texts = []
+    for city in cities:
+        with open(f'{city}.json', 'r') as file:
+            texts.append(file.read())
+    records = []
+    for i in range(copies):
+        for text in texts:
+            records += json.loads(text)['businesses']
+    return records
+
+
+def measure(make, records):
+    '''
+    Measures the memory used by the objects make builds from records.
+    The records themselves are not counted, since the store keeps
+    them either way.
+
+    Parameters
+    ----------
+    make: function
+        builds one object from a record
+    records: list
+        a list of dictionaries of restaurants
+
+    Returns
+    -------
+    bytes_per_restaurant: float
+        the bytes allocated per object, including the list holding them
+    '''
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [make(r) for r in records]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return (after - before) / len(records)
+
+
+def bench_memory(cities, copies):
+    '''
+    Compares the bytes per restaurant of the old Food class and the
+    compact Food class.
+
+    Parameters
+    ----------
+    cities: list
+        the city cache names, like Detroit or Ann_Arbor
+    copies: int
+        how many times to load every city
+
+    Returns
+    -------
+    results: dict
+        the bytes per restaurant of each class
+    '''
+    records = load_copies(cities, copies)
+    return {'restaurants': len(records),
+            'dict Food': measure(DictFood, records),
+            'slots Food': measure(lambda r: Food(json=r), records)}
+
+
+def bench_spatial(points, queries, k=10, seed=0):
+    '''
+    Times nearest, radius and bounding box queries on a synthetic
+    set of points spread over the Detroit metro area.
+
+    Parameters
+    ----------
+    points: int
+        how many points to index
+    queries: int
+        how many queries of each kind to time
+    k: int
+        how many neighbors the nearest queries return
+    seed: int
+        the random seed for the points and queries
+
+    Returns
+    -------
+    results: dict
+        the build time in seconds and the mean time of each query in ms
+    '''
+    rng = np.random.default_rng(seed)
+    latitude = rng.uniform(42.0, 42.8, points)
+    longitude = rng.uniform(-83.8, -82.8, points)
+    start = time.perf_counter()
+    index = SpatialIndex(latitude, longitude)
+    build = time.perf_counter() - start
+    centers = rng.uniform([42.0, -83.8], [42.8, -82.8], (queries, 2))
+    results = {'points': points, 'build (s)': build}
+    for name, query in [(f'nearest {k} (ms)', lambda lat, lon: index.nearest(lat, lon, k)),
+                        ('within 2 km (ms)', lambda lat, lon: index.near(lat, lon, 2000)),
+                        ('bounding box (ms)', lambda lat, lon: index.within(lat - 0.01, lon - 0.01, lat + 0.01, lon + 0.01))]:
+        start = time.perf_counter()
+        for lat, lon in centers:
+            query(lat, lon)
+        results[name] = (time.perf_counter() - start) / queries * 1000
+    return results
+
+
+def synthetic_records(n, seed=0, cities=['Detroit', 'Ann_Arbor']):
+    '''
+    Makes n fake Yelp records shaped like the ones in the caches.
+    Names, categories and prices are drawn from the shipped caches so
+    the filters select about as much as they do on real data, and the
+    coordinates are spread over the Detroit metro area.
+
+    Parameters
+    ----------
+    n: int
+        how many records to make
+    seed: int
+        the random seed
+    cities: list
+        the city caches to draw from
+
+    Returns
+    -------
+    records: list
+        a list of dictionaries of restaurants
+    '''
+    real = load_copies(cities, 1)
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(real), n)
+    ratings = rng.choice([1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0], n)
+    reviews = rng.geometric(0.005, n)
+    latitude = rng.uniform(42.0, 42.8, n)
+    longitude = rng.uniform(-83.8, -82.8, n)
+    records = []
+    for i in range(n):
+        base = real[picks[i]]
+        record = {'id': f'synthetic-{i}',
+                  'name': f"{base.get('name', 'Restaurant')} {i}",
+                  'rating': float(ratings[i]),
+                  'review_count': int(reviews[i]),
+                  'categories': base.get('categories', []),
+                  'coordinates': {'latitude': float(latitude[i]), 'longitude': float(longitude[i])},
+                  'location': {'display_address': base['location'].get('display_address', [])},
+                  'url': f'https://www.yelp.com/biz/synthetic-{i}'}
+        if 'price' in base:
+            record['price'] = base['price']
+        records.append(record)
+    return records
+
+
+def run_filters(restaurants, queries):
+    '''
+    Runs each filter chain the way get_types, get_rating and get_price
+    do, and returns the last result of each chain.
+    '''
+    results = []
+    for food_type, rating, price in queries:
+        found = restaurants
+        if food_type is not None:
+            found = found.where_type(food_type)
+        if rating is not None:
+            found = found.where_rating(rating)
+        if price is not None:
+            found = found.where_price(price)
+        results.append(found)
+    return results
+
+
+def time_stage(run, rows, repeats, memory):
+    '''
+    Times one stage and, if asked, measures its peak memory in a
+    separate run so tracemalloc doesn't slow down the timing.
+
+    Parameters
+    ----------
+    run: function
+        runs the stage once
+    rows: int
+        how many restaurants the stage handles, for the throughput
+    repeats: int
+        how many times to time the stage; the fastest run is kept
+    memory: bool
+        whether to measure the peak memory
+
+    Returns
+    -------
+    result: dict
+        the seconds, rows per second and peak bytes of the stage,
+        with None for the peak if it wasn't measured
+    '''
+    best = float('inf')
+    for i in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    peak = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {'seconds': best, 'rows_per_second': rows / best if best > 0 else None,
+            'peak_bytes': peak}
+
+
+def bench_suite(sizes, cities, repeats=3, memory=True, seed=0):
+    '''
+    Times every stage of a session without prompts: loading the
+    shipped caches, building the store, making Food objects, running
+    the type, rating and price filters, ranking the best results,
+    parsing the saved Eater pages and logging the session trace. The
+    store, Food, filter, ranking and output stages are run on
+    synthetic data at each size.
+
+    Parameters
+    ----------
+    sizes: list
+        how many synthetic restaurants to run with
+    cities: list
+        the shipped city caches to load
+    repeats: int
+        how many times to time each stage
+    memory: bool
+        whether to measure the peak memory of each stage
+    seed: int
+        the random seed for the synthetic data
+
+    Returns
+    -------
+    results: dict
+        each stage name mapped to its seconds, rows per second and
+        peak bytes, see time_stage
+    '''
+    results = {}
+    texts = []
+    for city in cities:
+        with open(f'{city}.json', 'r') as file:
+            texts.append(file.read())
+    records = [r for text in texts for r in json.loads(text)['businesses']]
+
+    def load_json():
+        for text in texts:
+            RestaurantStore(json.loads(text)['businesses'], Food)
+
+    results['load json cache'] = time_stage(load_json, len(records), repeats, memory)
+
+    def stream_json():
+        for city in cities:
+            for food in iter_food(f'{city}.json', food_class=Food):
+                pass
+
+    results['stream json cache'] = time_stage(stream_json, len(records), repeats, memory)
+    with tempfile.TemporaryDirectory() as folder:
+        sources = []
+        for city, text in zip(cities, texts):
+            path = os.path.join(folder, f'{city}.bin')
+            write_cache(path, json.loads(text)['businesses'], f'{city}.json')
+            sources.append((path, f'{city}.json'))
+
+        def load_binary():
+            for path, source in sources:
+                open_cache(path, source, Food)
+
+        results['load binary cache'] = time_stage(load_binary, len(records), repeats, memory)
+        pages = []
+        for path in scrape_fixtures:
+            with open(path, 'r') as file:
+                pages.append(file.read())
+        scraped = sum(len(parse_eater(html)) for html in pages)
+        results['scrape parse'] = time_stage(lambda: [parse_eater(html) for html in pages],
+                                             scraped, repeats, memory)
+        for n in sizes:
+            synthetic = synthetic_records(n, seed)
+            results[f'build store {n}'] = time_stage(lambda: RestaurantStore(synthetic, Food),
+                                                     n, repeats, memory)
+            store = RestaurantStore(synthetic, Food)
+            everything = store.all()
+            results[f'food objects {n}'] = time_stage(lambda: [Food(json=r) for r in synthetic],
+                                                      n, repeats, memory)
+            results[f'filters {n}'] = time_stage(lambda: run_filters(everything, suite_queries),
+                                                 n * len(suite_queries), repeats, memory)
+            results[f'rank top 50 {n}'] = time_stage(lambda: everything.top(50), n, repeats, memory)
+            results[f'rank top 50 near {n}'] = time_stage(lambda: everything.top(50, 42.33, -83.05),
+                                                          n, repeats, memory)
+            results[f'text index build {n}'] = time_stage(
+                lambda: build_index(store_documents(everything.store)), n, repeats, memory)
+            everything.store.attach_text(build_index(store_documents(everything.store)))
+            results[f'text search {n}'] = time_stage(lambda: everything.search('late night tacos'),
+                                                     n, repeats, memory)
+            results[f'export csv {n}'] = time_stage(
+                lambda: export_selection(everything, os.path.join(folder, 'export.csv')), n, repeats, memory)
+            results[f'map clusters {n}'] = time_stage(lambda: cluster_selection(everything), n, repeats, memory)
+            stages = [everything] + run_filters(everything, suite_queries[:1])
+            log = os.path.join(folder, f'trace{n}.jsonl')
+            start = time.perf_counter()
+            save_trace([everything, stages[1], stages[1], stages[1]], ['synthetic'], log)
+            elapsed = time.perf_counter() - start
+            ## the first session also writes the restaurant table
+            results[f'trace first session {n}'] = {'seconds': elapsed, 'rows_per_second': n / elapsed,
+                                                   'peak_bytes': None}
+            ## later sessions of the same cities only log their row ids
+            results[f'trace output {n}'] = time_stage(
+                lambda: save_trace([everything, stages[1], stages[1], stages[1]], ['synthetic'], log),
+                n, repeats, memory)
+            del synthetic, store, everything, stages
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    Compares the times of a run against a saved baseline.
+
+    Parameters
+    ----------
+    results: dict
+        the stages of this run, see bench_suite
+    baseline: dict
+        the stages of the saved run
+    threshold: float
+        how many percent slower a stage can get before it counts
+        as a regression
+
+    Returns
+    -------
+    regressions: list
+        a line describing each stage that got too slow
+    '''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['seconds'], result['seconds']
+        change = (after - before) / before * 100 if before > 0 else 0.0
+        if change > threshold:
+            regressions.append(f'{name}: {before * 1000:.2f} ms -> {after * 1000:.2f} ms ({change:+.0f}%)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the restaurant finder.')
+    parser.add_argument('stage', choices=['memory', 'spatial', 'scrape', 'suite'], help='what to benchmark')
+    parser.add_argument('--cities', nargs='+', default=['Detroit', 'Ann_Arbor'])
+    parser.add_argument('--copies', type=int, default=10,
+                        help='how many times to load every city')
+    parser.add_argument('--points', type=int, default=1000000,
+                        help='how many synthetic points the spatial index holds')
+    parser.add_argument('--queries', type=int, default=1000,
+                        help='how many spatial queries of each kind to time')
+    parser.add_argument('--repeats', type=int,
+                        help='how many times to parse each saved Eater page (20 by default), '
+                             'or to time each suite stage (3 by default)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=suite_sizes,
+                        help='synthetic dataset sizes for the suite, up to 1000000')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip measuring the peak memory of each suite stage')
+    parser.add_argument('--save', help='file to save the suite results to as a baseline')
+    parser.add_argument('--compare', help='baseline file to compare the suite results against')
+    parser.add_argument('--threshold', type=float, default=20,
+                        help='percent a stage can slow down before the comparison fails')
+    args = parser.parse_args()
+    if args.repeats is not None and args.repeats < 1:
+        parser.error('--repeats must be at least 1')
+    if args.stage == 'memory':
+        results = bench_memory(args.cities, args.copies)
+        print(f"{results.pop('restaurants')} restaurants")
+        for name, size in results.items():
+            print(f'{name}: {size:.0f} bytes per restaurant')
+    elif args.stage == 'spatial':
+        results = bench_spatial(args.points, args.queries)
+        print(f"{results.pop('points')} points")
+        for name, value in results.items():
+            print(f'{name}: {value:.4f}')
+    elif args.stage == 'scrape':
+        for name, value in bench_scrape(scrape_fixtures, args.repeats or 20).items():
+            print(f'{name}: {value:.2f}')
+    elif args.stage == 'suite':
+        results = bench_suite(args.sizes, args.cities, args.repeats or 3, memory=not args.no_memory)
+        for name, result in results.items():
+            peak = result['peak_bytes']
+            print(f"{name}: {result['seconds'] * 1000:.2f} ms, "
+                  f"{result['rows_per_second']:.0f} rows/s"
+                  + (f', peak {peak / 2**20:.1f} MiB' if peak is not None else ''))
+        if args.save:
+            with open(args.save, 'w') as file:
+                json.dump(results, file, indent=2)
+        if args.compare:
+            with open(args.compare, 'r') as file:
+                regressions = compare(results, json.load(file), args.threshold)
+            for line in regressions:
+                print(f'Regression {line}')
+            if regressions:
+                sys.exit(1)
+            print(f'No stage slowed down more than {args.threshold:g}%')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+import metrics
+from fetch import write_bytes_atomic
+from store import RestaurantStore, parse_columns
+
+## bump the version whenever the layout below changes
+magic = b'FOODBIN\x00'
+version = 2
+
+## magic, version, rows, categories, source size, source mtime (ns)
+header = struct.Struct('<8sHxxIIQq')
+
+## every section, in file order, with its dtype (None for raw bytes).
+## With n rows, m row categories and k distinct categories, the
+## columns have n items, category_start and record_start n + 1,
+## category_codes m and key_start 2k + 1 (an alias and a title each)
+sections = [('rating', np.float32),
+            ('review_count', np.uint32),
+            ('price', np.uint8),
+            ('latitude', np.float64),
+            ('longitude', np.float64),
+            ('category_start', np.uint32),
+            ('category_codes', np.int32),
+            ('key_start', np.uint64),
+            ('key_text', None),
+            ('record_start', np.uint64),
+            ('record_text', None)]
+
+## section offsets and lengths in bytes, stored after the header
+table = struct.Struct('<' + 'QQ' * len(sections))
+
+
+class RecordTable:
+    '''The raw restaurant records of a binary cache. Each record is
+    stored as compact JSON in one string table with an offset index,
+    and is only decoded when it's read, so opening a cache doesn't
+    touch the records at all.
+
+    Instance Attributes
+    -------------------
+    start: numpy array of uint64
+        where each record starts in text, plus the end of the last one
+    text: memoryview
+        the bytes of every record, one after another'''
+    def __init__(self, start, text):
+        self.start = start
+        self.text = text
+
+    def __len__(self):
+        return len(self.start) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('record index out of range')
+        metrics.count('records_parsed', 1, 'binary')
+        return json.loads(bytes(self.text[int(self.start[i]):int(self.start[i + 1])]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def string_table(texts):
+    '''
+    Packs a list of strings into one UTF-8 blob plus an offset index.
+
+    Parameters
+    ----------
+    texts: list
+        the strings to pack
+
+    Returns
+    -------
+    start: numpy array of uint64
+        where each string starts in the blob, plus the end of the last one
+    blob: bytes
+        the strings one after another
+    '''
+    encoded = [t.encode('utf-8') for t in texts]
+    start = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    np.cumsum([len(e) for e in encoded], out=start[1:])
+    return start, b''.join(encoded)
+
+
+def source_stamp(source):
+    '''
+    Returns the size and modification time of the JSON cache, which
+    the binary cache records so it knows when it's out of date.
+    '''
+    info = os.stat(source)
+    return info.st_size, info.st_mtime_ns
+
+
+def write_cache(path, records, source):
+    '''
+    Writes a binary cache of records, built from the JSON cache source.
+
+    Parameters
+    ----------
+    path: string
+        the binary cache file to write
+    records: list
+        the raw dictionaries of the restaurants
+    source: string
+        the JSON cache the records came from
+
+    Returns
+    -------
+    None
+    '''
+    columns = parse_columns(records)
+    keys = columns['category_keys']
+    key_start, key_text = string_table([text for key in keys for text in key])
+    record_start, record_text = string_table(
+        [json.dumps(r, separators=(',', ':')) for r in records])
+    data = dict(columns, key_start=key_start, key_text=key_text,
+                record_start=record_start, record_text=record_text)
+    size, mtime = source_stamp(source)
+    parts = []
+    spans = []
+    offset = header.size + table.size
+    for name, dtype in sections:
+        ## numeric sections start on 8 byte boundaries
+        pad = -offset % 8
+        parts.append(b'\x00' * pad)
+        offset += pad
+        value = data[name]
+        raw = value if isinstance(value, bytes) else np.ascontiguousarray(value, dtype=dtype).tobytes()
+        parts.append(raw)
+        spans += [offset, len(raw)]
+        offset += len(raw)
+    head = header.pack(magic, version, len(records), len(keys), size, mtime)
+    write_bytes_atomic(path, head + table.pack(*spans) + b''.join(parts))
+
+
+def open_cache(path, source=None, food_class=None):
+    '''
+    Memory-maps a binary cache and returns a RestaurantStore whose
+    columns are views of the file, so only the pages a query touches
+    are read from disk. Only the header and the category names are
+    read here; the store builds its indexes when they're first used,
+    so opening takes the same time however many restaurants there are.
+
+    Parameters
+    ----------
+    path: string
+        the binary cache file
+    source: string
+        the JSON cache it was built from, checked if given
+    food_class: class
+        the class used to make Food objects for displayed rows
+
+    Returns
+    -------
+    store: RestaurantStore
+        the restaurants in the cache, or None if the file is missing,
+        has another version or is older than source
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < header.size + table.size:
+            return None
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    file_magic, file_version, n, k, size, mtime = header.unpack_from(buf, 0)
+    if file_magic != magic or file_version != version:
+        return None
+    if source is not None and (not os.path.exists(source) or source_stamp(source) != (size, mtime)):
+        return None
+    spans = table.unpack_from(buf, header.size)
+    view = memoryview(buf)
+    data = {}
+    for i, (name, dtype) in enumerate(sections):
+        offset, length = spans[2 * i], spans[2 * i + 1]
+        if dtype is None:
+            data[name] = view[offset:offset + length]
+        else:
+            data[name] = np.frombuffer(buf, dtype=dtype, count=length // np.dtype(dtype).itemsize, offset=offset)
+    key_start = data['key_start']
+    texts = [bytes(data['key_text'][int(key_start[j]):int(key_start[j + 1])]).decode('utf-8')
+             for j in range(len(key_start) - 1)]
+    data['category_keys'] = list(zip(texts[0::2], texts[1::2]))
+    records = RecordTable(data['record_start'], data['record_text'])
+    return RestaurantStore(records, food_class, columns=data)
+
+
+def load_store(term, load_records, food_class=None):
+    '''
+    Gets a city's RestaurantStore from its binary cache, building
+    the binary cache from the JSON cache first if it's missing,
+    from an older version, or older than the JSON cache.
+
+    Parameters
+    ----------
+    term: string
+        the city term, like Detroit or Ann_Arbor
+    load_records: function
+        loads (or fetches) the JSON cache records for term
+    food_class: class
+        the class used to make Food objects for displayed rows
+
+    Returns
+    -------
+    store: RestaurantStore
+        every restaurant in the city
+    '''
+    source = f'{term}.json'
+    path = f'{term}.bin'
+    with metrics.timer('load_store', term):
+        store = open_cache(path, source, food_class)
+        if store is not None:
+            metrics.count('cache_hits', 1, 'binary')
+            return store
+        metrics.count('cache_misses', 1, 'binary')
+        records = load_records(term)
+        if not os.path.exists(source):
+            ## nothing to stamp the binary cache with, so just use the records
+            return RestaurantStore(records, food_class)
+        write_cache(path, records, source)
+        store = open_cache(path, source, food_class)
+        if store is None:
+            ## the JSON cache changed while the binary one was written,
+            # so the binary one is already stale; the records still are
+            # a whole copy of the city
+            return RestaurantStore(records, food_class)
+        return store
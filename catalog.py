@@ -0,0 +1,357 @@
+import argparse
+import glob
+import json
+import mmap
+import os
+import sys
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+import metrics
+from bincache import source_stamp
+from fetch import write_json_atomic
+from store import normalize, price_tiers
+from stream import iter_records
+
+## the manifest of every city cache in a folder
+catalog_file = 'catalog.json'
+catalog_version = 1
+## how much memory the loaded shards can take before the coldest is dropped
+default_budget = 256 * 2**20
+
+
+def is_city_cache(path):
+    '''
+    Checks whether a JSON file is a city cache, which always starts
+    with its businesses, rather than an Eater list, page metadata or
+    a session tree.
+    '''
+    if os.path.basename(path) == catalog_file:
+        return False
+    with open(path, 'r') as file:
+        start = file.read(64)
+    return start.lstrip().startswith('{"businesses"')
+
+
+def summarize(path):
+    '''
+    Reads a city cache in one streamed pass and summarizes it for the
+    catalog.
+
+    Parameters
+    ----------
+    path: string
+        the JSON cache, like Ann_Arbor.json
+
+    Returns
+    -------
+    entry: dict
+        the city term, its aliases, the record count, the bounding box
+        [south, west, north, east] (None without coordinates), the
+        [alias, title, count] of every category, the count of each
+        price and half-star rating, and the size and modification time
+        of the cache
+    '''
+    term = os.path.basename(path)[:-len('.json')]
+    count = 0
+    south = west = float('inf')
+    north = east = float('-inf')
+    categories = Counter()
+    prices = Counter()
+    ratings = Counter()
+    places = Counter()
+    for r in iter_records(path):
+        count += 1
+        coordinates = r.get('coordinates')
+        if isinstance(coordinates, dict):
+            lat, lon = coordinates.get('latitude'), coordinates.get('longitude')
+            if lat is not None and lon is not None:
+                south, north = min(south, lat), max(north, lat)
+                west, east = min(west, lon), max(east, lon)
+        for c in r.get('categories') or []:
+            categories[(c.get('alias') or '', c.get('title') or '')] += 1
+        if r.get('price') in price_tiers:
+            prices[r['price']] += 1
+        if r.get('rating') is not None:
+            ratings[str(float(r['rating']))] += 1
+        if isinstance(r.get('location'), dict) and r['location'].get('city'):
+            places[r['location']['city']] += 1
+    ## the term, the term with spaces, and the city most restaurants are in
+    aliases = {normalize(term), normalize(term.replace('_', ' '))}
+    if places:
+        aliases.add(normalize(places.most_common(1)[0][0]))
+    size, mtime = source_stamp(path)
+    return {'term': term, 'aliases': sorted(aliases), 'count': count,
+            'bbox': [south, west, north, east] if count and south <= north else None,
+            'categories': [[alias, title, n] for (alias, title), n in sorted(categories.items())],
+            'prices': dict(prices), 'ratings': dict(ratings),
+            'size': size, 'mtime': mtime}
+
+
+def shard_bytes(store):
+    '''
+    Estimates the memory a loaded store takes: its column arrays, its
+    category, spatial and full-text indexes if they've been built,
+    plus its records if they're decoded in memory rather than mapped
+    from the binary cache.
+    '''
+    built = vars(store)
+    arrays = [value for value in built.values() if isinstance(value, np.ndarray)]
+    if 'spatial' in built:
+        arrays += [value for value in vars(store.spatial).values() if isinstance(value, np.ndarray)]
+    if 'categories' in built:
+        arrays += store.categories.postings
+    total = 0
+    if 'text' in built:
+        arrays += [value for value in vars(store.text).values() if isinstance(value, np.ndarray)]
+        ## the term dictionary and its strings
+        total += sys.getsizeof(store.text.terms) + sum(sys.getsizeof(term) for term in store.text.terms)
+    for a in arrays:
+        root = a
+        while isinstance(root, np.ndarray) and root.base is not None:
+            root = root.base
+        ## columns mapped from the binary cache are paged in by the OS
+        if not isinstance(root, mmap.mmap):
+            total += a.nbytes
+    if isinstance(store.records, list):
+        ## about what a decoded Yelp record takes
+        total += len(store.records) * 4096
+    return total
+
+
+class Catalog:
+    '''Manifest of the city caches in a folder, kept in catalog.json.
+    Each city has its aliases, record count, bounding box and facet
+    counts of its categories, prices and ratings, so a query can tell
+    which cities might have results without loading them. Shards are
+    loaded when a query needs them and the least recently used are
+    dropped once they take more than budget bytes.
+
+    Instance Attributes
+    -------------------
+    folder: string
+        the folder with the city caches
+    entries: dict
+        the summary of each city term, see summarize
+    skipped: dict
+        the [size, mtime] of each JSON file that isn't a city cache,
+        so it's only opened again once it changes
+    aliases: dict
+        each normalized alias mapped to its city term
+    load: function
+        loads a city's store given its term
+    budget: int
+        the bytes the loaded shards may take
+    shards: OrderedDict
+        each loaded term mapped to its store, least recently used first
+    sizes: dict
+        the estimated bytes of each loaded shard'''
+    def __init__(self, folder='.', load=None, budget=default_budget):
+        if load is None:
+            from FinalProject_akdas import get_store
+            load = lambda term: get_store(term, folder=folder).store
+        self.folder = folder
+        self.load = load
+        self.budget = budget
+        self.entries = {}
+        self.skipped = {}
+        self.shards = OrderedDict()
+        self.sizes = {}
+        self.refresh()
+
+    @property
+    def path(self):
+        return os.path.join(self.folder, catalog_file)
+
+    def refresh(self):
+        '''
+        Updates the manifest: caches that are new or changed since it
+        was written are summarized again, and removed ones are dropped.
+        Unchanged caches, and unchanged JSON files that aren't city
+        caches, only cost a stat.
+
+        Returns
+        -------
+        changed: list
+            the terms that were summarized again or removed
+        '''
+        old = self.entries
+        old_skipped = self.skipped
+        if not old and os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                data = json.load(file)
+            if data.get('version') == catalog_version:
+                old = data['cities']
+                old_skipped = data.get('skipped', {})
+        entries = {}
+        skipped = {}
+        changed = []
+        for path in sorted(glob.glob(os.path.join(self.folder, '*.json'))):
+            name = os.path.basename(path)
+            if name == catalog_file:
+                continue
+            term = name[:-len('.json')]
+            entry = old.get(term)
+            stamp = list(source_stamp(path))
+            if entry is not None and [entry['size'], entry['mtime']] == stamp:
+                entries[term] = entry
+            elif old_skipped.get(name) == stamp or not is_city_cache(path):
+                skipped[name] = stamp
+            else:
+                with metrics.timer('catalog_summarize', term):
+                    entries[term] = summarize(path)
+                changed.append(term)
+                self.drop(term)
+        changed += [term for term in old if term not in entries]
+        self.entries = entries
+        new_skipped = skipped != old_skipped
+        self.skipped = skipped
+        self.aliases = {alias: term for term, entry in entries.items() for alias in entry['aliases']}
+        ## a city's own name wins over another cache's most common city
+        self.aliases.update((normalize(term), term) for term in entries)
+        if changed or new_skipped or not os.path.exists(self.path):
+            write_json_atomic(self.path, {'version': catalog_version, 'cities': entries,
+                                          'skipped': skipped})
+        return changed
+
+    def __len__(self):
+        return len(self.entries)
+
+    def resolve(self, name):
+        '''
+        Returns the city term for a name the user typed, like "ann
+        arbor" for Ann_Arbor, or None if no cache has that name.
+        '''
+        if name in self.entries:
+            return name
+        return self.aliases.get(normalize(name))
+
+    def candidates(self, food_type=None, rating=None, price=None, bbox=None):
+        '''
+        Finds the cities that might have restaurants passing every
+        filter given, from the manifest alone.
+
+        Parameters
+        ----------
+        food_type: string
+            a type some category's alias or title must contain
+        rating: float
+            the minimum rating
+        price: string
+            the price in dollar signs
+        bbox: list
+            [south, west, north, east] the restaurants must be in
+
+        Returns
+        -------
+        terms: list
+            the terms of the cities that can contribute, sorted
+        '''
+        key = normalize(food_type) if food_type is not None else None
+        terms = []
+        for term, entry in sorted(self.entries.items()):
+            if not entry['count']:
+                continue
+            if price is not None and not entry['prices'].get(price):
+                continue
+            if rating is not None and not any(float(r) >= rating for r in entry['ratings']):
+                continue
+            if key is not None and not (key and any(key in normalize(alias) or key in normalize(title)
+                                                   for alias, title, n in entry['categories'])):
+                continue
+            if bbox is not None:
+                box = entry['bbox']
+                if box is None or box[0] > bbox[2] or box[2] < bbox[0] or box[1] > bbox[3] or box[3] < bbox[1]:
+                    continue
+            terms.append(term)
+        return terms
+
+    def shard(self, term):
+        '''
+        Returns a city's store, loading it if it isn't loaded and
+        dropping the least recently used shards if that goes over
+        the budget. The shard just loaded is always kept.
+        '''
+        if term in self.shards:
+            self.shards.move_to_end(term)
+            metrics.count('shard_hits')
+            return self.shards[term]
+        metrics.count('shard_loads')
+        with metrics.timer('shard_load', term):
+            store = self.load(term)
+        self.shards[term] = store
+        self.sizes[term] = shard_bytes(store)
+        while sum(self.sizes.values()) > self.budget and len(self.shards) > 1:
+            self.drop(next(iter(self.shards)))
+            metrics.count('shard_evictions')
+        return store
+
+    def drop(self, term):
+        '''
+        Unloads a city's shard if it's loaded.
+        '''
+        self.shards.pop(term, None)
+        self.sizes.pop(term, None)
+
+    def select(self, food_type=None, rating=None, price=None, bbox=None):
+        '''
+        Runs the filters over every city that might have results,
+        loading only those shards.
+
+        Parameters
+        ----------
+        food_type, rating, price, bbox:
+            the filters, see candidates
+
+        Returns
+        -------
+        results: dict
+            each city term mapped to the Selection of its restaurants
+            that pass, for cities with at least one
+        '''
+        results = {}
+        for term in self.candidates(food_type, rating, price, bbox):
+            restaurants = self.shard(term).all()
+            if food_type is not None:
+                restaurants = restaurants.where_type(food_type)
+            if rating is not None:
+                restaurants = restaurants.where_rating(rating)
+            if price is not None:
+                restaurants = restaurants.where_price(price)
+            if bbox is not None:
+                restaurants = restaurants.within(*bbox)
+            if len(restaurants):
+                results[term] = restaurants
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Catalog of the city caches.')
+    parser.add_argument('mode', choices=['list', 'query'],
+                        help='list the cities, or run a query across them')
+    parser.add_argument('--folder', default='.')
+    parser.add_argument('--type')
+    parser.add_argument('--rating', type=float)
+    parser.add_argument('--price')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('SOUTH', 'WEST', 'NORTH', 'EAST'))
+    parser.add_argument('--budget-mb', type=float, default=default_budget / 2**20,
+                        help='memory the loaded cities can take')
+    parser.add_argument('--limit', type=int, default=10, help='rows shown per city')
+    args = parser.parse_args()
+    catalog = Catalog(args.folder, budget=int(args.budget_mb * 2**20))
+    if args.mode == 'list':
+        for term, entry in sorted(catalog.entries.items()):
+            print(f"{term}: {entry['count']} restaurants, {len(entry['categories'])} categories, "
+                  f"aliases {', '.join(entry['aliases'])}")
+        return
+    terms = catalog.candidates(args.type, args.rating, args.price, args.bbox)
+    print(f'{len(terms)} of {len(catalog)} cities can have results')
+    for term, restaurants in catalog.select(args.type, args.rating, args.price, args.bbox).items():
+        print(f'{term}: {len(restaurants)} results')
+        for r in restaurants[:args.limit]:
+            print(f'    {r.info()}')
+
+
+if __name__ == "__main__":
+    main()
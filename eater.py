@@ -0,0 +1,136 @@
+import re
+import unicodedata
+
+from store import normalize
+
+## how similar two names have to be for a fuzzy match
+min_similarity = 0.7
+
+## words so common in names that sharing them says little
+generic_words = {'and', 'bar', 'brewery', 'brewing', 'cafe', 'co', 'company',
+                 'grill', 'house', 'kitchen', 'restaurant', 'shop'}
+
+
+def name_key(name):
+    '''
+    Normalizes a restaurant name for matching: lowercase, no
+    accents or punctuation, "&" as "and", and no leading "the"
+    or possessive "'s".
+
+    Parameters
+    ----------
+    name: string
+        the restaurant name
+
+    Returns
+    -------
+    key: string
+        the normalized name
+    '''
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    name = name.lower().replace('&', ' and ')
+    name = re.sub(r"['’]s\b", '', name)
+    key = normalize(name)
+    if key.startswith('the '):
+        key = key[4:]
+    return key
+
+
+def trigrams(key):
+    '''
+    Returns the set of three letter pieces of a normalized name,
+    padded so the start and end of each word count too. Generic
+    words like "restaurant" are left out unless that's all there is.
+    '''
+    words = [w for w in key.split() if w not in generic_words]
+    padded = f"  {' '.join(words) or key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(grams, other):
+    '''
+    Scores how alike two names are from their trigram sets: the
+    average of their Dice coefficient and the share of the smaller
+    set found in the larger one.
+    '''
+    if not grams or not other:
+        return 0.0
+    count = len(grams & other)
+    return (2 * count / (len(grams) + len(other)) + count / min(len(grams), len(other))) / 2
+
+
+class EaterIndex:
+    '''Lookup structure over one city's scraped Eater list. Exact
+    lookups go through a hash map of normalized names. When that
+    misses, names sharing trigrams with the query are scored and the
+    best one is returned if it's similar enough. Generic words like
+    "restaurant" are ignored when scoring.
+
+    The similarity is the average of the Dice coefficient of the two
+    trigram sets and the share of the shorter name's trigrams found in
+    the longer one, so "Ima" still matches "Ima Izakaya".
+
+    Instance Attributes
+    -------------------
+    entries: list
+        the dictionaries of the top restaurants
+    exact: dict
+        each normalized name mapped to the entries with it
+    grams: list
+        the trigram set of each entry
+    postings: dict
+        each trigram mapped to the entries that have it'''
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self.exact = {}
+        self.grams = []
+        self.postings = {}
+        for i, entry in enumerate(self.entries):
+            key = name_key(entry.get('name', ''))
+            self.exact.setdefault(key, []).append(i)
+            grams = trigrams(key)
+            self.grams.append(grams)
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(i)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def lookup(self, name, threshold=min_similarity):
+        '''
+        Finds the top restaurant matching a name.
+
+        Parameters
+        ----------
+        name: string
+            the restaurant name
+        threshold: float
+            the lowest similarity accepted for a fuzzy match
+
+        Returns
+        -------
+        entry: dict
+            the matching top restaurant, or None
+        score: float
+            1.0 for an exact match, the similarity for a fuzzy one,
+            0.0 if nothing matched
+        '''
+        key = name_key(name)
+        if key in self.exact:
+            return self.entries[self.exact[key][0]], 1.0
+        grams = trigrams(key)
+        ## only names sharing a trigram can score above 0, ties go to the first entry
+        shared = set()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        best, best_score = None, 0.0
+        for i in sorted(shared):
+            score = similarity(grams, self.grams[i])
+            if score > best_score:
+                best, best_score = i, score
+        if best is None or best_score < threshold:
+            return None, 0.0
+        return self.entries[best], best_score
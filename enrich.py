@@ -0,0 +1,185 @@
+import json
+import os
+import re
+
+import numpy as np
+
+import metrics
+from bincache import source_stamp
+from eater import min_similarity, name_key, similarity, trigrams
+from fetch import write_json_atomic
+from store import normalize
+
+## bump whenever the keys or scoring below change, so old joins are rebuilt
+join_version = 1
+
+## how much a matching phone number or street address adds to the
+# name evidence: each closes that share of the gap to 1
+phone_weight = 0.8
+address_weight = 0.5
+## what a fuzzy name match keeps when both sites list different phones
+phone_conflict = 0.8
+
+## spellings of street words the two sites disagree on
+street_words = {'street': 'st', 'road': 'rd', 'avenue': 'ave', 'boulevard': 'blvd',
+                'drive': 'dr', 'highway': 'hwy', 'east': 'e', 'west': 'w',
+                'north': 'n', 'south': 's', 'suite': 'ste', 'place': 'pl',
+                'court': 'ct', 'lane': 'ln', 'parkway': 'pkwy'}
+
+
+def join_path(term):
+    '''
+    Returns the file the join of a city is saved in.
+    '''
+    return f'{term}_eater_join.json'
+
+
+def phone_key(phone):
+    '''
+    Returns the last ten digits of a phone number, so "+13135551234"
+    and "(313) 555-1234" match, or None if there aren't ten.
+    '''
+    digits = re.sub(r'\D', '', phone or '')
+    return digits[-10:] if len(digits) >= 10 else None
+
+
+def address_key(address):
+    '''
+    Returns the normalized street line of an address, like
+    "45 e 14 mile rd" for "45 E 14 Mile Road, Clawson, MI", or None.
+    '''
+    street = normalize((address or '').split(',')[0])
+    if not street:
+        return None
+    return ' '.join(street_words.get(word, word) for word in street.split())
+
+
+def yelp_keys(record):
+    '''
+    Returns the name, phone and address keys of a Yelp record.
+    '''
+    location = record.get('location') if isinstance(record.get('location'), dict) else {}
+    return (name_key(record.get('name') or ''), phone_key(record.get('phone')),
+            address_key(location.get('address1')))
+
+
+def join(records, entries):
+    '''
+    Matches Yelp records to Eater entries. A pair is a candidate if
+    the names are alike or the phone numbers or street addresses are
+    the same. Each candidate's confidence starts at the name
+    similarity, a matching phone or address raises it, and two
+    different phones lower a name that isn't an exact match. Pairs
+    are then taken best first, so every record and entry is used
+    at most once.
+
+    Parameters
+    ----------
+    records: sequence
+        the Yelp records, in store order
+    entries: list
+        the Eater entries
+
+    Returns
+    -------
+    matches: list
+        [row, entry, confidence] for each matched pair, by row
+    '''
+    keys = [(name_key(e.get('name') or ''), phone_key(e.get('phone')), address_key(e.get('address')))
+            for e in entries]
+    grams = [trigrams(name) for name, phone, address in keys]
+    by_name, by_phone, by_address, by_gram = {}, {}, {}, {}
+    for j, (name, phone, address) in enumerate(keys):
+        by_name.setdefault(name, []).append(j)
+        if phone:
+            by_phone.setdefault(phone, []).append(j)
+        if address:
+            by_address.setdefault(address, []).append(j)
+        for gram in grams[j]:
+            by_gram.setdefault(gram, []).append(j)
+    pairs = []
+    for i, record in enumerate(records):
+        name, phone, address = yelp_keys(record)
+        own = trigrams(name)
+        found = set(by_name.get(name, ()))
+        found.update(by_phone.get(phone, ()) if phone else ())
+        found.update(by_address.get(address, ()) if address else ())
+        shared = {}
+        for gram in own:
+            for j in by_gram.get(gram, ()):
+                shared[j] = shared.get(j, 0) + 1
+        found.update(j for j, n in shared.items() if 2 * n >= len(own))
+        for j in found:
+            score = 1.0 if name == keys[j][0] else similarity(own, grams[j])
+            if phone and phone == keys[j][1]:
+                score += (1 - score) * phone_weight
+            elif score < 1 and phone and keys[j][1]:
+                score *= phone_conflict
+            if address and address == keys[j][2]:
+                score += (1 - score) * address_weight
+            if score >= min_similarity:
+                pairs.append((score, i, j))
+    matches = []
+    rows, used = set(), set()
+    for score, i, j in sorted(pairs, key=lambda p: (-p[0], p[1], p[2])):
+        if i not in rows and j not in used:
+            rows.add(i)
+            used.add(j)
+            matches.append([i, j, round(score, 4)])
+    return sorted(matches)
+
+
+def load_join(term, records, eater_cache):
+    '''
+    Returns the saved join of a city, or makes and saves it if either
+    the Yelp cache or the Eater cache changed since it was made.
+
+    Parameters
+    ----------
+    term: string
+        the city term
+    records: sequence
+        the Yelp records of the city, in store order
+    eater_cache: string
+        the Eater cache of the city
+
+    Returns
+    -------
+    entries: list
+        the Eater entries
+    matches: list
+        [row, entry, confidence] for each matched pair
+    '''
+    source = f'{term}.json'
+    stamps = {'yelp': list(source_stamp(source)) if os.path.exists(source) else None,
+              'eater': list(source_stamp(eater_cache))}
+    with open(eater_cache, 'r') as file:
+        entries = json.load(file)
+    path = join_path(term)
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            saved = json.load(file)
+        if saved.get('version') == join_version and saved.get('stamps') == stamps:
+            metrics.count('cache_hits', 1, 'eater_join')
+            return entries, saved['matches']
+    metrics.count('cache_misses', 1, 'eater_join')
+    with metrics.timer('eater_join', term):
+        matches = join(records, entries)
+    if stamps['yelp'] is not None:
+        write_json_atomic(path, {'version': join_version, 'stamps': stamps, 'matches': matches})
+    return entries, matches
+
+
+def enrich_store(store, term, eater_cache):
+    '''
+    Attaches a city's Eater entries to its store, see
+    RestaurantStore.attach_eater.
+    '''
+    entries, matches = load_join(term, store.records, eater_cache)
+    match = np.full(len(store), -1, dtype=np.int32)
+    confidence = np.zeros(len(store), dtype=np.float32)
+    for i, j, score in matches:
+        if i < len(store) and j < len(entries):
+            match[i] = j
+            confidence[i] = score
+    store.attach_eater(entries, match, confidence)
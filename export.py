@@ -0,0 +1,271 @@
+import argparse
+import csv
+import importlib.util
+import json
+import os
+
+import numpy as np
+
+import metrics
+from fetch import atomic_path
+from stream import iter_records, predicate
+
+## how many rows are turned into columns and written at a time
+chunk_rows = 10000
+
+## every exported column and its type, the Food fields plus the raw
+# Yelp fields Food doesn't keep
+export_fields = [('id', 'string'), ('name', 'string'),
+                 ('latitude', 'float'), ('longitude', 'float'),
+                 ('address', 'list'), ('city', 'string'), ('state', 'string'),
+                 ('zip', 'string'), ('phone', 'string'), ('price', 'string'),
+                 ('rating', 'float'), ('review_count', 'int'), ('type', 'string'),
+                 ('categories', 'list'), ('transactions', 'list'), ('url', 'string'),
+                 ('eater_name', 'string'), ('eater_url', 'string'), ('eater_confidence', 'float')]
+
+## the format of each file extension
+formats = {'.csv': 'csv', '.jsonl': 'jsonl', '.json': 'jsonl',
+           '.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+
+
+def _part(record, key):
+    value = record.get(key)
+    return value if isinstance(value, dict) else {}
+
+
+def record_columns(records):
+    '''
+    Turns a chunk of Yelp records into export columns. Each column is
+    one list comprehension over the chunk, and missing fields are None.
+
+    Parameters
+    ----------
+    records: list
+        the raw dictionaries of the restaurants
+
+    Returns
+    -------
+    columns: dict
+        each field in export_fields mapped to its list of values; the
+        Eater fields are left as None for the caller to fill in
+    '''
+    n = len(records)
+    location = [_part(r, 'location') for r in records]
+    coordinates = [_part(r, 'coordinates') for r in records]
+    categories = [r.get('categories') or [] for r in records]
+    return {'id': [r.get('id') for r in records],
+            'name': [r.get('name') for r in records],
+            'latitude': [c.get('latitude') for c in coordinates],
+            'longitude': [c.get('longitude') for c in coordinates],
+            'address': [l.get('display_address') for l in location],
+            'city': [l.get('city') for l in location],
+            'state': [l.get('state') for l in location],
+            'zip': [l.get('zip_code') or None for l in location],
+            'phone': [r.get('phone') or None for r in records],
+            'price': [r.get('price') for r in records],
+            'rating': [None if r.get('rating') is None else float(r['rating']) for r in records],
+            'review_count': [r.get('review_count') for r in records],
+            'type': [c[0].get('title') if c else None for c in categories],
+            'categories': [[c.get('title') for c in cs] for cs in categories],
+            'transactions': [r.get('transactions') for r in records],
+            'url': [r.get('url') for r in records],
+            'eater_name': [None] * n, 'eater_url': [None] * n, 'eater_confidence': [None] * n}
+
+
+def selection_chunks(restaurants, size=chunk_rows):
+    '''
+    Yields the export columns of a Selection, size rows at a time, with
+    the Eater entry of each row that has one.
+    '''
+    store = restaurants.store
+    for start in range(0, len(restaurants), size):
+        ids = restaurants.ids[start:start + size]
+        columns = record_columns([store.records[i] for i in ids])
+        match = store.eater_match[ids]
+        for k in np.flatnonzero(match >= 0):
+            entry = store.eater_entries[match[k]]
+            columns['eater_name'][k] = entry.get('name')
+            columns['eater_url'][k] = entry.get('url')
+            columns['eater_confidence'][k] = round(float(store.eater_confidence[ids[k]]), 4)
+        yield columns
+
+
+def cache_chunks(path, where=None, size=chunk_rows):
+    '''
+    Yields the export columns of a city cache, size rows at a time,
+    reading the cache one record at a time so memory stays flat.
+    '''
+    records = []
+    for record in iter_records(path, where):
+        records.append(record)
+        if len(records) == size:
+            yield record_columns(records)
+            records = []
+    if records:
+        yield record_columns(records)
+
+
+class CsvWriter:
+    '''Writes chunks of columns as CSV rows, with list fields joined
+    by "; " and missing values left empty.'''
+    def __init__(self, file):
+        self.file = open(file, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([name for name, kind in export_fields])
+
+    def write(self, columns):
+        lists = [name for name, kind in export_fields if kind == 'list']
+        for name in lists:
+            columns[name] = ['; '.join(map(str, values)) if values else None
+                             for values in columns[name]]
+        self.writer.writerows(zip(*[columns[name] for name, kind in export_fields]))
+
+    def close(self):
+        self.file.close()
+
+
+class JsonLinesWriter:
+    '''Writes chunks of columns as one JSON object per row.'''
+    def __init__(self, file):
+        self.file = open(file, 'w', encoding='utf-8')
+        self.encoder = json.JSONEncoder(ensure_ascii=False)
+
+    def write(self, columns):
+        names = [name for name, kind in export_fields]
+        encode = self.encoder.encode
+        self.file.writelines(encode(dict(zip(names, row))) + '\n'
+                             for row in zip(*[columns[name] for name in names]))
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowWriter:
+    '''Writes chunks of columns as row groups of a Parquet file, or
+    record batches of an Arrow IPC file, with pyarrow.'''
+    def __init__(self, file, fmt):
+        import pyarrow as pa
+        types = {'string': pa.string(), 'float': pa.float64(), 'int': pa.int64(),
+                 'list': pa.list_(pa.string())}
+        self.pa = pa
+        self.schema = pa.schema([(name, types[kind]) for name, kind in export_fields])
+        if fmt == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(file, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(file, self.schema)
+
+    def write(self, columns):
+        self.writer.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def export_chunks(chunks, path, fmt=None):
+    '''
+    Writes chunks of export columns to a file, one chunk at a time,
+    so only one chunk is ever in memory. The file is written under a
+    temporary name and renamed when it's complete.
+
+    Parameters
+    ----------
+    chunks: iterable
+        the columns of each chunk, see record_columns
+    path: string
+        the file to write
+    fmt: string
+        'csv', 'jsonl', 'parquet' or 'arrow', or None to go by the
+        extension of path
+
+    Returns
+    -------
+    rows: int
+        how many rows were written
+
+    Raises
+    ------
+    ValueError
+        if the format isn't known
+    ImportError
+        for Parquet or Arrow without pyarrow installed
+    '''
+    if fmt is None:
+        fmt = formats.get(os.path.splitext(path)[1].lower())
+    if fmt not in set(formats.values()):
+        raise ValueError(f"can't tell the format of {path}, use one of {sorted(set(formats.values()))}")
+    if fmt in ('parquet', 'arrow') and importlib.util.find_spec('pyarrow') is None:
+        raise ImportError(f'exporting to {fmt} needs pyarrow, pip install pyarrow')
+    rows = 0
+    with atomic_path(path) as temp:
+        if fmt == 'csv':
+            writer = CsvWriter(temp)
+        elif fmt == 'jsonl':
+            writer = JsonLinesWriter(temp)
+        else:
+            writer = ArrowWriter(temp, fmt)
+        try:
+            with metrics.timer('export', fmt):
+                for columns in chunks:
+                    writer.write(columns)
+                    rows += len(columns['id'])
+        finally:
+            writer.close()
+    metrics.count('rows_exported', rows, fmt)
+    return rows
+
+
+def export_selection(restaurants, path, fmt=None, size=chunk_rows):
+    '''
+    Exports a filtered result, see export_chunks.
+    '''
+    return export_chunks(selection_chunks(restaurants, size), path, fmt)
+
+
+def export_cache(source, path, fmt=None, where=None, size=chunk_rows):
+    '''
+    Exports a whole city cache, or the records of it that pass where,
+    without loading it, see export_chunks.
+    '''
+    return export_chunks(cache_chunks(source, where, size), path, fmt)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports restaurants to CSV, JSON lines, Parquet or Arrow.')
+    parser.add_argument('city', help='the cities to export, separated by commas')
+    parser.add_argument('output', help='the file to write, its extension picks the format')
+    parser.add_argument('--format', choices=sorted(set(formats.values())))
+    parser.add_argument('--type')
+    parser.add_argument('--rating', type=float)
+    parser.add_argument('--price')
+    parser.add_argument('--stream', action='store_true',
+                        help='read the caches one record at a time instead of loading them; '
+                             'Eater fields are left empty')
+    args = parser.parse_args()
+    from FinalProject_akdas import city_terms, get_store, load_records
+    terms = city_terms(args.city)
+    try:
+        if args.stream:
+            def chunks():
+                for term in terms:
+                    if not os.path.exists(f'{term}.json'):
+                        load_records(term)
+                    yield from cache_chunks(f'{term}.json', predicate(args.type, args.rating, args.price))
+            rows = export_chunks(chunks(), args.output, args.format)
+        else:
+            from store import merge_stores
+            restaurants = merge_stores([get_store(term).store for term in terms]).all()
+            if args.type is not None:
+                restaurants = restaurants.where_type(args.type)
+            if args.rating is not None:
+                restaurants = restaurants.where_rating(args.rating)
+            if args.price is not None:
+                restaurants = restaurants.where_price(args.price)
+            rows = export_selection(restaurants, args.output, args.format)
+    except (ValueError, ImportError) as e:
+        parser.error(str(e))
+    print(f'Wrote {rows} restaurants to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
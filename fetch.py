@@ -0,0 +1,681 @@
+import contextlib
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+## the Yelp search endpoint only returns 1000 results, 50 at a time
+yelp_url = 'https://api.yelp.com/v3/businesses/search'
+page_limit = 50
+max_results = 1000
+
+## Yelp's quotas, shared by every fetch in the process
+per_second = 10
+daily_quota = 5000
+## retry settings for throttled (429) and failed (5xx) requests
+retries = 6
+backoff = 0.5
+max_backoff = 60
+
+
+class FetchError(Exception):
+    '''A page could not be fetched, even after retrying.'''
+
+
+class QuotaExhausted(FetchError):
+    '''The daily quota has run out, so the crawl has to stop.'''
+
+
+class TokenBucket:
+    '''Thread-safe token bucket. It holds up to capacity tokens and
+    refills at rate tokens per second; each request takes one.
+
+    Instance Attributes
+    -------------------
+    rate: float
+        tokens added per second
+    capacity: float
+        the most tokens the bucket holds
+    tokens: float
+        the tokens in the bucket now'''
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        '''
+        Takes a token and returns how many seconds the caller has to
+        wait before using it (0 if one was free).
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        '''
+        Gives back a token taken by reserve that won't be used.
+        '''
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class RateLimiter:
+    '''Keeps requests under both a per-second and a daily quota, each
+    a token bucket. A request waits for the per-second bucket, but
+    if the daily bucket would make it wait longer than max_wait the
+    request is refused with QuotaExhausted instead.
+
+    Instance Attributes
+    -------------------
+    second: TokenBucket
+        the per-second quota, allowing a burst of one second's requests
+    day: TokenBucket
+        the daily quota
+    max_wait: float
+        the longest a request waits for the daily quota'''
+    def __init__(self, per_second=per_second, per_day=daily_quota, max_wait=60):
+        self.second = TokenBucket(per_second, max(per_second, 1))
+        self.day = TokenBucket(per_day / 86400, per_day)
+        self.max_wait = max_wait
+
+    def acquire(self):
+        '''
+        Waits until a request is allowed.
+
+        Raises
+        ------
+        QuotaExhausted
+            if the daily quota won't allow a request within max_wait
+        '''
+        wait = self.day.reserve()
+        if wait > self.max_wait:
+            self.day.refund()
+            raise QuotaExhausted(f'daily quota used up, next request in {wait:.0f}s')
+        time.sleep(max(wait, self.second.reserve()))
+
+
+## one limiter for the whole process, so every city shares the quota
+yelp_limiter = RateLimiter()
+
+
+def backoff_delay(attempt, base=backoff, cap=max_backoff):
+    '''
+    Returns a jittered exponential backoff in seconds: a random time
+    between 0 and base * 2 ** attempt, capped at cap.
+    '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def make_session(pool_size=8):
+    '''
+    Makes a requests Session that keeps its connections alive
+    so every page reuses the same pool instead of opening a new
+    connection per request.
+
+    Parameters
+    ----------
+    pool_size: int
+        the most connections kept open to one host
+
+    Returns
+    -------
+    session: requests.Session
+        a session with a connection pool sized for pool_size pages
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_page(session, url, headers, term, offset, limit=page_limit, timeout=30,
+               limiter=None, retries=retries):
+    '''
+    Gets one page of search results. Throttled (429) and failed (5xx)
+    responses, dropped connections and responses without businesses
+    are retried after a jittered exponential backoff, or after the
+    server's Retry-After if it sends one.
+
+    Parameters
+    ----------
+    session: requests.Session
+        the session the request is sent through
+    url: string
+        the search endpoint
+    headers: dict
+        the request headers, including the authorization
+    term: string
+        the city term for the API
+    offset: int
+        the offset of the first result on the page
+    limit: int
+        the number of results on the page
+    timeout: float
+        seconds to wait for the server
+    limiter: RateLimiter
+        the quotas every attempt waits for, none if None
+    retries: int
+        how many times to retry a failed attempt
+
+    Returns
+    -------
+    businesses: list
+        a list of dictionaries of restaurants on the page
+
+    Raises
+    ------
+    FetchError
+        if the page still fails after every retry, or the request
+        is rejected (another 4xx)
+    '''
+    params = {'term': 'food', 'location': term, 'limit': limit, 'offset': offset}
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        metrics.count('api_requests')
+        wait = None
+        try:
+            response = session.get(url, headers=headers, params=params, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = f'{type(e).__name__}: {e}'
+        else:
+            if response.status_code == 429 or response.status_code >= 500:
+                error = f'HTTP {response.status_code}'
+                wait = response.headers.get('Retry-After')
+            elif response.status_code >= 400:
+                raise FetchError(f'{term} offset {offset}: HTTP {response.status_code}')
+            else:
+                try:
+                    return response.json()['businesses']
+                except (ValueError, KeyError):
+                    error = 'response has no businesses'
+        if attempt == retries:
+            break
+        metrics.count('api_retries', 1, error.split(':')[0])
+        try:
+            wait = min(float(wait), max_backoff)
+        except (TypeError, ValueError):
+            wait = backoff_delay(attempt)
+        time.sleep(wait)
+    raise FetchError(f'{term} offset {offset}: {error} after {retries + 1} attempts')
+
+
+def fetch_pages(term, headers, url=yelp_url, offsets=None, limit=page_limit,
+                max_workers=8, session=None, limiter=None, retries=retries):
+    '''
+    Gets every search page for a city with up to max_workers
+    requests in flight at once. The pages are put back together
+    in offset order, so the result is the same as fetching them
+    one after another.
+
+    Parameters
+    ----------
+    term: string
+        the city term for the API
+    headers: dict
+        the request headers, including the authorization
+    url: string
+        the search endpoint
+    offsets: iterable
+        the page offsets to fetch, every page up to 1000 by default
+    limit: int
+        the number of results per page
+    max_workers: int
+        the most pages fetched at the same time
+    session: requests.Session
+        a session to reuse, a new one is made if None
+    limiter: RateLimiter
+        the quotas every request waits for, none if None
+    retries: int
+        how many times to retry a failed request
+
+    Returns
+    -------
+    restaurants: list
+        a list of dictionaries of restaurants in offset order
+    '''
+    if offsets is None:
+        offsets = range(0, max_results, limit)
+    offsets = list(offsets)
+    own_session = session is None
+    if own_session:
+        session = make_session(max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            ## map keeps the pages in the order of the offsets
+            pages = list(pool.map(
+                lambda offset: fetch_page(session, url, headers, term, offset, limit,
+                                          limiter=limiter, retries=retries),
+                offsets))
+    finally:
+        if own_session:
+            session.close()
+    restaurants = []
+    for page in pages:
+        restaurants += page
+    return restaurants
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    '''
+    Gives the name of a temporary file in the same folder as path for
+    a writer that needs a file name, and renames it over path once
+    the block finishes, or removes it if the block raises, so readers
+    never see a half-written file.
+
+    Parameters
+    ----------
+    path: string
+        the file to write
+
+    Yields
+    ------
+    tmp: string
+        the temporary file to write instead
+    '''
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix='.' + os.path.basename(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        yield tmp
+        ## mkstemp makes the file private, caches are normal files
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def write_bytes_atomic(path, data):
+    '''
+    Writes bytes to a file through a temporary file in the same
+    folder and renames it over the old one, see atomic_path.
+
+    Parameters
+    ----------
+    path: string
+        the file to write
+    data: bytes
+        the bytes to write
+
+    Returns
+    -------
+    None
+    '''
+    with atomic_path(path) as tmp:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        metrics.count('bytes_written', len(data), os.path.basename(path))
+
+
+def write_json_atomic(path, data):
+    '''
+    Writes data to a JSON file in one atomic replace, like
+    write_bytes_atomic.
+
+    Parameters
+    ----------
+    path: string
+        the file to write
+    data: dict or list
+        the data to write
+
+    Returns
+    -------
+    None
+    '''
+    write_bytes_atomic(path, json.dumps(data).encode('utf-8'))
+
+
+def meta_path(term, folder='.'):
+    '''
+    Returns the name of the metadata file kept next to a city's cache.
+    '''
+    return os.path.join(folder, f'{term}_meta.json')
+
+
+def load_meta(term, limit=page_limit, folder='.'):
+    '''
+    Loads the fetch times of a city's cache. A cache written before
+    metadata was kept counts as fetched when its file was last changed.
+
+    Parameters
+    ----------
+    term: string
+        the city term for the API
+    limit: int
+        the number of results per page
+    folder: string
+        the folder the cache is in
+
+    Returns
+    -------
+    meta: dict
+        'fetched', the time of the last fetch, and 'pages', the time
+        each page offset (as a string) was last fetched
+    '''
+    path = meta_path(term, folder)
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            return json.load(file)
+    cache = os.path.join(folder, f'{term}.json')
+    if not os.path.exists(cache):
+        return {'fetched': None, 'pages': {}}
+    fetched = os.path.getmtime(cache)
+    with open(cache, 'r') as file:
+        count = len(json.load(file)['businesses'])
+    return {'fetched': fetched,
+            'pages': {str(offset): fetched for offset in range(0, count, limit)}}
+
+
+def save_meta(term, meta, folder='.'):
+    '''
+    Saves the fetch times of a city's cache.
+    '''
+    write_json_atomic(meta_path(term, folder), meta)
+
+
+def expired_pages(meta, ttl, now=None, limit=page_limit):
+    '''
+    Finds the page offsets that were fetched more than ttl seconds ago,
+    or never fetched.
+
+    Parameters
+    ----------
+    meta: dict
+        the fetch times from load_meta
+    ttl: float
+        how many seconds a page stays fresh
+    now: float
+        the current time, time.time() if None
+    limit: int
+        the number of results per page
+
+    Returns
+    -------
+    offsets: list
+        the offsets of the pages to fetch again
+    '''
+    if now is None:
+        now = time.time()
+    pages = meta.get('pages', {})
+    return [offset for offset in range(0, max_results, limit)
+            if now - pages.get(str(offset), float('-inf')) > ttl]
+
+
+def merge_records(records, fetched):
+    '''
+    Merges freshly fetched records into the cached ones by Yelp id.
+    Records that didn't change are left alone, changed ones are
+    replaced where they are and new ones are added at the end.
+
+    Parameters
+    ----------
+    records: list
+        the cached dictionaries of restaurants, updated in place
+    fetched: list
+        the freshly fetched dictionaries of restaurants
+
+    Returns
+    -------
+    changed: int
+        how many records were replaced or added
+    '''
+    where = {r.get('id'): i for i, r in enumerate(records)}
+    changed = 0
+    for r in fetched:
+        i = where.get(r.get('id'))
+        if i is None:
+            where[r.get('id')] = len(records)
+            records.append(r)
+            changed += 1
+        elif records[i] != r:
+            records[i] = r
+            changed += 1
+    return changed
+
+
+def refresh_cache(term, headers, ttl, url=yelp_url, max_workers=8, now=None,
+                  limiter=yelp_limiter, folder='.'):
+    '''
+    Fetches only the expired pages of a city's cache and merges them
+    in by Yelp id. The cache file is only rewritten if a record
+    changed, while the fetch times are always saved.
+
+    Parameters
+    ----------
+    term: string
+        the city term for the API
+    headers: dict
+        the request headers, including the authorization
+    ttl: float
+        how many seconds a page stays fresh
+    url: string
+        the search endpoint
+    max_workers: int
+        the most pages fetched at the same time
+    now: float
+        the current time, time.time() if None
+    limiter: RateLimiter
+        the quotas every request waits for
+    folder: string
+        the folder the cache and its metadata are in
+
+    Returns
+    -------
+    changed: int
+        how many records were replaced or added
+    '''
+    if now is None:
+        now = time.time()
+    cache = os.path.join(folder, f'{term}.json')
+    meta = load_meta(term, folder=folder)
+    offsets = expired_pages(meta, ttl, now)
+    if not offsets:
+        return 0
+    records = []
+    if os.path.exists(cache):
+        with open(cache, 'r') as file:
+            records = json.load(file)['businesses']
+    fetched = fetch_pages(term, headers, url=url, offsets=offsets, max_workers=max_workers,
+                          limiter=limiter)
+    changed = merge_records(records, fetched)
+    if changed:
+        write_json_atomic(cache, {'businesses': records})
+    for offset in offsets:
+        meta['pages'][str(offset)] = now
+    meta['fetched'] = now
+    save_meta(term, meta, folder)
+    return changed
+
+
+def start_refresh(term, headers, ttl, notify=print, **kwargs):
+    '''
+    Runs refresh_cache in a background thread, so the stale cache
+    keeps answering queries while the expired pages are fetched.
+    The binary cache picks up the new file the next time it's opened.
+
+    Parameters
+    ----------
+    term: string
+        the city term for the API
+    headers: dict
+        the request headers, including the authorization
+    ttl: float
+        how many seconds a page stays fresh
+    notify: function
+        called with a message if the refresh fails, from the refresh
+        thread; an interactive caller can queue it instead of printing
+        over a prompt
+    kwargs: dict
+        passed on to refresh_cache
+
+    Returns
+    -------
+    thread: threading.Thread
+        the started refresh thread
+    '''
+    def run():
+        try:
+            refresh_cache(term, headers, ttl, **kwargs)
+        except Exception as e:
+            notify(f'Could not refresh {term}: {e}')
+    thread = threading.Thread(target=run, name=f'refresh-{term}', daemon=True)
+    thread.start()
+    return thread
+
+
+class Checkpoint:
+    '''Progress of one city's crawl, so an interrupted crawl resumes
+    where it stopped. Each finished page is appended to
+    {term}_checkpoint.jsonl as one JSON line, which costs one small
+    write per page; a line cut off by a crash is ignored.
+
+    Instance Attributes
+    -------------------
+    path: string
+        the checkpoint file
+    pages: dict
+        the businesses of each finished page offset'''
+    def __init__(self, term):
+        self.path = f'{term}_checkpoint.jsonl'
+        self.pages = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                for line in file:
+                    try:
+                        page = json.loads(line)
+                        self.pages[page['offset']] = page['businesses']
+                    except (ValueError, KeyError, TypeError):
+                        continue
+
+    def save(self, offset, businesses):
+        '''
+        Records a finished page.
+        '''
+        with self.lock:
+            self.pages[offset] = businesses
+            with open(self.path, 'a') as file:
+                file.write(json.dumps({'offset': offset, 'businesses': businesses}) + '\n')
+
+    def clear(self):
+        '''
+        Deletes the checkpoint once the city's cache is written.
+        '''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def crawl(terms, headers, url=yelp_url, offsets=None, limit=page_limit,
+          max_workers=8, limiter=yelp_limiter, retries=retries, session=None):
+    '''
+    Fetches every page of many cities together on one pool of
+    workers, sharing the rate limiter, with pages from each city
+    taken in turn. Finished pages are checkpointed, and pages already
+    in a city's checkpoint are not fetched again. When all of a
+    city's pages are done its cache and metadata are written once
+    and its checkpoint is removed. If the daily quota runs out, no
+    more pages are started.
+
+    Parameters
+    ----------
+    terms: list
+        the city terms for the API
+    headers: dict
+        the request headers, including the authorization
+    url: string
+        the search endpoint
+    offsets: iterable
+        the page offsets to fetch, every page up to 1000 by default
+    limit: int
+        the number of results per page
+    max_workers: int
+        the most pages fetched at the same time
+    limiter: RateLimiter
+        the quotas every request waits for
+    retries: int
+        how many times to retry a failed request
+    session: requests.Session
+        a session to reuse, a new one is made if None
+
+    Returns
+    -------
+    restaurants: dict
+        each city term mapped to its list of restaurants in offset order
+
+    Raises
+    ------
+    FetchError
+        after every other city is finished, if any city has pages
+        that failed; their checkpoints are kept for the next crawl.
+        It's a QuotaExhausted if the daily quota ran out.
+    '''
+    if offsets is None:
+        offsets = range(0, max_results, limit)
+    offsets = list(offsets)
+    checkpoints = {term: Checkpoint(term) for term in terms}
+    jobs = [(term, offset) for offset in offsets for term in terms
+            if offset not in checkpoints[term].pages]
+    stop = threading.Event()
+    errors = {}
+    started = time.time()
+
+    def run(job):
+        term, offset = job
+        if stop.is_set():
+            errors.setdefault(term, 'stopped, daily quota used up')
+            return
+        try:
+            page = fetch_page(session, url, headers, term, offset, limit,
+                              limiter=limiter, retries=retries)
+        except QuotaExhausted as e:
+            stop.set()
+            errors.setdefault(term, str(e))
+        except FetchError as e:
+            errors.setdefault(term, str(e))
+        else:
+            checkpoints[term].save(offset, page)
+
+    own_session = session is None
+    if own_session:
+        session = make_session(max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            list(pool.map(run, jobs))
+    finally:
+        if own_session:
+            session.close()
+    restaurants = {}
+    for term in terms:
+        if term in errors:
+            continue
+        records = []
+        for offset in offsets:
+            records += checkpoints[term].pages[offset]
+        write_json_atomic(f'{term}.json', {'businesses': records})
+        save_meta(term, {'fetched': started,
+                         'pages': {str(offset): started for offset in offsets}})
+        checkpoints[term].clear()
+        restaurants[term] = records
+    if errors:
+        kind = QuotaExhausted if stop.is_set() else FetchError
+        raise kind('; '.join(f'{term}: {error}' for term, error in errors.items()))
+    return restaurants
@@ -0,0 +1,352 @@
+import argparse
+import html
+import json
+
+import numpy as np
+
+import metrics
+from fetch import write_bytes_atomic
+
+## the zoom levels clustered, from the whole metro area to a few blocks
+default_zooms = list(range(8, 18))
+## how wide a cluster's grid cell is on screen at its zoom
+cell_pixels = 60
+## a zoom level with more clusters than this isn't written, nor any finer one
+max_features = 4000
+## how many points are added to the grids at a time
+chunk_rows = 50000
+
+
+def mercator(lat, lon):
+    '''
+    Projects coordinates onto the Web Mercator square, both from 0 to 1,
+    the way map tiles are laid out.
+    '''
+    lat = np.clip(lat, -85.05112878, 85.05112878)
+    x = (lon + 180.0) / 360.0
+    y = (1.0 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2.0
+    return x, y
+
+
+class GridClusters:
+    '''Clusters of points on a grid at several zoom levels, built one
+    chunk of points at a time. At each zoom the map is cut into square
+    cells cell_pixels wide on screen, and each cell with points becomes
+    one cluster at the points' average position. Adding a chunk only
+    loops over the cells it touches, not its points. Once a zoom has
+    more than max_features cells it's dropped along with every finer
+    zoom, so the clusters kept, and the map written from them, stay
+    bounded however many points are added.
+
+    Instance Attributes
+    -------------------
+    zooms: list
+        the zoom levels still being clustered
+    cells: dict
+        for each zoom, each cell mapped to [count, latitude sum,
+        longitude sum, the row of its first point]
+    points: int
+        how many points with coordinates were added'''
+    def __init__(self, zooms=default_zooms, limit=max_features, pixels=cell_pixels):
+        self.zooms = sorted(zooms)
+        self.limit = limit
+        self.pixels = pixels
+        self.cells = {zoom: {} for zoom in self.zooms}
+        self.points = 0
+
+    def add(self, lat, lon, rows):
+        '''
+        Adds a chunk of points to every zoom's grid.
+
+        Parameters
+        ----------
+        lat, lon: numpy arrays
+            the coordinates of the points, NaN where missing
+        rows: numpy array
+            the row of each point, to label the clusters of one point
+        '''
+        keep = ~(np.isnan(lat) | np.isnan(lon))
+        lat, lon, rows = lat[keep], lon[keep], rows[keep]
+        if not len(lat):
+            return
+        self.points += len(lat)
+        x, y = mercator(lat, lon)
+        for zoom in list(self.zooms):
+            scale = 2.0 ** zoom * 256 / self.pixels
+            keys = (np.floor(x * scale).astype(np.int64) << 32) | np.floor(y * scale).astype(np.int64)
+            unique, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+            counts = np.bincount(inverse)
+            lat_sums = np.bincount(inverse, lat)
+            lon_sums = np.bincount(inverse, lon)
+            cells = self.cells[zoom]
+            if len(cells) + len(unique) > self.limit and len(set(cells).union(unique.tolist())) > self.limit:
+                ## this zoom and every finer one have too many clusters to draw
+                for dropped in self.zooms[self.zooms.index(zoom):]:
+                    del self.cells[dropped]
+                self.zooms = self.zooms[:self.zooms.index(zoom)]
+                metrics.count('map_zooms_dropped', 1)
+                break
+            for key, n, lat_sum, lon_sum, i in zip(unique.tolist(), counts.tolist(), lat_sums.tolist(),
+                                                   lon_sums.tolist(), first.tolist()):
+                cell = cells.get(key)
+                if cell is None:
+                    cells[key] = [n, lat_sum, lon_sum, int(rows[i])]
+                else:
+                    cell[0] += n
+                    cell[1] += lat_sum
+                    cell[2] += lon_sum
+
+    def levels(self):
+        '''
+        Returns the clusters of each zoom as [longitude, latitude,
+        count, row], the row being that of the cluster's first point.
+        '''
+        return {zoom: [[cell[2] / cell[0], cell[1] / cell[0], cell[0], cell[3]] for cell in self.cells[zoom].values()]
+                for zoom in self.zooms}
+
+
+def cluster_selection(restaurants, zooms=default_zooms, limit=max_features, size=chunk_rows):
+    '''
+    Clusters a Selection from the coordinates already parsed into its
+    store's latitude and longitude columns, size rows at a time.
+
+    Returns
+    -------
+    grid: GridClusters
+        the clusters of every zoom
+    '''
+    store = restaurants.store
+    grid = GridClusters(zooms, limit)
+    with metrics.timer('map_cluster'):
+        for start in range(0, len(restaurants), size):
+            ids = restaurants.ids[start:start + size]
+            grid.add(store.latitude[ids], store.longitude[ids], ids)
+    return grid
+
+
+def cluster_food(restaurants, zooms=default_zooms, limit=max_features, size=chunk_rows):
+    '''
+    Clusters Food objects, like a list of them, from their latitude
+    and longitude, size at a time. The rows of the points are their
+    positions in restaurants.
+    '''
+    grid = GridClusters(zooms, limit)
+    lat, lon = [], []
+    start = 0
+    for r in restaurants:
+        lat.append(r.latitude if isinstance(r.latitude, (int, float)) else np.nan)
+        lon.append(r.longitude if isinstance(r.longitude, (int, float)) else np.nan)
+        if len(lat) == size:
+            grid.add(np.array(lat), np.array(lon), np.arange(start, start + size))
+            start += size
+            lat, lon = [], []
+    if lat:
+        grid.add(np.array(lat), np.array(lon), np.arange(start, start + len(lat)))
+    return grid
+
+
+def label(food):
+    '''
+    Returns the popup text of a single restaurant.
+    '''
+    return food.info()
+
+
+def features(grid, describe):
+    '''
+    Returns the clusters as GeoJSON features, each with its zoom and
+    count. Clusters of one restaurant also get its label and url.
+
+    Parameters
+    ----------
+    grid: GridClusters
+        the clusters
+    describe: function
+        returns the Food object of a row
+    '''
+    items = []
+    for zoom, clusters in grid.levels().items():
+        for lon, lat, count, row in clusters:
+            properties = {'zoom': zoom, 'count': count}
+            if count == 1:
+                food = describe(row)
+                properties['name'] = label(food)
+                ## the tracking parameters of Yelp urls aren't needed to open them
+                properties['url'] = food.url.split('?')[0] if isinstance(food.url, str) else None
+            items.append({'type': 'Feature', 'properties': properties,
+                          'geometry': {'type': 'Point', 'coordinates': [round(lon, 6), round(lat, 6)]}})
+    return items
+
+
+## the offline viewer; it draws the clusters of the zoom closest to the
+# view's on a canvas, with drag to pan and the wheel to zoom
+viewer = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>%(title)s</title>
+<style>body{margin:0;font:13px sans-serif}canvas{display:block;cursor:grab}
+#tip{position:fixed;background:#fff;border:1px solid #999;padding:3px 6px;pointer-events:none;display:none}
+#info{position:fixed;top:8px;left:8px;background:#fffc;padding:4px 8px}</style></head>
+<body><canvas id="map"></canvas><div id="tip"></div><div id="info"></div>
+<script>
+const data = %(data)s;
+const zooms = Object.keys(data.levels).map(Number).sort((a, b) => a - b);
+const canvas = document.getElementById('map'), ctx = canvas.getContext('2d');
+const tip = document.getElementById('tip'), info = document.getElementById('info');
+function project(lon, lat) {
+  const s = Math.sin(lat * Math.PI / 180);
+  return [(lon + 180) / 360, 0.5 - Math.log((1 + s) / (1 - s)) / (4 * Math.PI)];
+}
+const points = {};
+for (const z of zooms) points[z] = data.levels[z].map(f => [project(f[0], f[1]), f]);
+let zoom = zooms.length ? zooms[0] : 10, center = project(data.center[0], data.center[1]), drawn = [];
+function level() {
+  let best = zooms[0];
+  for (const z of zooms) if (z <= zoom + 0.5) best = z;
+  return best;
+}
+function draw() {
+  canvas.width = innerWidth; canvas.height = innerHeight;
+  const scale = 256 * Math.pow(2, zoom), z = level();
+  ctx.fillStyle = '#f4f1ea'; ctx.fillRect(0, 0, canvas.width, canvas.height);
+  drawn = [];
+  for (const [p, f] of points[z] || []) {
+    const x = (p[0] - center[0]) * scale + canvas.width / 2, y = (p[1] - center[1]) * scale + canvas.height / 2;
+    if (x < -40 || y < -40 || x > canvas.width + 40 || y > canvas.height + 40) continue;
+    const r = f[2] > 1 ? 8 + 4 * Math.log10(f[2]) * 2 : 5;
+    ctx.beginPath(); ctx.arc(x, y, r, 0, 2 * Math.PI);
+    ctx.fillStyle = f[2] > 1 ? '#d9534fcc' : '#337ab7'; ctx.fill();
+    if (f[2] > 1) { ctx.fillStyle = '#fff'; ctx.textAlign = 'center'; ctx.fillText(f[2], x, y + 4); }
+    drawn.push([x, y, r, f]);
+  }
+  info.textContent = data.title + ': ' + data.count + ' restaurants, zoom ' + zoom.toFixed(1);
+}
+let drag = null;
+canvas.onmousedown = e => { drag = [e.clientX, e.clientY]; canvas.style.cursor = 'grabbing'; };
+onmouseup = () => { drag = null; canvas.style.cursor = 'grab'; };
+onmousemove = e => {
+  if (drag) {
+    const scale = 256 * Math.pow(2, zoom);
+    center = [center[0] - (e.clientX - drag[0]) / scale, center[1] - (e.clientY - drag[1]) / scale];
+    drag = [e.clientX, e.clientY]; draw(); return;
+  }
+  const hit = drawn.find(([x, y, r]) => (x - e.clientX) ** 2 + (y - e.clientY) ** 2 <= r * r);
+  tip.style.display = hit ? 'block' : 'none';
+  if (hit) {
+    tip.textContent = hit[3][2] > 1 ? hit[3][2] + ' restaurants' : data.places[hit[3][3]][0];
+    tip.style.left = e.clientX + 12 + 'px'; tip.style.top = e.clientY + 12 + 'px';
+  }
+};
+canvas.onwheel = e => { e.preventDefault(); zoom = Math.max(3, Math.min(19, zoom - Math.sign(e.deltaY) * 0.5)); draw(); };
+canvas.ondblclick = e => {
+  const hit = drawn.find(([x, y, r]) => (x - e.clientX) ** 2 + (y - e.clientY) ** 2 <= r * r);
+  if (hit && hit[3][2] == 1 && data.places[hit[3][3]][1]) window.open(data.places[hit[3][3]][1]);
+};
+onresize = draw;
+draw();
+</script></body></html>
+'''
+
+
+def write_map(grid, describe, path, title='Restaurants'):
+    '''
+    Writes the clusters to one self-contained file: a GeoJSON feature
+    collection if path ends in .geojson or .json, otherwise an HTML
+    page that needs no network to view. Its size depends on the number
+    of clusters, which GridClusters keeps bounded, not on how many
+    restaurants there are.
+
+    Parameters
+    ----------
+    grid: GridClusters
+        the clusters
+    describe: function
+        returns the Food object of a row
+    path: string
+        the file to write
+    title: string
+        the title of the page
+
+    Returns
+    -------
+    clusters: int
+        how many clusters were written, over every zoom
+
+    Raises
+    ------
+    ValueError
+        if there are points but even the coarsest zoom had too many
+        clusters, which would make a map with nothing on it
+    '''
+    if grid.points and not grid.zooms:
+        raise ValueError(f'every zoom has more than {grid.limit} clusters, '
+                         f'allow more clusters or map fewer restaurants')
+    items = features(grid, describe)
+    if path.endswith(('.geojson', '.json')):
+        text = json.dumps({'type': 'FeatureCollection', 'features': items})
+    else:
+        ## a restaurant alone in its cell at several zooms is listed once
+        places = {}
+        levels = {}
+        for f in items:
+            p = f['properties']
+            place = places.setdefault((p['name'], p['url']), len(places)) if p['count'] == 1 else None
+            levels.setdefault(p['zoom'], []).append(f['geometry']['coordinates'] + [p['count'], place])
+        lon = [f['geometry']['coordinates'][0] for f in items]
+        lat = [f['geometry']['coordinates'][1] for f in items]
+        center = [(min(lon) + max(lon)) / 2, (min(lat) + max(lat)) / 2] if items else [-83.05, 42.33]
+        data = json.dumps({'title': title, 'count': grid.points, 'center': center,
+                           'places': [list(place) for place in places], 'levels': levels},
+                          separators=(',', ':'))
+        ## keeps a name like "</script>" from ending the script early
+        text = viewer % {'title': html.escape(title), 'data': data.replace('</', '<\\/')}
+    write_bytes_atomic(path, text.encode('utf-8'))
+    return len(items)
+
+
+def map_selection(restaurants, path, title='Restaurants', zooms=default_zooms, limit=max_features):
+    '''
+    Clusters a Selection and writes its map, see write_map.
+    '''
+    grid = cluster_selection(restaurants, zooms, limit)
+    return write_map(grid, restaurants.store.food, path, title)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes an offline map of restaurants.')
+    parser.add_argument('city', help='the cities to map, separated by commas')
+    parser.add_argument('output', help='an .html page, or a .geojson file')
+    parser.add_argument('--type')
+    parser.add_argument('--rating', type=float)
+    parser.add_argument('--price')
+    parser.add_argument('--max-clusters', type=int, default=max_features,
+                        help='the most clusters a zoom level can have')
+    args = parser.parse_args()
+    if args.max_clusters < 1:
+        parser.error('--max-clusters must be at least 1')
+    from FinalProject_akdas import city_terms, get_store
+    from store import merge_stores
+    terms = city_terms(args.city)
+    if not terms:
+        parser.error('no city given')
+    restaurants = merge_stores([get_store(term).store for term in terms]).all()
+    if args.type is not None:
+        restaurants = restaurants.where_type(args.type)
+    if args.rating is not None:
+        restaurants = restaurants.where_rating(args.rating)
+    if args.price is not None:
+        restaurants = restaurants.where_price(args.price)
+    grid = cluster_selection(restaurants, limit=args.max_clusters)
+    try:
+        clusters = write_map(grid, restaurants.store.food, args.output, args.city)
+    except ValueError as e:
+        parser.error(str(e))
+    if not grid.points:
+        print(f'No restaurants with coordinates matched, wrote an empty map to {args.output}')
+        return
+    if grid.zooms[-1] < default_zooms[-1]:
+        print(f'Zooms past {grid.zooms[-1]} have more than {args.max_clusters} clusters and are left out')
+    print(f'Wrote {grid.points} restaurants as {clusters} clusters over zooms '
+          f'{grid.zooms[0]}-{grid.zooms[-1]} to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
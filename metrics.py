@@ -0,0 +1,268 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+## every hook checks this first, so metrics cost one test when disabled
+enabled = False
+
+## prefix of every exported metric name
+namespace = 'restaurant'
+
+counters = {}
+timers = {}
+_lock = threading.Lock()
+
+
+class _NoTimer:
+    '''The timer handed out while metrics are disabled. It does nothing,
+    and one instance is shared so no object is made per call.'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_timer = _NoTimer()
+
+
+class _Timer:
+    '''Times one run of a stage and adds it to timers when it ends.'''
+    __slots__ = ('name', 'label', 'start')
+
+    def __init__(self, name, label):
+        self.name = name
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        key = (self.name, self.label)
+        with _lock:
+            stats = timers.get(key)
+            if stats is None:
+                timers[key] = [1, elapsed, elapsed]
+            else:
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+        return False
+
+
+def count(name, n=1, label=None):
+    '''
+    Adds n to a counter, like records parsed or bytes written.
+
+    Parameters
+    ----------
+    name: string
+        the counter, like cache_hits
+    n: int
+        how much to add
+    label: string
+        what the count is about, like the cache or filter, or None
+    '''
+    if not enabled:
+        return
+    key = (name, label)
+    with _lock:
+        counters[key] = counters.get(key, 0) + n
+
+
+def timer(name, label=None):
+    '''
+    Returns a context manager that times the code inside it.
+
+    Parameters
+    ----------
+    name: string
+        the stage, like load_store or filter
+    label: string
+        which part of the stage, like the filter type, or None
+
+    Returns
+    -------
+    timer: context manager
+        records the time when the block ends
+    '''
+    if not enabled:
+        return _no_timer
+    return _Timer(name, label)
+
+
+def reset():
+    '''
+    Forgets every counter and timer.
+    '''
+    with _lock:
+        counters.clear()
+        timers.clear()
+
+
+def _labels(label):
+    if label is None:
+        return ''
+    return '{kind="%s"}' % str(label).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def prometheus():
+    '''
+    Returns every metric in the Prometheus text format. Counters end
+    in _total, and timers are summaries with a _seconds_count,
+    _seconds_sum and a separate _seconds_max gauge.
+    '''
+    with _lock:
+        counter_items = sorted(counters.items(), key=lambda item: (item[0][0], str(item[0][1])))
+        timer_items = sorted(((key, list(stats)) for key, stats in timers.items()),
+                             key=lambda item: (item[0][0], str(item[0][1])))
+    lines = []
+    last = None
+    for (name, label), value in counter_items:
+        metric = f'{namespace}_{name}_total'
+        if metric != last:
+            lines.append(f'# TYPE {metric} counter')
+            last = metric
+        lines.append(f'{metric}{_labels(label)} {value}')
+    for suffix in ('', '_max'):
+        last = None
+        for (name, label), (n, total, longest) in timer_items:
+            metric = f'{namespace}_{name}_seconds{suffix}'
+            if metric != last:
+                lines.append(f"# TYPE {metric} {'gauge' if suffix else 'summary'}")
+                last = metric
+            if suffix:
+                lines.append(f'{metric}{_labels(label)} {longest:.9f}')
+            else:
+                lines.append(f'{metric}_count{_labels(label)} {n}')
+                lines.append(f'{metric}_sum{_labels(label)} {total:.9f}')
+    return '\n'.join(lines) + '\n'
+
+
+def json_lines(now=None):
+    '''
+    Returns every metric as JSON lines, one object per counter or
+    timer, stamped with the time so runs can be appended to one file.
+    '''
+    now = time.time() if now is None else now
+    with _lock:
+        rows = [{'time': now, 'type': 'counter', 'name': name, 'label': label, 'value': value}
+                for (name, label), value in counters.items()]
+        rows += [{'time': now, 'type': 'timer', 'name': name, 'label': label,
+                  'count': n, 'seconds': total, 'max_seconds': longest}
+                 for (name, label), (n, total, longest) in timers.items()]
+    return ''.join(json.dumps(row) + '\n' for row in rows)
+
+
+def export(path):
+    '''
+    Writes the metrics to a file, as Prometheus text if it ends in
+    .prom or .txt and appended JSON lines otherwise.
+    '''
+    if path.endswith(('.prom', '.txt')):
+        with open(path, 'w') as f:
+            f.write(prometheus())
+    else:
+        with open(path, 'a') as f:
+            f.write(json_lines())
+
+
+def enable(path=None):
+    '''
+    Turns the metrics on. If path is given, they are exported to it
+    when the program exits.
+    '''
+    global enabled
+    enabled = True
+    if path:
+        atexit.register(export, path)
+
+
+class SamplingProfiler:
+    '''Finds where a thread spends its time by looking at its stack
+    every interval seconds from a background thread. Nothing is added
+    to the code being profiled, so it can run in a normal session.
+    Stacks are written in the collapsed format flame graph tools read:
+    one line per stack, functions from outermost to innermost joined
+    by semicolons, then the number of samples.
+
+    Instance Attributes
+    -------------------
+    interval: float
+        the seconds between samples
+    thread_id: int
+        the thread being sampled
+    samples: dict
+        each stack mapped to how many times it was seen'''
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = threading.main_thread().ident if thread_id is None else thread_id
+        self.samples = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def start(self):
+        '''
+        Starts sampling in a daemon thread.
+        '''
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stops sampling and waits for the sampling thread to finish.
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def collapsed(self):
+        '''
+        Returns the samples in the collapsed stack format, most
+        sampled stacks first.
+        '''
+        rows = sorted(self.samples.items(), key=lambda item: -item[1])
+        return ''.join(f'{stack} {n}\n' for stack, n in rows)
+
+    def save(self, path):
+        '''
+        Stops sampling and writes the collapsed stacks to a file.
+        '''
+        self.stop()
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+
+
+def start_profiler(path, interval=0.005):
+    '''
+    Starts sampling the main thread and saves the stacks to path
+    when the program exits.
+
+    Returns
+    -------
+    profiler: SamplingProfiler
+        the running profiler
+    '''
+    profiler = SamplingProfiler(interval).start()
+    atexit.register(profiler.save, path)
+    return profiler
@@ -0,0 +1,469 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+from collections import OrderedDict
+
+import metrics
+from FinalProject_akdas import Food, city_term, get_catalog, get_store, load_records
+from bincache import source_stamp
+from fetch import FetchError
+from store import normalize, price_tiers
+from stream import iter_records, predicate
+from textindex import tokenize
+
+## the same limits the interactive prompts accept
+min_rating = 1
+max_rating = 5
+preview = 50
+## how much the filter result cache can hold before it drops the
+# least recently used results
+max_results = 10000
+max_result_bytes = 64 * 2**20
+
+
+def flag(value):
+    '''
+    Reads a yes/no option that may come from JSON or a query string.
+    '''
+    return bool(value) and value not in ('0', 'false', 'no')
+
+
+def parse_spec(spec):
+    '''
+    Checks a query spec and returns its filter chain.
+
+    Parameters
+    ----------
+    spec: dict
+        the query, with a 'city' and optional 'type', 'rating'
+        (1-5), 'price' (1-4 dollar signs), 'eater' (only Eater
+        picks), 'q' (free text, matches ranked best first) and
+        'limit' (0 or more rows returned); the city is looked up in
+        the catalog as it is, without rescanning the caches
+
+    Returns
+    -------
+    chain: tuple
+        (city term, normalized type, rating, price, eater, text),
+        with None for each filter that isn't used
+
+    Raises
+    ------
+    ValueError
+        if the city is missing or a filter is invalid
+    '''
+    if not isinstance(spec, dict) or not spec.get('city'):
+        raise ValueError('a query needs a city')
+    food_type = spec.get('type')
+    if food_type is not None:
+        food_type = normalize(str(food_type))
+    rating = spec.get('rating')
+    if rating is not None:
+        rating = float(rating)
+        if not min_rating <= rating <= max_rating:
+            raise ValueError(f'rating must be between {min_rating} and {max_rating}')
+    price = spec.get('price')
+    if price is not None and price not in price_tiers:
+        raise ValueError('price must be 1-4 dollar signs')
+    eater = True if flag(spec.get('eater')) else None
+    text = spec.get('q')
+    if text is not None:
+        text = ' '.join(str(text).lower().split())
+        if not tokenize(text):
+            raise ValueError('q has no words to search for')
+    limit = spec.get('limit')
+    if limit is not None and int(limit) < 0:
+        raise ValueError('limit must be 0 or more')
+    return (city_term(spec['city'], refresh=False), food_type, rating, price, eater, text)
+
+
+def run_query(restaurants, food_type=None, rating=None, price=None):
+    '''
+    Runs the type, rating and price filters, in that order, the
+    same way the interactive session does. Filters left as None
+    are skipped.
+
+    Parameters
+    ----------
+    restaurants: Selection
+        the restaurants to filter
+    food_type: string
+        the type to look for
+    rating: float
+        the minimum rating
+    price: string
+        the price in dollar signs
+
+    Returns
+    -------
+    restaurants: Selection
+        the restaurants that pass every filter
+    '''
+    if food_type is not None:
+        restaurants = restaurants.where_type(food_type)
+    if rating is not None:
+        restaurants = restaurants.where_rating(rating)
+    if price is not None:
+        restaurants = restaurants.where_price(price)
+    return restaurants
+
+
+def first_rows(restaurants, spec, rows):
+    '''
+    Returns the rows of a result that get shown: the first ones, which
+    are the best text matches for a spec with 'q', or with 'rank' in
+    the spec the best ones by review-weighted rating,
+    weighted by distance too if the spec has a 'lat' and 'lon'.
+
+    Raises
+    ------
+    ValueError
+        if lat or lon isn't a number
+    '''
+    if not flag(spec.get('rank')):
+        return restaurants[:rows]
+    lat, lon = spec.get('lat'), spec.get('lon')
+    if lat is not None and lon is not None:
+        lat, lon = float(lat), float(lon)
+    return restaurants.top(rows, lat, lon)
+
+
+class ResultCache:
+    '''Least recently used cache of filter results, keyed on the
+    normalized filter prefix, like ('Detroit', 'sushi') or
+    ('Detroit', 'sushi', 4.0), so a result is reused whatever
+    filters follow it. When it holds more than max_entries
+    results, or their row ids take more than max_bytes, the results
+    used longest ago are dropped.
+
+    Instance Attributes
+    -------------------
+    results: OrderedDict
+        each prefix mapped to its Selection, least recently used first
+    nbytes: int
+        the bytes of row ids held
+    hits, misses, evictions, invalidations: int
+        how often a result was found, computed, dropped for space or
+        dropped because its city changed'''
+    def __init__(self, max_entries=max_results, max_bytes=max_result_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.results = OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def __len__(self):
+        return len(self.results)
+
+    def get(self, key):
+        '''
+        Returns the result for a prefix, or None if it isn't cached.
+        '''
+        return self.longest([key])[1]
+
+    def longest(self, keys):
+        '''
+        Finds the last of several prefixes that is cached, counting
+        one hit if any of them is and one miss if none is.
+
+        Parameters
+        ----------
+        keys: list
+            the prefixes, shortest first
+
+        Returns
+        -------
+        found: int
+            how many of the keys the result covers, 0 if none is cached
+        result: Selection
+            the result of the longest cached prefix, or None
+        '''
+        for i in range(len(keys), 0, -1):
+            result = self.results.get(keys[i - 1])
+            if result is not None:
+                self.results.move_to_end(keys[i - 1])
+                self.hits += 1
+                metrics.count('filter_cache_hits')
+                return i, result
+        self.misses += 1
+        metrics.count('filter_cache_misses')
+        return 0, None
+
+    def put(self, key, result):
+        '''
+        Caches the result for a prefix, dropping old results if
+        there's no room.
+        '''
+        if key in self.results:
+            self.nbytes -= self.results.pop(key).ids.nbytes
+        self.results[key] = result
+        self.nbytes += result.ids.nbytes
+        while len(self.results) > self.max_entries or (self.nbytes > self.max_bytes and len(self.results) > 1):
+            old, dropped = self.results.popitem(last=False)
+            self.nbytes -= dropped.ids.nbytes
+            self.evictions += 1
+
+    def invalidate(self, term):
+        '''
+        Drops every result for a city.
+        '''
+        for key in [key for key in self.results if key[0] == term]:
+            self.nbytes -= self.results.pop(key).ids.nbytes
+            self.invalidations += 1
+
+    def stats(self):
+        '''
+        Returns the hit, miss, eviction and invalidation counts, the
+        hit rate and how much is cached.
+        '''
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions, 'invalidations': self.invalidations,
+                'entries': len(self.results), 'bytes': self.nbytes}
+
+
+class BatchEngine:
+    '''Runs many queries against warm city stores. Each prefix of a
+    filter chain (city, then type, rating, price, Eater picks and
+    text search) is
+    computed once and kept in a ResultCache, so every later query
+    that starts with it, in this batch or a later one, reuses it.
+    A city is loaded again, and its cached results dropped, when
+    its cache file changes.
+
+    Instance Attributes
+    -------------------
+    load: function
+        loads the Selection of every restaurant in a city
+    stores: dict
+        the loaded Selection of each city term
+    stamps: dict
+        the size and modification time of each city's cache file
+        when it was loaded, None if it has none
+    results: ResultCache
+        the filter results kept between queries
+    stages: int
+        how many filter stages have been computed, for checking reuse'''
+    def __init__(self, load=get_store, results=None):
+        self.load = load
+        self.stores = {}
+        self.stamps = {}
+        self.results = ResultCache() if results is None else results
+        self.stages = 0
+
+    def city(self, term):
+        '''
+        Returns every restaurant in a city, loading it the first time
+        and again whenever its cache file has changed.
+        '''
+        source = f'{term}.json'
+        stamp = source_stamp(source) if os.path.exists(source) else None
+        if term not in self.stores or self.stamps[term] != stamp:
+            if term in self.stores:
+                self.results.invalidate(term)
+            self.stores[term] = self.load(term)
+            ## the load may have written the cache, so stamp it afterwards
+            self.stamps[term] = source_stamp(source) if os.path.exists(source) else None
+        return self.stores[term]
+
+    def evaluate(self, chain):
+        '''
+        Returns the Selection for a filter chain, reusing the longest
+        prefix already cached and caching the ones it computes.
+        A filter that isn't used isn't a new prefix, so
+        (Detroit, None, 4.0) is computed from (Detroit,).
+
+        Parameters
+        ----------
+        chain: tuple
+            (city term, type, rating, price, eater, text) from parse_spec
+
+        Returns
+        -------
+        restaurants: Selection
+            the restaurants that pass the chain
+        '''
+        restaurants = self.city(chain[0])
+        stages = [stage for stage in range(1, len(chain)) if chain[stage] is not None]
+        done = 0
+        ## a chain of just a city has no prefix to cache
+        if stages:
+            done, cached = self.results.longest([chain[:stage + 1] for stage in stages])
+            if cached is not None:
+                restaurants = cached
+        for stage in stages[done:]:
+            self.stages += 1
+            value = chain[stage]
+            if stage == 1:
+                restaurants = restaurants.where_type(value)
+            elif stage == 2:
+                restaurants = restaurants.where_rating(value)
+            elif stage == 3:
+                restaurants = restaurants.where_price(value)
+            elif stage == 4:
+                restaurants = restaurants.where_eater()
+            else:
+                restaurants = restaurants.search(value)
+            self.results.put(chain[:stage + 1], restaurants)
+        return restaurants
+
+    def run_batch(self, specs, limit=preview):
+        '''
+        Runs a batch of queries and returns one result per query,
+        in the same order.
+
+        Parameters
+        ----------
+        specs: list
+            the query specs, see parse_spec; each can also have an
+            'id' that is copied to its result, a 'limit' on the
+            number of rows returned and 'rank', 'lat' and 'lon', see
+            first_rows
+        limit: int
+            the default number of rows returned per query
+
+        Returns
+        -------
+        results: list
+            a dictionary per query with its id, the count of matching
+            restaurants and the first rows, or an error
+        '''
+        results = []
+        ## caches fetched since the catalog was read are found once per
+        # batch rather than once per query of an unknown city
+        get_catalog().refresh()
+        for spec in specs:
+            result = {'id': spec.get('id') if isinstance(spec, dict) else None}
+            try:
+                chain = parse_spec(spec)
+                rows = int(spec.get('limit', limit))
+                restaurants = self.evaluate(chain)
+                shown = first_rows(restaurants, spec, rows)
+            except (ValueError, TypeError, OSError, KeyError, FetchError) as e:
+                result['error'] = str(e)
+            else:
+                result['count'] = len(restaurants)
+                result['results'] = [r.as_dict() for r in shown]
+            results.append(result)
+        return results
+
+    def run_lines(self, lines, batch_size=1000, limit=preview):
+        '''
+        Reads JSON line query specs and yields JSON line results,
+        batch_size queries at a time so memory stays bounded.
+
+        Parameters
+        ----------
+        lines: iterable
+            the lines of JSON query specs, blank lines are skipped
+        batch_size: int
+            how many queries are read and run at a time
+        limit: int
+            the default number of rows returned per query
+
+        Returns
+        -------
+        lines: generator
+            one JSON line per query
+        '''
+        specs = (line for line in lines if line.strip())
+        while True:
+            batch = list(itertools.islice(specs, batch_size))
+            if not batch:
+                return
+            parsed = []
+            errors = {}
+            for i, line in enumerate(batch):
+                try:
+                    parsed.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    parsed.append(None)
+                    errors[i] = f'invalid JSON: {e}'
+            for i, result in enumerate(self.run_batch(parsed, limit)):
+                if i in errors:
+                    result['error'] = errors[i]
+                yield json.dumps(result)
+
+
+class StreamEngine(BatchEngine):
+    '''Runs a batch of queries in one pass over each city's JSON cache
+    instead of loading it into a store. Every record is checked
+    against every query of the batch, and only the rows each query
+    returns are kept, so memory stays flat however big the caches
+    are. Ranking and text search need every match at once, so they
+    aren't supported.'''
+    def run_batch(self, specs, limit=preview):
+        '''
+        Runs a batch of queries and returns one result per query, in
+        the same order, like BatchEngine.run_batch.
+        '''
+        results = []
+        cities = {}
+        get_catalog().refresh()
+        for spec in specs:
+            result = {'id': spec.get('id') if isinstance(spec, dict) else None}
+            try:
+                city, food_type, rating, price, eater, text = parse_spec(spec)
+                rows = int(spec.get('limit', limit))
+                if flag(spec.get('rank')) or eater or text is not None:
+                    raise ValueError('rank, eater and q are not supported when streaming')
+            except (ValueError, TypeError) as e:
+                result['error'] = str(e)
+            else:
+                result['count'] = 0
+                result['results'] = []
+                cities.setdefault(city, []).append((predicate(food_type, rating, price), rows, result))
+            results.append(result)
+        for city, queries in cities.items():
+            try:
+                if not os.path.exists(f'{city}.json'):
+                    load_records(city)
+                for record in iter_records(f'{city}.json'):
+                    for where, rows, result in queries:
+                        if where(record):
+                            result['count'] += 1
+                            if len(result['results']) < rows:
+                                result['results'].append(Food(json=record).as_dict())
+            except (ValueError, OSError, KeyError, FetchError) as e:
+                for where, rows, result in queries:
+                    result.pop('count')
+                    result.pop('results')
+                    result['error'] = str(e)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Runs restaurant queries from JSON lines without prompts.')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='file of JSON query specs, - for stdin')
+    parser.add_argument('--output', default='-', help='file for the results, - for stdout')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='how many queries are read and run at a time')
+    parser.add_argument('--limit', type=int, default=preview,
+                        help='rows returned per query unless the query sets limit')
+    parser.add_argument('--stats', action='store_true',
+                        help='print the filter cache hits and misses when done')
+    parser.add_argument('--stream', action='store_true',
+                        help='read the caches in one pass per batch instead of loading them')
+    args = parser.parse_args()
+    source = sys.stdin if args.input == '-' else open(args.input, 'r')
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        engine = StreamEngine() if args.stream else BatchEngine()
+        for line in engine.run_lines(source, args.batch_size, args.limit):
+            output.write(line + '\n')
+        if args.stats:
+            print(json.dumps(engine.results.stats()), file=sys.stderr)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import numpy as np
+
+import metrics
+from store import Selection
+
+## the number of bits set in each byte value
+popcount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def to_bits(ids, n):
+    '''
+    Packs row ids into a bitset over n rows, 8 rows per byte.
+    '''
+    bits = np.zeros(n, dtype=bool)
+    bits[ids] = True
+    return np.packbits(bits)
+
+
+def to_ids(bits, n):
+    '''
+    Returns the row ids set in a bitset, in store order.
+    '''
+    return np.flatnonzero(np.unpackbits(bits, count=n))
+
+
+class Refinement:
+    '''The stages of an interactive session as bitsets over the loaded
+    restaurant table. Each filter is run once over the whole table and
+    its bitset kept, so a stage is the stage before it ANDed with its
+    filter's bitset, which takes time in the size of the bitset rather
+    than in the number of restaurants. Undoing a stage just drops it.
+
+    Instance Attributes
+    -------------------
+    store: RestaurantStore
+        the loaded restaurant table
+    stages: list
+        a [filter, value, bitset] for each stage, the first being
+        every restaurant the session started with; the filter and
+        value are None for a stage that wasn't filtered
+    masks: dict
+        the bitset of each (filter, value) run so far'''
+    def __init__(self, restaurants):
+        self.store = restaurants.store
+        self.stages = [[None, None, to_bits(restaurants.ids, len(self.store))]]
+        self.masks = {}
+
+    def __len__(self):
+        return len(self.stages)
+
+    def mask(self, kind, value):
+        '''
+        Returns the bitset of every row of the table passing one
+        filter, running it the first time it's asked for.
+
+        Parameters
+        ----------
+        kind: string
+            'type', 'rating', 'price', 'eater' or 'text'
+        value:
+            the filter's value, like 'sushi', 4.0 or '$$'
+
+        Returns
+        -------
+        bits: numpy array of uint8
+            the packed bitset of the rows that pass
+        '''
+        key = (kind, value)
+        bits = self.masks.get(key)
+        if bits is None:
+            metrics.count('refine_masks', 1, kind)
+            everything = self.store.all()
+            if kind == 'type':
+                found = everything.where_type(value)
+            elif kind == 'rating':
+                found = everything.where_rating(value)
+            elif kind == 'price':
+                found = everything.where_price(value)
+            elif kind == 'eater':
+                found = everything.where_eater()
+            elif kind == 'text':
+                found = everything.search(value)
+            else:
+                raise ValueError(f'unknown filter {kind!r}')
+            bits = self.masks[key] = to_bits(found.ids, len(self.store))
+        return bits
+
+    def _apply(self, bits, kind, value):
+        if kind is None:
+            return bits
+        with metrics.timer('refine', kind):
+            return np.bitwise_and(bits, self.mask(kind, value))
+
+    def push(self, kind=None, value=None):
+        '''
+        Adds a stage that refines the last one by a filter, or that
+        keeps it as it is if kind is None.
+
+        Returns
+        -------
+        restaurants: Selection
+            the restaurants of the new stage
+        '''
+        self.stages.append([kind, value, self._apply(self.stages[-1][2], kind, value)])
+        return self.selection()
+
+    def try_push(self, kind, value):
+        '''
+        Adds a stage like push, but only if it keeps at least one
+        restaurant.
+
+        Returns
+        -------
+        restaurants: Selection
+            the restaurants of the new stage, or None if there are
+            none and no stage was added
+        '''
+        bits = self._apply(self.stages[-1][2], kind, value)
+        if not bits.any():
+            return None
+        self.stages.append([kind, value, bits])
+        return self.selection()
+
+    def pop(self):
+        '''
+        Drops the last stage, going back to the one before it without
+        running anything again. The first stage is never dropped.
+
+        Returns
+        -------
+        restaurants: Selection
+            the restaurants of the stage that is now last
+        '''
+        if len(self.stages) > 1:
+            self.stages.pop()
+        return self.selection()
+
+    def count(self, stage=-1):
+        '''
+        Returns how many restaurants are in a stage.
+        '''
+        return int(popcount[self.stages[stage][2]].sum(dtype=np.int64))
+
+    def selection(self, stage=-1):
+        '''
+        Returns the restaurants of a stage, the last by default.
+        '''
+        return Selection(self.store, to_ids(self.stages[stage][2], len(self.store)))
+
+    def filters(self):
+        '''
+        Returns the (filter, value) of every stage, first to last.
+        '''
+        return [(kind, value) for kind, value, bits in self.stages]
+
+    def selections(self):
+        '''
+        Returns the restaurants of every stage, first to last.
+        '''
+        return [self.selection(i) for i in range(len(self.stages))]
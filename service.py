@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+
+from FinalProject_akdas import city_term, webscrape
+from eater import name_key
+from query import BatchEngine, first_rows, parse_spec, preview
+
+## the caches shipped with the project
+default_cities = ['Detroit', 'Ann_Arbor']
+## the paths the service answers
+routes = ('/query', '/types', '/eater', '/health')
+
+
+class QueryService:
+    '''Answers restaurant queries from warm, in-memory city data. Every
+    city's store and Eater list is loaded once when the service starts
+    instead of on every lookup. Requests are answered on one worker
+    thread, off the event loop, so connections keep being read while
+    a query runs; one thread is enough since the filters are short
+    numpy calls, and it means the filter cache is never used by two
+    requests at once.
+
+    Instance Attributes
+    -------------------
+    engine: BatchEngine
+        the engine holding each city's store
+    names: dict
+        for each city term, each normalized Yelp name mapped to its
+        rows, for /eater
+    worker: ThreadPoolExecutor
+        the thread requests are answered on'''
+    def __init__(self, cities=default_cities):
+        self.engine = BatchEngine()
+        self.names = {}
+        self.worker = ThreadPoolExecutor(max_workers=1)
+        for city in cities:
+            term = city_term(city)
+            ## the Eater list is cached first so the store is joined to it
+            webscrape(term)
+            store = self.engine.city(term).store
+            ## decodes every record once so responses don't parse JSON
+            store.records = list(store.records)
+            names = self.names[term] = {}
+            for i, record in enumerate(store.records):
+                names.setdefault(name_key(record.get('name') or ''), []).append(i)
+
+    def handle(self, path, params):
+        '''
+        Answers one request.
+
+        Parameters
+        ----------
+        path: string
+            the request path, one of routes
+        params: dict
+            the query string parameters
+
+        Returns
+        -------
+        status: int
+            the HTTP status code
+        body: dict
+            the JSON response
+        '''
+        if path not in routes:
+            return 404, {'error': f'unknown path {path}'}
+        try:
+            if path == '/health':
+                return 200, {'status': 'ok', 'cities': sorted(self.names),
+                             'filter_cache': self.engine.results.stats()}
+            term = city_term(params.get('city', ''), refresh=False)
+            if term not in self.names:
+                return 404, {'error': f"city {params.get('city')!r} is not loaded"}
+            if path == '/query':
+                spec = dict(params)
+                chain = parse_spec(spec)
+                limit = int(spec.get('limit', preview))
+                restaurants = self.engine.evaluate(chain)
+                return 200, {'count': len(restaurants),
+                             'results': [r.as_dict() for r in first_rows(restaurants, spec, limit)]}
+            if path == '/types':
+                return 200, {'types': self.engine.city(term).store.categories.types()}
+            if path == '/eater':
+                ## the answer is the join's, the same one /query results carry
+                store = self.engine.city(term).store
+                rows = self.names[term].get(name_key(params.get('name', '')))
+                if not rows:
+                    return 404, {'error': f"no restaurant named {params.get('name')!r}"}
+                joined = [i for i in rows if store.eater_match[i] >= 0]
+                i = joined[0] if joined else rows[0]
+                j = int(store.eater_match[i])
+                return 200, {'id': store.records[i].get('id'),
+                             'result': store.eater_entries[j] if j >= 0 else None,
+                             'score': round(float(store.eater_confidence[i]), 4)}
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            ## a bug shouldn't drop the connection, the client gets a 500
+            print(f'{path}: {type(e).__name__}: {e}', file=sys.stderr)
+            return 500, {'error': 'internal error'}
+
+    async def serve_client(self, reader, writer):
+        '''
+        Reads requests from one connection and answers each one,
+        keeping the connection open until the client closes it.
+        '''
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                close = False
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'connection' and value.strip().lower() == 'close':
+                        close = True
+                parts = request.decode('latin-1').split()
+                if len(parts) < 2 or parts[0] != 'GET':
+                    status, body = 405, {'error': 'only GET is supported'}
+                else:
+                    url = urlsplit(parts[1])
+                    status, body = await asyncio.get_running_loop().run_in_executor(
+                        self.worker, self.handle, url.path, dict(parse_qsl(url.query)))
+                data = json.dumps(body).encode('utf-8')
+                writer.write(f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n'
+                             f'Content-Type: application/json\r\n'
+                             f'Content-Length: {len(data)}\r\n'
+                             f'Connection: {"close" if close else "keep-alive"}\r\n\r\n'.encode('latin-1') + data)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        '''
+        Runs the HTTP server until it's cancelled.
+        '''
+        server = await asyncio.start_server(self.serve_client, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+async def load_test(host, port, paths, clients, requests):
+    '''
+    Sends requests from many concurrent keep-alive clients and times
+    each one.
+
+    Parameters
+    ----------
+    host: string
+        the service host
+    port: int
+        the service port
+    paths: list
+        the request paths to cycle through
+    clients: int
+        how many connections send requests at once
+    requests: int
+        how many requests to send in total
+
+    Returns
+    -------
+    latencies: numpy array
+        the time of each request in seconds
+    elapsed: float
+        the wall time of the whole test in seconds
+    '''
+    latencies = []
+    counter = iter(range(requests))
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for i in counter:
+                path = paths[i % len(paths)]
+                start = time.perf_counter()
+                writer.write(f'GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode('latin-1'))
+                await writer.drain()
+                await reader.readline()
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    if name.lower() == 'content-length':
+                        length = int(value)
+                await reader.readexactly(length)
+                latencies.append(time.perf_counter() - start)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(clients)])
+    return np.array(latencies), time.perf_counter() - start
+
+
+## a mix of the lookups a kiosk makes
+sample_paths = ['/query?city=Detroit&type=sushi&rating=4',
+                '/query?city=Detroit&type=pizza&price=%24%24&limit=10',
+                '/query?city=Ann_Arbor&type=coffee&rating=4.5',
+                '/query?city=Ann_Arbor&rating=4&price=%24',
+                '/eater?city=Detroit&name=Noble%20Fish',
+                '/types?city=Ann_Arbor']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Restaurant query service.')
+    parser.add_argument('mode', choices=['serve', 'loadgen'],
+                        help='run the service, or load test a running one')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--cities', nargs='+', default=default_cities,
+                        help='the cities loaded when serving')
+    parser.add_argument('--clients', type=int, default=64,
+                        help='concurrent connections for the load test')
+    parser.add_argument('--requests', type=int, default=10000,
+                        help='total requests for the load test')
+    args = parser.parse_args()
+    if args.mode == 'serve':
+        service = QueryService(args.cities)
+        print(f'Serving on http://{args.host}:{args.port}')
+        try:
+            asyncio.run(service.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            print('Service Ended')
+    else:
+        latencies, elapsed = asyncio.run(
+            load_test(args.host, args.port, sample_paths, args.clients, args.requests))
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        print(f'{len(latencies)} requests from {args.clients} clients in {elapsed:.2f}s '
+              f'({len(latencies) / elapsed:.0f} requests/s)')
+        print(f'p50 {p50:.2f} ms, p99 {p99:.2f} ms')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import base64
+import json
+import os
+import time
+
+import numpy as np
+
+import metrics
+from bincache import source_stamp
+
+## the log every session is appended to
+trace_file = 'trace.jsonl'
+## the names of the stages of a session, in order
+stage_names = ['initial results', 'type results', 'rating results', 'price results']
+
+
+def table_key(terms):
+    '''
+    Returns the key of the restaurant table for a set of cities: their
+    terms and the size and modification time of each cache, so a
+    table is logged again once a cache changes.
+    '''
+    parts = []
+    for term in terms:
+        source = f'{term}.json'
+        stamp = source_stamp(source) if os.path.exists(source) else (0, 0)
+        parts.append(f'{term}@{stamp[0]}:{stamp[1]}')
+    return '+'.join(parts)
+
+
+def encode_ids(ids, n):
+    '''
+    Encodes the rows of a stage as whichever is smaller: a list of row
+    ids, or a base64 bitmap over all n rows. A bitmap is only used for
+    ids in store order, since it can't keep any other order.
+    '''
+    ids = np.asarray(ids, dtype=np.intp)
+    ordered = len(ids) < 2 or bool(np.all(np.diff(ids) > 0))
+    ## a row id in a list takes about 4 characters, a bitmap 8 rows per 1.33
+    if ordered and len(ids) * 4 > n / 6:
+        bits = np.zeros(n, dtype=bool)
+        bits[ids] = True
+        return {'bitmap': base64.b64encode(np.packbits(bits).tobytes()).decode('ascii')}
+    return {'ids': ids.tolist()}
+
+
+def decode_ids(stage, n):
+    '''
+    Returns the row ids of a stage encoded by encode_ids.
+    '''
+    if 'bitmap' in stage:
+        bits = np.unpackbits(np.frombuffer(base64.b64decode(stage['bitmap']), dtype=np.uint8), count=n)
+        return np.flatnonzero(bits)
+    return np.array(stage['ids'], dtype=np.intp)
+
+
+## the keys logged in each log file and how far it has been read, so
+# each save only reads what was appended since the last one
+_logged = {}
+
+
+def logged_tables(path):
+    '''
+    Returns the keys of the restaurant tables already in a log. The
+    keys are kept between calls and only lines appended since the
+    last call are read, by this or another process; the log is read
+    again from the start if it shrank. Only the start of each line is
+    read as JSON.
+    '''
+    if not os.path.exists(path):
+        _logged.pop(os.path.abspath(path), None)
+        return set()
+    offset, keys = _logged.get(os.path.abspath(path), (0, set()))
+    if os.path.getsize(path) < offset:
+        offset, keys = 0, set()
+    prefix = b'{"kind": "table", "key": '
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                ## a line still being written is read again next time
+                break
+            offset += len(line)
+            if line.startswith(prefix):
+                ## the key is the first string after the prefix
+                keys.add(json.JSONDecoder().raw_decode(line[len(prefix):].decode('utf-8'))[0])
+    _logged[os.path.abspath(path)] = (offset, keys)
+    return keys
+
+
+def save_trace(stages, terms, path=trace_file, now=None, filters=None):
+    '''
+    Appends one session to the trace log. Each distinct set of
+    cities gets its restaurant table written once, as the info()
+    line of every row, and each stage is logged as its filter and
+    the row ids or bitmap of the restaurants in it.
+
+    Parameters
+    ----------
+    stages: list
+        the Selection of each stage, all of one store, in the order of
+        stage_names; a session that ended early has fewer
+    terms: list
+        the city terms the store was loaded from
+    path: string
+        the log file
+    now: float
+        the time of the session, the current time if None
+    filters: list
+        the (filter, value) of each stage, like ('price', '$$'), with
+        None for both if the stage wasn't filtered
+
+    Returns
+    -------
+    None
+    '''
+    with metrics.timer('trace_write'):
+        store = stages[0].store
+        key = table_key(terms)
+        n = len(store)
+        lines = []
+        if key not in logged_tables(path):
+            rows = [store.food(i).info() for i in range(n)]
+            lines.append(json.dumps({'kind': 'table', 'key': key, 'count': n, 'rows': rows}))
+        session = {'kind': 'session', 'table': key, 'time': time.time() if now is None else now,
+                   'cities': list(terms), 'stages': []}
+        if filters is None:
+            filters = [(None, None)] * len(stages)
+        for name, stage, (kind, value) in zip(stage_names, stages, filters):
+            session['stages'].append(dict(name=name, filter=kind, value=value, count=len(stage),
+                                          **encode_ids(stage.ids, n)))
+        lines.append(json.dumps(session))
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        with open(path, 'ab') as f:
+            f.write(data)
+        metrics.count('bytes_written', len(data), os.path.basename(path))
+
+
+class SessionLog:
+    '''Reads a trace log lazily. Opening it only notes where each
+    session and table starts; a session is decoded when it's viewed,
+    and its table when its rows are.
+
+    Instance Attributes
+    -------------------
+    path: string
+        the log file
+    sessions: list
+        the offset of each session line, oldest first
+    tables: dict
+        the offset of each table line by its key'''
+    def __init__(self, path=trace_file):
+        self.path = path
+        self.sessions = []
+        self.tables = {}
+        self._rows = {}
+        offset = 0
+        table = b'{"kind": "table", "key": '
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.startswith(b'{"kind": "session"'):
+                    self.sessions.append(offset)
+                elif line.startswith(table):
+                    key = json.JSONDecoder().raw_decode(line[len(table):].decode('utf-8'))[0]
+                    self.tables[key] = offset
+                offset += len(line)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def _read(self, offset):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def session(self, i):
+        '''
+        Returns one session, -1 for the latest.
+        '''
+        return self._read(self.sessions[i])
+
+    def rows(self, key):
+        '''
+        Returns the restaurant table with a key, reading it the first
+        time it's needed.
+        '''
+        if key not in self._rows:
+            self._rows[key] = self._read(self.tables[key])['rows']
+        return self._rows[key]
+
+    def page(self, session, stage, page=0, size=20):
+        '''
+        Returns one page of a stage of a session.
+
+        Parameters
+        ----------
+        session: dict
+            the session, see session
+        stage: int
+            the position of the stage
+        page: int
+            the page, starting at 0
+        size: int
+            the rows on a page
+
+        Returns
+        -------
+        rows: list
+            (position in the stage, info line) for each row on the page
+        '''
+        rows = self.rows(session['table'])
+        ids = decode_ids(session['stages'][stage], len(rows))
+        start = page * size
+        return [(start + j, rows[i]) for j, i in enumerate(ids[start:start + size])]
@@ -0,0 +1,215 @@
+import math
+
+import numpy as np
+
+earth_radius = 6371008.8 # meters
+meters_per_degree = earth_radius * math.pi / 180
+
+
+def haversine(lat, lon, latitude, longitude):
+    '''
+    Returns the great-circle distance in meters from one point to
+    each of many points.
+
+    Parameters
+    ----------
+    lat: float
+        the latitude of the point
+    lon: float
+        the longitude of the point
+    latitude: numpy array
+        the latitudes of the other points
+    longitude: numpy array
+        the longitudes of the other points
+
+    Returns
+    -------
+    distance: numpy array
+        the distance to each point in meters
+    '''
+    lat1 = math.radians(lat)
+    lat2 = np.radians(latitude)
+    dlat = lat2 - lat1
+    dlon = np.radians(longitude) - math.radians(lon)
+    a = np.sin(dlat / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * earth_radius * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class SpatialIndex:
+    '''Grid index over restaurant coordinates. The bounding box of the
+    points is cut into cells holding a few points each, and the rows
+    are sorted by cell so that every row of cells is one contiguous
+    slice. Radius and bounding box queries only look at the cells they
+    overlap, and nearest queries grow a square of cells around the
+    point until nothing outside it can be closer. Rows without
+    coordinates (NaN, like the old "No Latitude") are never returned.
+
+    Instance Attributes
+    -------------------
+    latitude: numpy array
+        the latitude of every row, NaN if missing
+    longitude: numpy array
+        the longitude of every row, NaN if missing
+    rows: numpy array
+        the rows with coordinates, sorted by cell
+    cell_start: numpy array
+        where each cell starts in rows, plus the end of the last one
+    south, west: float
+        the corner of the grid
+    cell: float
+        the width and height of a cell in degrees
+    nx, ny: int
+        the number of cells across and down'''
+    def __init__(self, latitude, longitude, per_cell=8):
+        self.latitude = latitude
+        self.longitude = longitude
+        valid = ~(np.isnan(latitude) | np.isnan(longitude))
+        rows = np.flatnonzero(valid)
+        if len(rows):
+            lat = latitude[rows]
+            lon = longitude[rows]
+            self.south, self.west = float(lat.min()), float(lon.min())
+            height = max(float(lat.max()) - self.south, 1e-6)
+            width = max(float(lon.max()) - self.west, 1e-6)
+            ## square cells sized for about per_cell points each
+            self.cell = math.sqrt(height * width * per_cell / len(rows))
+            self.nx = int(width / self.cell) + 1
+            self.ny = int(height / self.cell) + 1
+            ## the shortest side of a cell in meters, for the nearest search
+            widest = max(abs(self.south), abs(self.south + height))
+            self.cell_meters = self.cell * meters_per_degree * max(math.cos(math.radians(widest)), 1e-3)
+            keys = self._cells(lat, lon)
+            order = np.argsort(keys, kind='stable')
+            self.rows = rows[order]
+            self.cell_start = np.searchsorted(keys[order], np.arange(self.nx * self.ny + 1))
+        else:
+            self.south = self.west = 0.0
+            self.cell = self.cell_meters = 1.0
+            self.nx = self.ny = 1
+            self.rows = rows
+            self.cell_start = np.zeros(2, dtype=np.intp)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _cells(self, lat, lon):
+        cx = np.clip(((lon - self.west) / self.cell).astype(np.intp), 0, self.nx - 1)
+        cy = np.clip(((lat - self.south) / self.cell).astype(np.intp), 0, self.ny - 1)
+        return cy * self.nx + cx
+
+    def _block(self, x0, x1, y0, y1):
+        '''
+        Returns the rows in the cells from column x0 to x1 and row y0
+        to y1, both ends included and clipped to the grid.
+        '''
+        x0, x1 = max(x0, 0), min(x1, self.nx - 1)
+        y0, y1 = max(y0, 0), min(y1, self.ny - 1)
+        if x0 > x1 or y0 > y1:
+            return self.rows[:0]
+        parts = [self.rows[self.cell_start[y * self.nx + x0]:self.cell_start[y * self.nx + x1 + 1]]
+                 for y in range(y0, y1 + 1)]
+        return np.concatenate(parts)
+
+    def _column(self, lon):
+        return math.floor((lon - self.west) / self.cell)
+
+    def _row(self, lat):
+        return math.floor((lat - self.south) / self.cell)
+
+    def within(self, south, west, north, east, allowed=None):
+        '''
+        Finds the rows inside a bounding box.
+
+        Parameters
+        ----------
+        south, west, north, east: float
+            the edges of the box in degrees
+        allowed: numpy array of bool
+            if given, only rows where allowed is True are returned
+
+        Returns
+        -------
+        ids: numpy array
+            the sorted rows inside the box
+        '''
+        found = self._block(self._column(west), self._column(east),
+                            self._row(south), self._row(north))
+        if allowed is not None:
+            found = found[allowed[found]]
+        lat = self.latitude[found]
+        lon = self.longitude[found]
+        found = found[(lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)]
+        return np.sort(found)
+
+    def near(self, lat, lon, meters, allowed=None):
+        '''
+        Finds the rows within a distance of a point.
+
+        Parameters
+        ----------
+        lat, lon: float
+            the point in degrees
+        meters: float
+            the radius in meters
+        allowed: numpy array of bool
+            if given, only rows where allowed is True are returned
+
+        Returns
+        -------
+        ids: numpy array
+            the rows within the radius, nearest first
+        distance: numpy array
+            the distance to each of them in meters
+        '''
+        dlat = meters / meters_per_degree
+        dlon = dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 90.0))), 1e-3)
+        found = self._block(self._column(lon - dlon), self._column(lon + dlon),
+                            self._row(lat - dlat), self._row(lat + dlat))
+        if allowed is not None:
+            found = found[allowed[found]]
+        distance = haversine(lat, lon, self.latitude[found], self.longitude[found])
+        keep = distance <= meters
+        found, distance = found[keep], distance[keep]
+        order = np.argsort(distance, kind='stable')
+        return found[order], distance[order]
+
+    def nearest(self, lat, lon, k, allowed=None):
+        '''
+        Finds the k rows closest to a point.
+
+        Parameters
+        ----------
+        lat, lon: float
+            the point in degrees
+        k: int
+            how many rows to return
+        allowed: numpy array of bool
+            if given, only rows where allowed is True are returned
+
+        Returns
+        -------
+        ids: numpy array
+            up to k rows, nearest first
+        distance: numpy array
+            the distance to each of them in meters
+        '''
+        if k <= 0 or len(self.rows) == 0:
+            return self.rows[:0], np.zeros(0)
+        cx, cy = self._column(lon), self._row(lat)
+        ## start with a square that should hold about k points
+        r = max(int(math.sqrt(k * len(self.cell_start) / max(len(self.rows), 1)) / 2), 1)
+        while True:
+            found = self._block(cx - r, cx + r, cy - r, cy + r)
+            if allowed is not None:
+                found = found[allowed[found]]
+            covers = cx - r <= 0 and cy - r <= 0 and cx + r >= self.nx - 1 and cy + r >= self.ny - 1
+            if len(found) >= k or covers:
+                distance = haversine(lat, lon, self.latitude[found], self.longitude[found])
+                if len(found) > k:
+                    top = np.argpartition(distance, k - 1)[:k]
+                    found, distance = found[top], distance[top]
+                ## anything outside the square is at least r cells away
+                if covers or distance.max() <= r * self.cell_meters:
+                    order = np.argsort(distance, kind='stable')
+                    return found[order], distance[order]
+            r *= 2
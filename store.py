@@ -0,0 +1,616 @@
+import functools
+import re
+
+import numpy as np
+
+import metrics
+import ranking
+from spatial import SpatialIndex, haversine
+
+## price tiers are stored as the number of dollar signs, 0 means no price
+price_tiers = {'$': 1, '$$': 2, '$$$': 3, '$$$$': 4}
+
+
+def normalize(text):
+    '''
+    Lowercases text and turns every run of punctuation or spaces into
+    one space, so "American (New)" and "american new" are the same.
+    '''
+    return ' '.join(re.split(r'[^0-9a-z]+', text.lower())).strip()
+
+
+def parse_columns(records):
+    '''
+    Reads the columns the store filters on out of the raw records.
+    Every category of a row is kept as a (alias, title) key code, in
+    compressed rows: the codes of row i are
+    category_codes[category_start[i]:category_start[i + 1]].
+
+    Parameters
+    ----------
+    records: list
+        the raw dictionaries of the restaurants
+
+    Returns
+    -------
+    columns: dict
+        the rating, review_count, price, latitude, longitude,
+        category_start and category_codes arrays plus the
+        category_keys list
+    '''
+    n = len(records)
+    rating = np.full(n, np.nan, dtype=np.float32)
+    review_count = np.zeros(n, dtype=np.uint32)
+    price = np.zeros(n, dtype=np.uint8)
+    latitude = np.full(n, np.nan, dtype=np.float64)
+    longitude = np.full(n, np.nan, dtype=np.float64)
+    category_start = np.zeros(n + 1, dtype=np.uint32)
+    category_codes = []
+    category_keys = []
+    codes = {}
+    for i, r in enumerate(records):
+        if r.get('rating') is not None:
+            rating[i] = r['rating']
+        if r.get('review_count'):
+            review_count[i] = r['review_count']
+        price[i] = price_tiers.get(r.get('price'), 0)
+        if isinstance(r.get('coordinates'), dict):
+            lat = r['coordinates'].get('latitude')
+            lon = r['coordinates'].get('longitude')
+            if lat is not None and lon is not None:
+                latitude[i] = lat
+                longitude[i] = lon
+        row = []
+        for c in r.get('categories') or []:
+            key = (c.get('alias') or '', c.get('title') or '')
+            if key not in codes:
+                codes[key] = len(category_keys)
+                category_keys.append(key)
+            ## a row is listed once even if a category repeats
+            if codes[key] not in row:
+                row.append(codes[key])
+        category_codes += row
+        category_start[i + 1] = len(category_codes)
+    return {'rating': rating, 'review_count': review_count, 'price': price,
+            'latitude': latitude, 'longitude': longitude,
+            'category_start': category_start,
+            'category_codes': np.array(category_codes, dtype=np.int32),
+            'category_keys': category_keys}
+
+
+def _filtered(kind, ids, found):
+    '''
+    Counts the rows a filter kept and dropped, and returns the kept ones.
+    '''
+    metrics.count('rows_in', len(ids), kind)
+    metrics.count('rows_out', len(found), kind)
+    return found
+
+
+class CategoryIndex:
+    '''Inverted index from category text to restaurants. Every category
+    of a restaurant is indexed, not just the first one, by both its
+    Yelp alias and its title. Each distinct category gets a posting
+    list of the rows that have it, and every substring of its
+    normalized alias and title (which covers its words and n-grams)
+    points at that category. A type query is one dictionary lookup
+    plus a union of the matching posting lists.
+
+    Instance Attributes
+    -------------------
+    keys: list
+        the (alias, title) of each category, indexed by category code
+    titles: list
+        the category titles, indexed by category code
+    postings: list
+        a sorted numpy array of rows for each category code
+    terms: dict
+        each normalized substring mapped to a tuple of category codes'''
+    def __init__(self, keys, category_start, category_codes):
+        self.keys = list(keys)
+        self.titles = [title or alias for alias, title in keys]
+        ## every (row, code) pair, grouped by code with rows kept in order
+        counts = np.diff(category_start.astype(np.intp))
+        rows = np.repeat(np.arange(len(counts), dtype=np.intp), counts)
+        order = np.argsort(category_codes, kind='stable')
+        bounds = np.searchsorted(category_codes[order], np.arange(1, len(keys)))
+        self.postings = np.split(rows[order], bounds)
+        terms = {}
+        for code, (alias, title) in enumerate(keys):
+            for text in (alias, title):
+                if not text:
+                    continue
+                text = normalize(text)
+                for start in range(len(text)):
+                    for end in range(start + 1, len(text) + 1):
+                        terms.setdefault(text[start:end], set()).add(code)
+        self.terms = {t: tuple(sorted(c)) for t, c in terms.items()}
+        self._unions = {}
+
+    def types(self):
+        '''
+        Returns the sorted list of category titles that can be searched.
+        '''
+        return sorted(set(self.titles), key=str.lower)
+
+    def lookup(self, food_type):
+        '''
+        Finds every row with a category whose alias or title contains
+        food_type, ignoring case and punctuation.
+
+        Parameters
+        ----------
+        food_type: string
+            the type to look for
+
+        Returns
+        -------
+        ids: numpy array
+            the sorted rows that match
+        '''
+        key = normalize(food_type)
+        if key not in self._unions:
+            codes = self.terms.get(key, ())
+            if not codes:
+                ids = np.array([], dtype=np.intp)
+            elif len(codes) == 1:
+                ids = self.postings[codes[0]]
+            else:
+                ids = np.unique(np.concatenate([self.postings[c] for c in codes]))
+            self._unions[key] = ids
+        return self._unions[key]
+
+
+class RestaurantStore:
+    '''Column store of the cached Yelp businesses. Each field used
+    by the filters is kept in its own NumPy array, so a filter is one
+    vectorized comparison over the whole city instead of a Python loop
+    over Food objects. Food objects are only made for rows that get
+    displayed. The columns can be passed in already built, for example
+    as views of a memory-mapped binary cache. Everything derived from
+    the columns, like the category and spatial indexes, is only built
+    the first time it's used, so opening a store doesn't read them.
+
+    Instance Attributes
+    -------------------
+    records: sequence
+        the raw dictionaries of the restaurants, in cache order
+    rating: numpy array of float32
+        the average rating of each restaurant, NaN if missing
+    review_count: numpy array of uint32
+        how many reviews each rating averages, 0 if missing
+    mean_rating: float
+        the average rating over the whole store, the prior the
+        ranking pulls ratings with few reviews towards
+    price: numpy array of uint8
+        the price tier (1-4 dollar signs) of each restaurant, 0 if missing
+    category_start: numpy array of uint32
+        where each row's codes start in category_codes
+    category_codes: numpy array of int32
+        the category codes of every row, one after another
+    category_keys: list
+        the (alias, title) of each category code
+    categories: CategoryIndex
+        the index of every category of every restaurant
+    latitude: numpy array of float64
+        the latitude of each restaurant, NaN if missing
+    longitude: numpy array of float64
+        the longitude of each restaurant, NaN if missing
+    spatial: SpatialIndex
+        the grid index over the coordinates
+    eater_entries: list
+        the Eater entries joined to the rows, see attach_eater
+    eater_match: numpy array of int32
+        the Eater entry of each row, -1 if it isn't on the Eater list
+    eater_confidence: numpy array of float32
+        how sure the join is of each row's Eater entry, 0 without one
+    text: TextIndex
+        the full-text index of the rows, see attach_text; it's only
+        loaded, or built, the first time it's used
+    load_text: function
+        loads the saved full-text index of the rows, like
+        load_text_index, or None to build it in memory
+    food_class: class
+        the class used to make Food objects for displayed rows'''
+    def __init__(self, records, food_class=None, columns=None):
+        if food_class is None:
+            from FinalProject_akdas import Food as food_class
+        self.food_class = food_class
+        if columns is None:
+            self.records = list(records)
+            columns = parse_columns(self.records)
+        else:
+            self.records = records
+        self.rating = columns['rating']
+        self.review_count = columns['review_count']
+        self.price = columns['price']
+        self.latitude = columns['latitude']
+        self.longitude = columns['longitude']
+        self.category_start = columns['category_start']
+        self.category_codes = columns['category_codes']
+        self.category_keys = columns['category_keys']
+        self.eater_entries = []
+        self.load_text = None
+
+    def __len__(self):
+        return len(self.records)
+
+    @functools.cached_property
+    def mean_rating(self):
+        rated = self.rating[~np.isnan(self.rating)]
+        return float(rated.mean()) if len(rated) else 0.0
+
+    @functools.cached_property
+    def categories(self):
+        return CategoryIndex(self.category_keys, self.category_start, self.category_codes)
+
+    @functools.cached_property
+    def spatial(self):
+        return SpatialIndex(self.latitude, self.longitude)
+
+    @functools.cached_property
+    def text(self):
+        if self.load_text is not None:
+            return self.load_text()
+        from textindex import build_index, store_documents
+        return build_index(store_documents(self))
+
+    ## until attach_eater is called no row is on the Eater list
+    @functools.cached_property
+    def eater_match(self):
+        return np.full(len(self), -1, dtype=np.int32)
+
+    @functools.cached_property
+    def eater_confidence(self):
+        return np.zeros(len(self), dtype=np.float32)
+
+    def all(self):
+        '''
+        Returns a Selection of every restaurant in the store.
+        '''
+        return Selection(self, np.arange(len(self), dtype=np.intp))
+
+    def food(self, i):
+        '''
+        Makes the Food object for one row.
+
+        Parameters
+        ----------
+        i: int
+            the row of the restaurant
+
+        Returns
+        -------
+        food: Food
+            the restaurant at that row
+        '''
+        metrics.count('food_objects')
+        record = self.records[i]
+        j = self.eater_match[i]
+        if j >= 0:
+            record = dict(record, eater=dict(self.eater_entries[j],
+                                             confidence=round(float(self.eater_confidence[i]), 4)))
+        return self.food_class(json=record)
+
+    def attach_eater(self, entries, match, confidence):
+        '''
+        Attaches Eater entries to the rows, so each matched row's Food
+        object has its Eater description, url and match confidence.
+
+        Parameters
+        ----------
+        entries: list
+            the Eater entries
+        match: numpy array
+            the entry of each row, -1 for none
+        confidence: numpy array
+            how sure the match of each row is
+        '''
+        self.eater_entries = entries
+        self.eater_match = match
+        self.eater_confidence = confidence
+
+    def attach_text(self, index):
+        '''
+        Attaches a full-text index of the rows that's already built.
+        To load the city's saved index only if it's searched, set
+        load_text instead.
+        '''
+        self.text = index
+
+    def filter_type(self, ids, food_type):
+        '''
+        Keeps the rows with any category whose alias or title contains
+        food_type, ignoring case.
+
+        Parameters
+        ----------
+        ids: numpy array
+            the rows to filter
+        food_type: string
+            the type to look for
+
+        Returns
+        -------
+        ids: numpy array
+            the rows that match
+        '''
+        with metrics.timer('filter', 'type'):
+            mask = np.zeros(len(self), dtype=bool)
+            mask[self.categories.lookup(food_type)] = True
+            found = ids[mask[ids]]
+        return _filtered('type', ids, found)
+
+    def filter_rating(self, ids, rating):
+        '''
+        Keeps the rows rated at least rating.
+        '''
+        with metrics.timer('filter', 'rating'):
+            found = ids[self.rating[ids] >= rating]
+        return _filtered('rating', ids, found)
+
+    def filter_price(self, ids, price):
+        '''
+        Keeps the rows with exactly the given price in dollar signs.
+        '''
+        with metrics.timer('filter', 'price'):
+            if price not in price_tiers:
+                found = ids[:0]
+            else:
+                found = ids[self.price[ids] == price_tiers[price]]
+        return _filtered('price', ids, found)
+
+    def rank(self, ids, k, lat=None, lon=None, scale=ranking.distance_scale):
+        '''
+        Finds the k best rows by their review-weighted rating, and if
+        a point is given, by how close they are to it too. Only the top
+        k are sorted, not every row.
+
+        Parameters
+        ----------
+        ids: numpy array
+            the rows to rank
+        k: int
+            how many rows to return
+        lat, lon: float
+            the point to weight by distance from, or None
+        scale: float
+            the distance in meters at which a score is halved
+
+        Returns
+        -------
+        ids: numpy array
+            up to k rows, best first
+        scores: numpy array
+            the score of each of them
+        '''
+        with metrics.timer('rank'):
+            scores = ranking.bayesian(self.rating[ids], self.review_count[ids], self.mean_rating)
+            if lat is not None and lon is not None:
+                distance = haversine(lat, lon, self.latitude[ids], self.longitude[ids])
+                scores = ranking.near_weight(scores, distance, scale)
+            top = ranking.top_k(scores, k)
+        return ids[top], scores[top]
+
+    def search(self, ids, query, k=None):
+        '''
+        Ranks the rows matching a free-text query by BM25 over their
+        names, categories and Eater descriptions. The index is loaded
+        with load_text on the first search, or built in memory if
+        there's nothing to load it from.
+
+        Parameters
+        ----------
+        ids: numpy array
+            the rows to search
+        query: string
+            the words to look for, like "late night tacos"
+        k: int
+            how many rows to return, every match if None
+
+        Returns
+        -------
+        ids: numpy array
+            the matching rows, best first
+        scores: numpy array
+            the BM25 score of each of them
+        '''
+        found, scores = self.text.search(query, ids, k)
+        return _filtered('text', ids, found), scores
+
+    def filter_eater(self, ids):
+        '''
+        Keeps the rows on the Eater list.
+        '''
+        with metrics.timer('filter', 'eater'):
+            found = ids[self.eater_match[ids] >= 0]
+        return _filtered('eater', ids, found)
+
+    def _allowed(self, ids):
+        '''
+        Returns a boolean mask over every row that is True for ids.
+        '''
+        mask = np.zeros(len(self), dtype=bool)
+        mask[ids] = True
+        return mask
+
+    def filter_near(self, ids, lat, lon, meters):
+        '''
+        Keeps the rows within meters of a point, nearest first.
+
+        Parameters
+        ----------
+        ids: numpy array
+            the rows to filter
+        lat, lon: float
+            the point in degrees
+        meters: float
+            the radius in meters
+
+        Returns
+        -------
+        ids: numpy array
+            the rows that match
+        '''
+        return self.spatial.near(lat, lon, meters, self._allowed(ids))[0]
+
+    def filter_within(self, ids, south, west, north, east):
+        '''
+        Keeps the rows inside a bounding box, in store order.
+        '''
+        return self.spatial.within(south, west, north, east, self._allowed(ids))
+
+    def filter_nearest(self, ids, lat, lon, k):
+        '''
+        Keeps the k rows closest to a point, nearest first.
+        '''
+        return self.spatial.nearest(lat, lon, k, self._allowed(ids))[0]
+
+
+class MergedRecords:
+    '''The records of several stores read as one sequence, without
+    copying or decoding them.
+
+    Instance Attributes
+    -------------------
+    parts: list
+        the record sequence of each store
+    start: numpy array
+        the first merged row of each part, plus the total'''
+    def __init__(self, parts):
+        self.parts = parts
+        self.start = np.zeros(len(parts) + 1, dtype=np.intp)
+        np.cumsum([len(p) for p in parts], out=self.start[1:])
+
+    def __len__(self):
+        return int(self.start[-1])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('record index out of range')
+        part = int(np.searchsorted(self.start, i, side='right')) - 1
+        return self.parts[part][i - self.start[part]]
+
+    def __iter__(self):
+        for part in self.parts:
+            yield from part
+
+
+def merge_stores(stores):
+    '''
+    Combines the stores of several cities into one store, so the
+    filters run over all of them at once. The rows of each store
+    follow the rows of the one before it.
+
+    Parameters
+    ----------
+    stores: list
+        the RestaurantStore of each city
+
+    Returns
+    -------
+    store: RestaurantStore
+        one store with every row
+    '''
+    if len(stores) == 1:
+        return stores[0]
+    keys = []
+    codes = {}
+    category_codes = []
+    category_start = [np.zeros(1, dtype=np.uint32)]
+    offset = 0
+    for store in stores:
+        ## maps this store's category codes to the merged ones
+        remap = np.zeros(len(store.category_keys), dtype=np.int32)
+        for code, key in enumerate(store.category_keys):
+            if key not in codes:
+                codes[key] = len(keys)
+                keys.append(key)
+            remap[code] = codes[key]
+        category_codes.append(remap[store.category_codes])
+        category_start.append(store.category_start[1:].astype(np.uint32) + np.uint32(offset))
+        offset += len(store.category_codes)
+    columns = {name: np.concatenate([getattr(store, name) for store in stores])
+               for name in ('rating', 'review_count', 'price', 'latitude', 'longitude')}
+    columns['category_start'] = np.concatenate(category_start)
+    columns['category_codes'] = np.concatenate(category_codes).astype(np.int32)
+    columns['category_keys'] = keys
+    records = MergedRecords([store.records for store in stores])
+    merged = RestaurantStore(records, stores[0].food_class, columns=columns)
+    entries = []
+    match = []
+    for store in stores:
+        match.append(np.where(store.eater_match >= 0, store.eater_match + len(entries), -1))
+        entries += store.eater_entries
+    merged.attach_eater(entries, np.concatenate(match).astype(np.int32),
+                        np.concatenate([store.eater_confidence for store in stores]))
+    from textindex import merge_indexes
+    ## each city's index is only loaded if the merged store is searched
+    merged.load_text = lambda: merge_indexes([store.text for store in stores])
+    return merged
+
+
+class Selection:
+    '''A filtered set of rows of a RestaurantStore. It can be used like
+    the old list of Food objects: its length is the number of rows,
+    indexing and slicing make Food objects for just those rows, and
+    the filter methods return a new Selection.
+
+    Instance Attributes
+    -------------------
+    store: RestaurantStore
+        the store the rows come from
+    ids: numpy array
+        the selected rows, in store order unless a nearest or radius
+        query sorted them by distance or top sorted them by score'''
+    def __init__(self, store, ids):
+        self.store = store
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.store.food(i) for i in self.ids[key]]
+        return self.store.food(self.ids[key])
+
+    def __iter__(self):
+        for i in self.ids:
+            yield self.store.food(i)
+
+    def __eq__(self, other):
+        if not isinstance(other, Selection):
+            return NotImplemented
+        return self.store is other.store and np.array_equal(self.ids, other.ids)
+
+    def where_type(self, food_type):
+        return Selection(self.store, self.store.filter_type(self.ids, food_type))
+
+    def where_rating(self, rating):
+        return Selection(self.store, self.store.filter_rating(self.ids, rating))
+
+    def where_price(self, price):
+        return Selection(self.store, self.store.filter_price(self.ids, price))
+
+    def where_eater(self):
+        return Selection(self.store, self.store.filter_eater(self.ids))
+
+    def search(self, query, k=None):
+        return Selection(self.store, self.store.search(self.ids, query, k)[0])
+
+    def top(self, k, lat=None, lon=None):
+        return Selection(self.store, self.store.rank(self.ids, k, lat, lon)[0])
+
+    def near(self, lat, lon, meters):
+        return Selection(self.store, self.store.filter_near(self.ids, lat, lon, meters))
+
+    def within(self, south, west, north, east):
+        return Selection(self.store, self.store.filter_within(self.ids, south, west, north, east))
+
+    def nearest(self, lat, lon, k):
+        return Selection(self.store, self.store.filter_nearest(self.ids, lat, lon, k))
@@ -0,0 +1,186 @@
+import json
+import re
+
+import metrics
+from store import normalize, price_tiers
+
+## how many characters are read from the cache at a time
+chunk_size = 1 << 16
+
+_space = re.compile(r'\s*')
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    '''Reads JSON values one at a time from a text file through a small
+    buffer, so only the value being decoded is ever held in memory.'''
+    def __init__(self, file, size):
+        self.file = file
+        self.size = size
+        self.buf = ''
+        self.pos = 0
+
+    def fill(self):
+        '''
+        Reads the next chunk onto the end of the buffer, dropping what
+        has been used. Returns False at the end of the file.
+        '''
+        chunk = self.file.read(self.size)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        '''
+        Skips whitespace and returns the next character, or '' at the
+        end of the file.
+        '''
+        while True:
+            self.pos = _space.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        '''
+        Skips one of chars after any whitespace and returns it.
+        '''
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f'expected one of {chars!r} in the cache, found {char!r}')
+        self.pos += 1
+        return char
+
+    def value(self):
+        '''
+        Decodes the next JSON value, reading more of the file until
+        the whole value is in the buffer.
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            ## a number could go on in the next chunk
+            if end == len(self.buf) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_records(path, where=None, size=chunk_size):
+    '''
+    Reads the businesses of a city cache one record at a time instead
+    of parsing the whole file, so memory stays flat however big the
+    cache is.
+
+    Parameters
+    ----------
+    path: string
+        the JSON cache, like Detroit.json
+    where: function
+        if given, only records it returns True for are yielded, see
+        predicate
+    size: int
+        how many characters to read at a time
+
+    Returns
+    -------
+    records: generator
+        the dictionaries of the restaurants, in cache order
+
+    Raises
+    ------
+    ValueError
+        if the file isn't a JSON object
+    '''
+    with open(path, 'r') as file:
+        reader = _Reader(file, size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key != 'businesses':
+                reader.value()
+            else:
+                reader.expect('[')
+                if reader.peek() != ']':
+                    while True:
+                        record = reader.value()
+                        metrics.count('records_parsed', 1, 'stream')
+                        if where is None or where(record):
+                            yield record
+                        if reader.expect(',]') == ']':
+                            break
+                else:
+                    reader.pos += 1
+            if reader.expect(',}') == '}':
+                return
+
+
+def iter_food(path, where=None, food_class=None):
+    '''
+    Reads a city cache one restaurant at a time as Food objects. Only
+    the records that pass where are made into Food objects.
+
+    Parameters
+    ----------
+    path: string
+        the JSON cache, like Detroit.json
+    where: function
+        if given, only records it returns True for are yielded
+    food_class: class
+        the class the records are made into
+
+    Returns
+    -------
+    restaurants: generator
+        the Food object of each record that passes
+    '''
+    if food_class is None:
+        from FinalProject_akdas import Food as food_class
+    for record in iter_records(path, where):
+        yield food_class(json=record)
+
+
+def predicate(food_type=None, rating=None, price=None):
+    '''
+    Makes a record filter that matches the same restaurants as the
+    store's type, rating and price filters, to push into iter_records.
+
+    Parameters
+    ----------
+    food_type: string
+        a type that any category's alias or title must contain
+    rating: float
+        the minimum rating
+    price: string
+        the exact price in dollar signs
+
+    Returns
+    -------
+    where: function
+        True for a record that passes every filter given
+    '''
+    key = normalize(food_type) if food_type is not None else None
+
+    def where(record):
+        if price is not None and (price not in price_tiers or record.get('price') != price):
+            return False
+        if rating is not None and not (record.get('rating') is not None and record['rating'] >= rating):
+            return False
+        if key is not None:
+            for c in record.get('categories') or []:
+                if key and any(key in normalize(c.get(field) or '') for field in ('alias', 'title')):
+                    return True
+            return False
+        return True
+    return where
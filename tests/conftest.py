@@ -0,0 +1,115 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+## the modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+## kept before the sleeps fixture patches time.sleep for fetch
+_sleep = time.sleep
+
+
+class StubYelp:
+    '''A local stand-in for the Yelp search endpoint. Each page offset
+    answers with the responses queued for it, in order, and then with
+    a page of made-up businesses. Every request is recorded with the
+    time it arrived, and can be held for a while first to stand in
+    for the round trip to the real API.
+
+    Instance Attributes
+    -------------------
+    url: string
+        the search endpoint of the stub
+    scripts: dict
+        each offset mapped to a list of (status, headers) to answer
+        with before a normal page, or to one (status, headers) to
+        always answer with
+    delay: function
+        the seconds each request for an offset is held before it's
+        answered, or None to answer at once
+    requests: list
+        (time, offset) of every request
+    finished: list
+        the offset of every answered request, in the order they were
+        answered'''
+    def __init__(self, delay=None):
+        self.scripts = {}
+        self.delay = delay
+        self.requests = []
+        self.finished = []
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                params = parse_qs(urlparse(self.path).query)
+                offset = int(params['offset'][0])
+                limit = int(params['limit'][0])
+                with stub.lock:
+                    stub.requests.append((time.monotonic(), offset))
+                    script = stub.scripts.get(offset)
+                    if isinstance(script, list):
+                        answer = script.pop(0) if script else None
+                    else:
+                        answer = script
+                if stub.delay is not None:
+                    _sleep(stub.delay(offset))
+                if answer is None:
+                    body = json.dumps({'businesses': [{'id': f'{offset + i}', 'name': f'Place {offset + i}'}
+                                                      for i in range(limit)]}).encode()
+                    status, headers = 200, {}
+                else:
+                    status, headers = answer
+                    body = json.dumps({'error': status}).encode()
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with stub.lock:
+                    stub.finished.append(offset)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/v3/businesses/search'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def offsets(self):
+        '''
+        Returns the offset of every request, in the order they came.
+        '''
+        with self.lock:
+            return [offset for t, offset in self.requests]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    server = StubYelp()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    '''
+    Records the waits of fetch instead of sleeping through them.
+    '''
+    import fetch
+    waits = []
+    monkeypatch.setattr(fetch.time, 'sleep', waits.append)
+    return waits
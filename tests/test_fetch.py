@@ -0,0 +1,132 @@
+import json
+import os
+import random
+import time
+
+import pytest
+
+import fetch
+from fetch import Checkpoint, FetchError, crawl, fetch_page, fetch_pages, make_session
+
+headers = {'Authorization': 'Bearer test'}
+
+
+@pytest.fixture
+def session():
+    session = make_session()
+    yield session
+    session.close()
+
+
+def test_retry_after_is_waited(stub, session, sleeps):
+    stub.scripts[0] = [(429, {'Retry-After': '3'}), (503, {'Retry-After': '1.5'})]
+    page = fetch_page(session, stub.url, headers, 'Detroit', 0, limit=2)
+    assert [r['id'] for r in page] == ['0', '1']
+    assert stub.offsets() == [0, 0, 0]
+    assert sleeps == [3.0, 1.5]
+
+
+def test_backoff_grows_without_retry_after(stub, session, sleeps, monkeypatch):
+    monkeypatch.setattr(fetch.random, 'uniform', lambda low, high: high)
+    stub.scripts[0] = [(500, {}), (502, {}), (503, {})]
+    fetch_page(session, stub.url, headers, 'Detroit', 0, limit=1)
+    assert sleeps == [fetch.backoff, fetch.backoff * 2, fetch.backoff * 4]
+
+
+def test_backoff_is_capped():
+    for attempt in range(20):
+        assert 0 <= fetch.backoff_delay(attempt) <= fetch.max_backoff
+
+
+def test_retry_limit(stub, session, sleeps):
+    stub.scripts[0] = (503, {})
+    with pytest.raises(FetchError, match='HTTP 503 after 3 attempts'):
+        fetch_page(session, stub.url, headers, 'Detroit', 0, retries=2)
+    assert stub.offsets() == [0, 0, 0]
+    assert len(sleeps) == 2
+
+
+def test_crawl_resumes_from_checkpoint(stub, sleeps, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    stub.scripts[2] = (500, {})
+    with pytest.raises(FetchError):
+        crawl(['Detroit'], headers, url=stub.url, offsets=[0, 2, 4], limit=2,
+              limiter=None, retries=1, max_workers=2)
+    ## the finished pages are kept, and nothing is written for the city
+    assert sorted(Checkpoint('Detroit').pages) == [0, 4]
+    assert not os.path.exists('Detroit.json')
+    ## a line cut off by the interruption is skipped
+    with open('Detroit_checkpoint.jsonl', 'a') as file:
+        file.write('{"offset": 2, "busin')
+
+    del stub.scripts[2]
+    before = len(stub.requests)
+    restaurants = crawl(['Detroit'], headers, url=stub.url, offsets=[0, 2, 4], limit=2,
+                        limiter=None, max_workers=2)
+    assert stub.offsets()[before:] == [2]
+    assert [r['id'] for r in restaurants['Detroit']] == ['0', '1', '2', '3', '4', '5']
+    with open('Detroit.json') as file:
+        assert json.load(file) == {'businesses': restaurants['Detroit']}
+    assert not os.path.exists('Detroit_checkpoint.jsonl')
+
+
+def test_token_bucket_caps_rate():
+    bucket = fetch.TokenBucket(rate=100, capacity=5)
+    waits = [bucket.reserve() for i in range(25)]
+    ## the burst is free, then each request waits one more token
+    assert waits[:5] == [0.0] * 5
+    assert waits[-1] == pytest.approx(20 / 100, abs=0.01)
+
+
+def test_limiter_caps_requests_to_server(stub):
+    limiter = fetch.RateLimiter(per_second=20, per_day=10**6)
+    fetch.fetch_pages('Detroit', headers, url=stub.url, offsets=range(40), limit=1,
+                      max_workers=8, limiter=limiter)
+    times = sorted(t for t, offset in stub.requests)
+    assert len(times) == 40
+    ## 20 at once, then 20 a second
+    assert times[-1] - times[0] >= 0.9
+    for i, start in enumerate(times):
+        within = sum(1 for t in times[i:] if t - start < 0.5)
+        assert within <= 20 + 0.5 * 20 + 1
+
+
+def test_rejected_request_is_not_retried(stub, session, sleeps):
+    stub.scripts[0] = (404, {})
+    with pytest.raises(FetchError, match='HTTP 404') as error:
+        fetch_page(session, stub.url, headers, 'Detroit', 0)
+    assert not isinstance(error.value, fetch.QuotaExhausted)
+    assert stub.offsets() == [0]
+
+
+def test_fetch_error_propagates_from_pool(stub, sleeps):
+    stub.scripts[3] = (500, {})
+    with pytest.raises(FetchError, match='offset 3: HTTP 500'):
+        fetch.fetch_pages('Detroit', headers, url=stub.url, offsets=range(6), limit=1,
+                          max_workers=4, retries=1)
+
+
+def test_quota_exhausted_stops_crawl(stub, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    limiter = fetch.RateLimiter(per_second=100, per_day=3, max_wait=0)
+    with pytest.raises(fetch.QuotaExhausted):
+        crawl(['Detroit'], headers, url=stub.url, offsets=range(0, 10, 2), limit=2,
+              limiter=limiter, max_workers=1)
+    assert len(stub.requests) == 3
+    ## the pages fetched before the quota ran out are kept for next time
+    assert sorted(Checkpoint('Detroit').pages) == [0, 2, 4]
+    assert not os.path.exists('Detroit.json')
+
+
+def test_pages_are_fetched_at_once_and_kept_in_order(stub):
+    ## later pages answer sooner, so they finish out of order
+    delays = {offset: 0.1 + 0.2 * (7 - k) / 7 + random.uniform(0, 0.02)
+              for k, offset in enumerate(range(0, 400, 50))}
+    stub.delay = delays.get
+    start = time.monotonic()
+    records = fetch_pages('Detroit', headers, url=stub.url, offsets=delays, limit=50, max_workers=8)
+    elapsed = time.monotonic() - start
+    ## about one slowest round trip, not the sum of them
+    assert elapsed < max(delays.values()) + 0.25 < sum(delays.values())
+    assert stub.finished != sorted(stub.finished)
+    assert [r['id'] for r in records] == [str(i) for i in range(400)]
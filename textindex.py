@@ -0,0 +1,354 @@
+import argparse
+import functools
+import io
+import os
+import re
+import unicodedata
+
+import numpy as np
+
+import metrics
+from bincache import source_stamp
+from enrich import join_version
+from fetch import write_bytes_atomic
+from ranking import top_k
+
+## bump whenever tokenizing, stemming or the file layout changes
+index_version = 1
+
+## BM25 term frequency saturation and length normalization
+k1 = 1.2
+b = 0.75
+
+## how many times a word counts in each field of a restaurant
+field_weights = {'name': 2.0, 'categories': 1.0, 'eater': 1.0}
+
+stopwords = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from',
+             'has', 'have', 'in', 'into', 'is', 'it', 'its', 'of', 'on', 'or', 'our',
+             'that', 'the', 'their', 'this', 'to', 'was', 'were', 'with', 'you', 'your'}
+
+
+@functools.lru_cache(maxsize=65536)
+def stem(word):
+    '''
+    Cuts common English endings off a word, so "tacos" and "taco",
+    or "smoked", "smoking" and "smoke", are the same term. It is much
+    lighter than a full Porter stemmer but maps a word and its plural
+    or verb forms the same way.
+    '''
+    if len(word) <= 3 or not word.isalpha():
+        return word
+    if word.endswith('ies') and len(word) > 4:
+        word = word[:-2]
+    elif word.endswith(('sses', 'xes', 'ches', 'shes')):
+        word = word[:-2]
+    elif word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        word = word[:-1]
+    for suffix in ('ing', 'ed'):
+        if word.endswith(suffix) and re.search('[aeiouy]', word[:-len(suffix)]) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            ## "shopping" to "shop", but not "grill" to "gril"
+            if len(word) > 3 and word[-1] == word[-2] and word[-1] not in 'lsz':
+                word = word[:-1]
+            break
+    if word.endswith('e') and len(word) > 3:
+        word = word[:-1]
+    ## "pastry" and "pastries" both end up as "pastri"
+    elif word.endswith('y') and len(word) > 3 and word[-2] not in 'aeiou':
+        word = word[:-1] + 'i'
+    return word
+
+
+def tokenize(text):
+    '''
+    Splits text into stemmed terms: accents and case are dropped,
+    words are runs of letters and digits, and stopwords are skipped.
+    '''
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii').lower()
+    return [stem(word) for word in re.findall(r'[a-z0-9]+', text) if word not in stopwords]
+
+
+def fields(record, eater=None):
+    '''
+    Returns the text of each field of a restaurant: its Yelp name,
+    its category aliases and titles, and its Eater name and
+    description if it's on the Eater list.
+    '''
+    categories = []
+    for c in record.get('categories') or []:
+        categories += [c.get('alias') or '', c.get('title') or '']
+    texts = {'name': record.get('name') or '', 'categories': ' '.join(categories), 'eater': ''}
+    if eater:
+        texts['eater'] = f"{eater.get('name') or ''} {eater.get('description') or ''}"
+    return texts
+
+
+def store_documents(store):
+    '''
+    Returns the fields of every row of a store, with the Eater entry
+    attached to each row if it has one.
+    '''
+    for i, record in enumerate(store.records):
+        j = store.eater_match[i]
+        yield fields(record, store.eater_entries[j] if j >= 0 else None)
+
+
+class TextIndex:
+    '''Inverted index of the words of each restaurant, ranked with
+    BM25. The postings of every term are kept together in flat
+    arrays: the documents and weighted term frequencies of term t are
+    docs[start[t]:start[t + 1]] and freqs[start[t]:start[t + 1]].
+    A query only touches the postings of its own terms.
+
+    Instance Attributes
+    -------------------
+    terms: dict
+        each term mapped to its number
+    start: numpy array of int64
+        where each term's postings start, plus the end of the last one
+    docs: numpy array of int32
+        the rows of each posting, sorted within a term
+    freqs: numpy array of float32
+        the weighted count of the term in each posting's row
+    lengths: numpy array of float32
+        the weighted number of terms of each row'''
+    def __init__(self, terms, start, docs, freqs, lengths):
+        self.terms = terms
+        self.start = start
+        self.docs = docs
+        self.freqs = freqs
+        self.lengths = lengths
+        self.average = float(lengths.mean()) if len(lengths) and lengths.mean() > 0 else 1.0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def postings(self, term):
+        '''
+        Returns the rows and weighted frequencies of a term.
+        '''
+        t = self.terms.get(term)
+        if t is None:
+            return self.docs[:0], self.freqs[:0]
+        return self.docs[self.start[t]:self.start[t + 1]], self.freqs[self.start[t]:self.start[t + 1]]
+
+    def scores(self, query, ids=None):
+        '''
+        Scores rows against a free-text query with BM25.
+
+        Parameters
+        ----------
+        query: string
+            the words to look for
+        ids: numpy array
+            if given, only these rows are scored
+
+        Returns
+        -------
+        ids: numpy array
+            the rows that have at least one query term
+        scores: numpy array
+            the BM25 score of each of them
+        '''
+        n = len(self)
+        total = np.zeros(n, dtype=np.float64)
+        hit = np.zeros(n, dtype=bool)
+        for term in set(tokenize(query)):
+            docs, freqs = self.postings(term)
+            if not len(docs):
+                continue
+            idf = np.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = k1 * (1 - b + b * self.lengths[docs] / self.average)
+            total[docs] += idf * freqs * (k1 + 1) / (freqs + norm)
+            hit[docs] = True
+        if ids is None:
+            found = np.flatnonzero(hit)
+        else:
+            found = ids[hit[ids]]
+        return found, total[found]
+
+    def search(self, query, ids=None, k=None):
+        '''
+        Returns the rows matching a query, best first.
+
+        Parameters
+        ----------
+        query: string
+            the words to look for
+        ids: numpy array
+            if given, only these rows are searched
+        k: int
+            how many rows to return, every match if None
+
+        Returns
+        -------
+        ids: numpy array
+            the matching rows, best first
+        scores: numpy array
+            the BM25 score of each of them
+        '''
+        with metrics.timer('text_search'):
+            found, scores = self.scores(query, ids)
+            top = top_k(scores, len(found) if k is None else k)
+        return found[top], scores[top]
+
+    def save(self, path, stamps):
+        '''
+        Saves the index with the stamps of the caches it was built from.
+        '''
+        vocab = '\n'.join(sorted(self.terms, key=self.terms.get)).encode('utf-8')
+        data = io.BytesIO()
+        np.savez(data, version=np.array([index_version]), stamps=np.array(stamps, dtype=np.int64),
+                 vocab=np.frombuffer(vocab, dtype=np.uint8), start=self.start,
+                 docs=self.docs, freqs=self.freqs, lengths=self.lengths)
+        write_bytes_atomic(path, data.getvalue())
+
+    @classmethod
+    def load(cls, path, stamps):
+        '''
+        Loads a saved index, or returns None if it's missing, from
+        another version, or built from caches that have changed.
+        '''
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if int(data['version'][0]) != index_version or data['stamps'].tolist() != stamps:
+                return None
+            vocab = data['vocab'].tobytes().decode('utf-8')
+            terms = {term: t for t, term in enumerate(vocab.split('\n'))} if vocab else {}
+            return cls(terms, data['start'], data['docs'], data['freqs'], data['lengths'])
+
+
+def build_index(documents):
+    '''
+    Builds a TextIndex from the fields of each row, see fields.
+
+    Parameters
+    ----------
+    documents: iterable
+        a dictionary of field texts for each row, in store order
+
+    Returns
+    -------
+    index: TextIndex
+        the index of every row
+    '''
+    counts = {}
+    lengths = []
+    for row, texts in enumerate(documents):
+        length = 0.0
+        for field, text in texts.items():
+            weight = field_weights[field]
+            for term in tokenize(text):
+                postings = counts.setdefault(term, {})
+                postings[row] = postings.get(row, 0.0) + weight
+                length += weight
+        lengths.append(length)
+    terms = {term: t for t, term in enumerate(sorted(counts))}
+    start = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum([len(counts[term]) for term in terms], out=start[1:])
+    docs = np.empty(start[-1], dtype=np.int32)
+    freqs = np.empty(start[-1], dtype=np.float32)
+    for term, t in terms.items():
+        rows = sorted(counts[term])
+        docs[start[t]:start[t + 1]] = rows
+        freqs[start[t]:start[t + 1]] = [counts[term][r] for r in rows]
+    return TextIndex(terms, start, docs, freqs, np.array(lengths, dtype=np.float32))
+
+
+def merge_indexes(indexes):
+    '''
+    Combines the indexes of several stores into one over their merged
+    rows, like merge_stores: the rows of each index follow the rows
+    of the one before it.
+    '''
+    if len(indexes) == 1:
+        return indexes[0]
+    terms = {term: t for t, term in enumerate(sorted(set().union(*[index.terms for index in indexes])))}
+    offsets = np.cumsum([0] + [len(index) for index in indexes])
+    parts = {t: [] for t in range(len(terms))}
+    for index, offset in zip(indexes, offsets):
+        for term, t in index.terms.items():
+            docs, freqs = index.postings(term)
+            parts[terms[term]].append((docs + offset, freqs))
+    start = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum([sum(len(d) for d, f in parts[t]) for t in range(len(terms))], out=start[1:])
+    docs = np.empty(start[-1], dtype=np.int32)
+    freqs = np.empty(start[-1], dtype=np.float32)
+    for t in range(len(terms)):
+        if parts[t]:
+            docs[start[t]:start[t + 1]] = np.concatenate([d for d, f in parts[t]])
+            freqs[start[t]:start[t + 1]] = np.concatenate([f for d, f in parts[t]])
+    return TextIndex(terms, start, docs, freqs, np.concatenate([index.lengths for index in indexes]))
+
+
+def index_path(term):
+    '''
+    Returns the file the text index of a city is saved in.
+    '''
+    return f'{term}_text.npz'
+
+
+def load_text_index(term, store, eater_cache=None):
+    '''
+    Returns the text index of a city's store, loading the saved one
+    if the Yelp and Eater caches, and the way they're joined, haven't
+    changed since it was built, and building and saving it if they
+    have.
+
+    Parameters
+    ----------
+    term: string
+        the city term
+    store: RestaurantStore
+        the city's store, with its Eater entries attached
+    eater_cache: string
+        the city's Eater cache, or None if it has none
+
+    Returns
+    -------
+    index: TextIndex
+        the index of every row of the store
+    '''
+    stamps = []
+    for source in (f'{term}.json', eater_cache):
+        stamps += list(source_stamp(source)) if source and os.path.exists(source) else [0, 0]
+    ## a new join can attach other Eater entries to the same caches
+    stamps.append(join_version)
+    path = index_path(term)
+    index = TextIndex.load(path, stamps)
+    if index is not None and len(index) == len(store):
+        metrics.count('cache_hits', 1, 'text_index')
+        return index
+    metrics.count('cache_misses', 1, 'text_index')
+    with metrics.timer('text_index_build', term):
+        index = build_index(store_documents(store))
+    if stamps[:2] != [0, 0]:
+        index.save(path, stamps)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Searches restaurants by free text.')
+    parser.add_argument('query', help='the words to look for, like "late night tacos"')
+    parser.add_argument('--city', default='Detroit, Ann Arbor',
+                        help='the cities to search, separated by commas')
+    parser.add_argument('--rating', type=float)
+    parser.add_argument('--price')
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+    from FinalProject_akdas import city_terms, get_store
+    from store import merge_stores
+    restaurants = merge_stores([get_store(term).store for term in city_terms(args.city)]).all()
+    if args.rating is not None:
+        restaurants = restaurants.where_rating(args.rating)
+    if args.price is not None:
+        restaurants = restaurants.where_price(args.price)
+    found = restaurants.search(args.query)
+    print(f'{len(found)} matches')
+    for r in found[:args.limit]:
+        print(r.info() + (' (Eater pick)' if r.eater else ''))
+
+
+if __name__ == "__main__":
+    main()
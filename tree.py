@@ -1,73 +1,117 @@
-import json
+import argparse
+import os
 
-# Load the JSON file
-with open('tree.json') as f:
-    data = json.load(f)
+from sessionlog import SessionLog, stage_names, trace_file
 
-print(' ')
-print('Initial results for input city:')
-print(' ')
-for i, r in enumerate(data['initial results']):
-    print(i, r)
-print(' ')
-for i in range(7):
-    print('              |               ')
-print('              V               ')
-print(' ')
-if len(data['type results']) == 1:
-    print('User did not choose to filter by type')
-    print(' ')
-    print('              |               ')
-    print('              V               ')
-    print(' ')
-else:
-    print(' ')
-    print('Would you like to filter by restaurant type?:')
-    print(' ')
-    print('              |               ')
-    print('              V               ')
-    print(' ')
-    for i, r in enumerate(data['type results']):
-        print(i, r)
-    print(' ')
-    for i in range(7):
-        print('              |               ')
-print('              V               ')
-print(' ')
-if len(data['rating results']) == 1:
-    print('User did not choose to filter by type')
-    print(' ')
-    print('              |               ')
-    print('              V               ')
-    print(' ')
-else:
-    print(' ')
-    print('Would you like to filter by rating?:')
-    print(' ')
-    print('              |               ')
-    print('              V               ')
-    print(' ')
-    for i, r in enumerate(data['rating results']):
-        print(i, r)
-    print(' ')
-    for i in range(7):
+questions = {'type results': 'Would you like to filter by restaurant type?:',
+             'rating results': 'Would you like to filter by rating?:',
+             'price results': 'Would you like to filter by restaurant price?:'}
+
+
+def arrow(length=1):
+    for i in range(length):
         print('              |               ')
-print('              V               ')
-print(' ')
-if len(data['price results']) == 1:
-    print('User did not choose to filter by price')
-    print(' ')
-    print('              |               ')
     print('              V               ')
     print(' ')
-else:
-    print(' ')
-    print('Would you like to filter by restaurant price?:')
-    print(' ')
-    print('              |               ')
-    print('              V               ')
-    print(' ')
-    for i, r in enumerate(data['price results']):
+
+
+def print_page(log, session, stage, page, size):
+    '''
+    Prints one page of a stage and how many pages it has.
+    '''
+    count = session['stages'][stage]['count']
+    for i, r in log.page(session, stage, page, size):
         print(i, r)
+    pages = max((count + size - 1) // size, 1)
+    print(f'(page {page + 1} of {pages}, {count} restaurants)')
+
+
+def print_session(log, session, size):
+    '''
+    Prints the first page of every stage of a session, like the
+    old tree of the whole session.
+    '''
+    print(' ')
+    print(f"Initial results for {', '.join(session['cities'])}:")
+    print(' ')
+    print_page(log, session, 0, 0, size)
+    print(' ')
+    arrow(7)
+    for stage in range(1, len(session['stages'])):
+        name = session['stages'][stage]['name']
+        if 'filter' in session['stages'][stage]:
+            filtered = session['stages'][stage]['filter'] is not None
+        else:
+            ## older logs have no filters, and a stage with as many rows
+            # as the one before is taken as not filtered
+            filtered = session['stages'][stage]['count'] != session['stages'][stage - 1]['count']
+        if not filtered:
+            print(f"User did not choose to filter by {name.split()[0]}")
+            print(' ')
+            arrow()
+            continue
+        print(' ')
+        print(questions.get(name, name))
+        if session['stages'][stage].get('value') is not None:
+            print(f"User chose {session['stages'][stage]['value']}")
+        print(' ')
+        arrow()
+        print_page(log, session, stage, 0, size)
+        print(' ')
+        arrow(7)
     print('Done, user would pick one of these restaurants')
-# dict_keys(['initial results', 'type results', 'rating results', 'price results'])
\ No newline at end of file
+
+
+def positive(text):
+    '''
+    Reads a command line number that must be 1 or more.
+    '''
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f'{text} is not 1 or more')
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shows the sessions in the trace log.')
+    parser.add_argument('--log', default=trace_file)
+    parser.add_argument('--list', action='store_true', help='list the sessions in the log')
+    parser.add_argument('--session', type=int, default=-1,
+                        help='the session to show, -1 for the latest')
+    parser.add_argument('--stage', choices=[name.split()[0] for name in stage_names],
+                        help='page through just this stage')
+    parser.add_argument('--page', type=positive, default=1)
+    parser.add_argument('--page-size', type=positive, default=20)
+    args = parser.parse_args()
+    if not os.path.exists(args.log):
+        print(f'No sessions yet, run FinalProject_akdas.py to make {args.log}')
+        return
+    log = SessionLog(args.log)
+    if len(log) == 0:
+        print('No sessions yet')
+        return
+    if args.list:
+        for i in range(len(log)):
+            session = log.session(i)
+            counts = ' -> '.join(str(stage['count']) for stage in session['stages'])
+            print(f"{i}: {', '.join(session['cities'])}, {counts}")
+        return
+    if not -len(log) <= args.session < len(log):
+        parser.error(f'there are {len(log)} sessions, --session must be from {-len(log)} to {len(log) - 1}')
+    session = log.session(args.session)
+    if args.stage is None:
+        print_session(log, session, args.page_size)
+    else:
+        stage = [name.split()[0] for name in stage_names].index(args.stage)
+        if stage >= len(session['stages']):
+            print(f'The session ended before its {args.stage} stage')
+            return
+        pages = max((session['stages'][stage]['count'] + args.page_size - 1) // args.page_size, 1)
+        if args.page > pages:
+            parser.error(f'the {args.stage} stage has {pages} pages')
+        print(f"{session['stages'][stage]['name']}:")
+        print_page(log, session, stage, args.page - 1, args.page_size)
+
+
+if __name__ == "__main__":
+    main()